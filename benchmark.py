@@ -0,0 +1,615 @@
+"""Benchmarks for the Dairy Farm Management System.
+
+Run with: python benchmark.py loader --rows 100000 1000000
+          python benchmark.py store --rows 100000
+          python benchmark.py archive --rows 1000000
+          python benchmark.py suite --cows 100 --workers 4 --years 2 --output results.json
+          python benchmark.py farms --farms 8
+
+The suite runs the app end to end with Streamlit's AppTest against an
+in-process fake of the gspread Spreadsheet API, filled by a seeded
+synthetic farm, and writes timings and Sheets call counts as JSON. The
+farms benchmark opens one farm after another in the same process and
+prints each farm's startup time and the memory used so far.
+"""
+import argparse
+import collections
+import gc
+import json
+import logging
+import os
+import platform
+import re
+import statistics
+import subprocess
+import tempfile
+import time
+import tracemalloc
+from datetime import date, datetime, timedelta
+
+import gspread
+import numpy as np
+import pandas as pd
+import streamlit
+import streamlit.config
+
+# Outside `streamlit run` Streamlit warns once on import and on every call that there is no script run
+streamlit.config.set_option("global.showWarningOnDirectExecution", False)
+logging.getLogger("streamlit.runtime.scriptrunner_utils.script_run_context").disabled = True
+
+import cow_milk_tracker as app
+
+
+def synthetic_milk_values(rows, seed=0):
+    """Raw milk_data sheet values as returned by get_values, header row first"""
+    rng = np.random.default_rng(seed)
+    days = rng.integers(0, 3 * 365, rows)
+    dates = (np.datetime64("2023-01-01") + days).astype(str)
+    sessions = np.where(rng.random(rows) < 0.5, "Morning", "Evening")
+    cows = rng.integers(1, 501, rows)
+    liters = np.round(rng.gamma(9.0, 1.1, rows), 1)
+    workers = rng.choice(["John Doe", "Mary Smith", "David Johnson", "Sarah Wilson"], rows)
+    values = [app.MILK_DATA_HEADERS]
+    for d, s, c, l, w in zip(dates.tolist(), sessions.tolist(), cows.tolist(), liters.tolist(), workers.tolist()):
+        values.append([d, s, c, l, w, "", f"{d} 06:00:00"])
+    return values
+
+
+def formatted_values(values):
+    """The same sheet as get_all_records sees it: every cell formatted as text"""
+    return [values[0]] + [[str(cell) for cell in row] for row in values[1:]]
+
+
+def legacy_load(values):
+    """The previous loader: get_all_records dicts plus a per-row conversion loop"""
+    data = gspread.utils.to_records(values[0], [gspread.utils.numericise_all(row) for row in values[1:]])
+    clean_data = []
+    for row in data:
+        if row.get('date') and row.get('cow_number') and row.get('milk_liters'):
+            try:
+                row['cow_number'] = int(row['cow_number'])
+                row['milk_liters'] = float(row['milk_liters'])
+                clean_data.append(row)
+            except (ValueError, TypeError):
+                continue
+    return clean_data
+
+
+def timed(func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - start
+
+
+def bench_loader(rows_list):
+    for rows in rows_list:
+        values = synthetic_milk_values(rows)
+        legacy, legacy_time = timed(legacy_load, formatted_values(values))
+        (frame, rejected), vector_time = timed(app.parse_milk_frame, values)
+        assert len(legacy) == len(frame) + sum(rejected.values())
+        print(f"{rows:>9,} rows  legacy {legacy_time:7.2f}s  vectorized {vector_time:7.2f}s  "
+              f"speedup {legacy_time / vector_time:5.1f}x")
+
+
+def frame_to_records(frame):
+    """The previous session state layout: one dict per record"""
+    columns = list(frame.columns)
+    return [dict(zip(columns, row)) for row in zip(*(frame[column].tolist() for column in columns))]
+
+
+def legacy_reports(milk_data):
+    """The previous Production Reports rerun: rebuild a DataFrame from the list of dicts"""
+    df = pd.DataFrame(milk_data)
+    df['date'] = pd.to_datetime(df['date'])
+    daily = df.groupby('date')['milk_liters'].sum().reset_index()
+    workers = df.groupby('worker')['milk_liters'].sum().reset_index()
+    cows = df.groupby('cow_number')['milk_liters'].agg(['sum', 'mean', 'count'])
+    return df['milk_liters'].sum(), daily, workers, cows
+
+
+def bench_store(rows_list):
+    for rows in rows_list:
+        frame, _ = app.parse_milk_frame(synthetic_milk_values(rows))
+
+        tracemalloc.start()
+        milk_data = frame_to_records(frame)
+        list_bytes = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        store = app.MilkRecordStore(frame)
+        store_bytes = store.frame().memory_usage(deep=True).sum()
+
+        _, legacy_time = timed(legacy_reports, milk_data)
+        _, store_time = timed(store.summary)
+        print(f"{rows:>9,} rows  memory/record list {list_bytes / rows:6.0f}B  store {store_bytes / rows:4.0f}B  "
+              f"reports rerun list {legacy_time * 1000:7.1f}ms  store {store_time * 1000:7.1f}ms")
+
+
+def bench_archive(rows_list):
+    """Multi-year date-range report: recompute from the store vs scan the memory-mapped archive"""
+    for rows in rows_list:
+        frame, _ = app.parse_milk_frame(synthetic_milk_values(rows))
+        store = app.MilkRecordStore(frame)
+        with tempfile.TemporaryDirectory() as directory:
+            archive = app.MilkArchive(directory)
+            _, sync_time = timed(archive.sync, store, "2099_01")
+            months = archive.months()
+            _, store_time = timed(store.range_rollups, "2023-03-15", "2025-09-02")
+            _, archive_time = timed(archive.rollups, months, "2023-03-15", "2025-09-02")
+        print(f"{rows:>9,} rows  build {sync_time * 1000:7.1f}ms  range report store {store_time * 1000:7.1f}ms  "
+              f"archive {archive_time * 1000:7.1f}ms")
+
+
+class FakeWorksheet:
+    """In-memory stand-in for gspread.Worksheet; every API call is counted on its spreadsheet"""
+
+    def __init__(self, spreadsheet, title, sheet_id):
+        self.spreadsheet = spreadsheet
+        self.title = title
+        self.id = sheet_id
+        self.rows = []
+
+    @staticmethod
+    def _format(value):
+        """Cell as the Sheets UI formats it"""
+        if isinstance(value, float) and value.is_integer():
+            return str(int(value))
+        return str(value)
+
+    def _values(self, value_render_option=None):
+        self._trim()
+        if value_render_option == "UNFORMATTED_VALUE":
+            rows = [list(row) for row in self.rows]
+        else:
+            rows = [[self._format(value) for value in row] for row in self.rows]
+        return gspread.utils.fill_gaps(rows)
+
+    def _trim(self):
+        while self.rows and all(value == "" for value in self.rows[-1]):
+            self.rows.pop()
+
+    def _set(self, range_name, values):
+        row, col = gspread.utils.a1_to_rowcol(range_name.split(":")[0])
+        for i, new in enumerate(values):
+            while len(self.rows) < row + i:
+                self.rows.append([])
+            target = self.rows[row + i - 1]
+            for j, value in enumerate(new):
+                while len(target) < col + j:
+                    target.append("")
+                target[col + j - 1] = value
+        self._trim()
+
+    def get_all_values(self, **kwargs):
+        self.spreadsheet.count("get_all_values")
+        return self._values()
+
+    def get_values(self, range_name=None, value_render_option=None, **kwargs):
+        self.spreadsheet.count("get_values")
+        return self._values(value_render_option)
+
+    def row_values(self, row, **kwargs):
+        self.spreadsheet.count("row_values")
+        return [self._format(value) for value in self.rows[row - 1]] if len(self.rows) >= row else []
+
+    def col_values(self, col, **kwargs):
+        self.spreadsheet.count("col_values")
+        return [self._format(row[col - 1]) if len(row) >= col else "" for row in self.rows]
+
+    def append_rows(self, values, **kwargs):
+        self.spreadsheet.count("append_rows")
+        self._trim()
+        self.rows.extend(list(row) for row in values)
+
+    def update(self, values=None, range_name=None, **kwargs):
+        self.spreadsheet.count("update")
+        self._set(range_name or "A1", values)
+
+    def batch_update(self, data, **kwargs):
+        self.spreadsheet.count("batch_update")
+        for entry in data:
+            self._set(entry["range"], entry["values"])
+
+    def batch_clear(self, ranges):
+        self.spreadsheet.count("batch_clear")
+        for range_name in ranges:
+            start, _, end = range_name.partition(":")
+            first = gspread.utils.a1_to_rowcol(start)[0]
+            last = int(re.sub(r"[A-Z]", "", end) or len(self.rows))
+            for i in range(first - 1, min(last, len(self.rows))):
+                self.rows[i] = []
+        self._trim()
+
+    def update_title(self, title):
+        self.spreadsheet.count("update_title")
+        del self.spreadsheet.sheets[self.title]
+        self.title = title
+        self.spreadsheet.sheets[title] = self
+
+
+class FakeSpreadsheet:
+    """In-memory stand-in for gspread.Spreadsheet that counts API calls.
+
+    latency adds a sleep to every call to model the network round trip.
+    """
+
+    def __init__(self, spreadsheet_id="benchmark", latency=0.0):
+        self.id = spreadsheet_id
+        self.title = spreadsheet_id
+        self.latency = latency
+        self.sheets = {}
+        self.calls = collections.Counter()
+
+    def count(self, operation):
+        self.calls[operation] += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def worksheet(self, title):
+        self.count("worksheet")
+        if title not in self.sheets:
+            raise gspread.WorksheetNotFound(title)
+        return self.sheets[title]
+
+    def worksheets(self):
+        self.count("worksheets")
+        return list(self.sheets.values())
+
+    def add_worksheet(self, title, rows=1000, cols=10, **kwargs):
+        self.count("add_worksheet")
+        self.sheets[title] = FakeWorksheet(self, title, len(self.sheets) + 1)
+        return self.sheets[title]
+
+    def values_batch_get(self, ranges, params=None):
+        self.count("values_batch_get")
+        render = (params or {}).get("valueRenderOption")
+        value_ranges = []
+        for range_name in ranges:
+            # 'title' or 'title'!A5:Z; of a cell range only the first row is honoured
+            title, _, cells = range_name.rpartition("'")
+            rows = self.sheets[title[1:].replace("''", "'")]._values(render)
+            if cells:
+                rows = rows[gspread.utils.a1_to_rowcol(cells.lstrip("!").split(":")[0])[0] - 1:]
+            value_ranges.append({"range": range_name, "values": rows} if rows else {"range": range_name})
+        return {"valueRanges": value_ranges}
+
+
+class SyntheticFarm:
+    """Seedable synthetic farm: cows milked Morning and Evening by their assigned workers.
+
+    Yields follow Wood's lactation curve over a 305-day lactation with a
+    60-day dry period, scaled per cow, split 55/45 between Morning and
+    Evening, with multiplicative noise and a few missed milkings. Records
+    end yesterday, so today's worker form starts empty.
+    """
+
+    def __init__(self, cows=100, workers=4, years=1, seed=0, end=None):
+        self.cows = cows
+        self.workers = [f"Worker {i + 1}" for i in range(workers)]
+        self.assignments = {cow: self.workers[(cow - 1) % workers] for cow in range(1, cows + 1)}
+        self.end = end or date.today() - timedelta(days=1)
+        self.start = self.end - timedelta(days=365 * years - 1)
+        self.seed = seed
+
+    def milk_frame(self):
+        rng = np.random.default_rng(self.seed)
+        days = (self.end - self.start).days + 1
+        day_index = np.arange(days)[:, None, None]
+        calving = rng.integers(0, 365, self.cows)[None, :, None]
+        in_milk = (day_index + calving) % 365 + 1
+        peak = np.clip(rng.normal(14.0, 3.0, self.cows), 5.0, None)[None, :, None]
+        # Wood's curve a * t^b * e^(-ct) peaks at t = b / c, scaled so the peak is the cow's peak yield
+        b, c = 0.2, 0.004
+        curve = in_milk ** b * np.exp(-c * in_milk) / ((b / c) ** b * np.exp(-b))
+        share = np.array([0.55, 0.45])[None, None, :]
+        liters = peak * curve * share * rng.normal(1.0, 0.08, (days, self.cows, 2))
+        milked = (in_milk <= 305) & (rng.random((days, self.cows, 2)) > 0.01)
+        liters = np.round(np.where(milked, liters, 0.0), 1)
+
+        day, cow, session = np.nonzero(liters > 0)
+        dates = (np.datetime64(self.start) + day).astype(str)
+        sessions = np.array(["Morning", "Evening"])[session]
+        clock = np.array([" 06:00:00", " 18:00:00"])[session]
+        workers = np.array([self.assignments[c + 1] for c in range(self.cows)])[cow]
+        return pd.DataFrame({
+            "date": dates,
+            "time": sessions,
+            "cow_number": cow + 1,
+            "milk_liters": liters[day, cow, session],
+            "worker": workers,
+            "notes": "",
+            "timestamp": np.char.add(dates, clock),
+            "record_id": [f"{self.seed}-{i}" for i in range(len(day))],
+        })
+
+    def last_yields(self, session):
+        """Cow -> liters at its last milking in a session, what a worker would enter today"""
+        frame = self.milk_frame()
+        frame = frame[frame["time"] == session].sort_values("date")
+        return frame.groupby("cow_number")["milk_liters"].last().to_dict()
+
+    def spreadsheet(self, spreadsheet_id="benchmark", latency=0.0):
+        """A FakeSpreadsheet holding the farm in the app's worksheet layout"""
+        sheet = FakeSpreadsheet(spreadsheet_id, latency)
+
+        def add(title, rows):
+            sheet.sheets[title] = FakeWorksheet(sheet, title, len(sheet.sheets) + 1)
+            sheet.sheets[title].rows = rows
+
+        add("workers", [["name"]] + [[worker] for worker in self.workers])
+        add("cow_assignments", [["cow_number", "worker_name"]] + [[cow, worker] for cow, worker in self.assignments.items()])
+        add("system_config", [["total_cows", "last_updated"], [self.cows, self.end.isoformat()]])
+        add("milk_events", [app.MILK_EVENT_HEADERS])
+        frame = self.milk_frame()
+        for partition, rows in frame.groupby(app.milk_partition_keys(frame["date"]), sort=True):
+            add(app.milk_partition_sheet(partition),
+                [app.MILK_DATA_HEADERS] + rows[app.MILK_DATA_HEADERS].values.tolist())
+        return sheet
+
+
+APP_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "cow_milk_tracker.py")
+
+
+class AppSession:
+    """One browser session of the app under AppTest, connected to a fake spreadsheet"""
+
+    def __init__(self, sheet, instrumentation=True, farms=None, farm_id=None):
+        from streamlit.testing.v1 import AppTest
+        self.sheet = sheet
+        self.at = AppTest.from_file(APP_PATH, default_timeout=600)
+        self.at.session_state["gsheets_conn"] = sheet
+        # Benchmarks measure the app, not the client-side quota limiter
+        self.at.secrets["sheets"] = {"read_requests_per_minute": 1e6, "write_requests_per_minute": 1e6, "burst": 1e6}
+        self.at.secrets["diagnostics"] = {"enabled": instrumentation}
+        if farms:
+            self.at.secrets["farms"] = farms
+            self.at.session_state["farm_id"] = farm_id
+        self.farm_id = farm_id or "default"
+        self.tab = None
+
+    def open_tab(self, label):
+        """Switch the supervisor dashboard to a tab; only the open tab's panel runs"""
+        self.tab = label
+        return self.run()
+
+    def run(self):
+        # AppTest does not send the selected tab back with the other widget states
+        if self.tab:
+            self.at.session_state["supervisor_tab"] = self.tab
+        self.at.run()
+        if self.at.exception:
+            raise RuntimeError([e.value for e in self.at.exception])
+        return self
+
+    def interact(self, widget):
+        """Rerun after a widget change, e.g. session.interact(button.click())"""
+        return self.run()
+
+    def login(self, role, user=None):
+        self.at.session_state["role"] = role
+        if role == "supervisor":
+            # Supervisor access is granted per farm
+            self.at.session_state["supervisor_password_correct"] = self.farm_id
+        if user:
+            self.at.session_state["current_user"] = user
+        return self.run()
+
+
+def measure(results, name, sheet, action):
+    """Time one app interaction and the Sheets calls it made"""
+    before = collections.Counter(sheet.calls)
+    start = time.perf_counter()
+    action()
+    seconds = time.perf_counter() - start
+    calls = {operation: count - before[operation] for operation, count in sheet.calls.items() if count != before[operation]}
+    results.append({"scenario": name, "seconds": seconds, "sheets_calls": calls})
+
+
+def run_scenarios(farm, sheet, results, instrumentation=True):
+    def new_session():
+        return AppSession(sheet, instrumentation)
+
+    supervisor = new_session()
+    measure(results, "initialize_session_state", sheet, supervisor.run)
+    measure(results, "first_supervisor_dashboard", sheet, lambda: supervisor.login("supervisor"))
+    measure(results, "warm_session_start", sheet, lambda: new_session().login("supervisor"))
+
+    # Worker fills in every assigned cow (the first page of the grid for large assignments)
+    # and submits; saved once the rows reach the sheet
+    worker = new_session().login("worker", farm.workers[0])
+    # Each cow gets about its usual yield, so the entry-time yield check lets the batch through
+    cows = sorted(cow for cow, name in farm.assignments.items() if name == farm.workers[0])
+    usual = farm.last_yields("Morning" if datetime.now().hour < 12 else "Evening")
+    if len(cows) > app.BULK_ENTRY_THRESHOLD:
+        page = cows[:app.BULK_ENTRY_PAGE_SIZE]
+        worker.at.session_state[app.bulk_entry_grid_key(page)] = {
+            "edited_rows": {row: {"milk_liters": usual.get(cow, 9.5)} for row, cow in enumerate(page)},
+            "added_rows": [], "deleted_rows": [],
+        }
+        entered = len(page)
+    else:
+        for number_input in worker.at.number_input:
+            # Inputs are keyed milk_<cow>
+            number_input.set_value(usual.get(int(number_input.key.split("_")[1]), 9.5))
+        entered = len(worker.at.number_input)
+    submit = [button for button in worker.at.button if "सेव" in button.label][0]
+    current = app.milk_partition_sheet(app.milk_partition(date.today()))
+
+    def saved_rows():
+        return len(sheet.sheets[current].rows) - 1 if current in sheet.sheets else 0
+    target = saved_rows() + entered
+    measure(results, "worker_batch_submit", sheet, lambda: submit.click().run())
+
+    def saved():
+        while saved_rows() < target:
+            time.sleep(0.01)
+    measure(results, "worker_batch_saved", sheet, saved)
+
+    # The supervisor's next live update fetches just the worker's new rows
+    supervisor.at.session_state["milk_synced_at"] = 0.0
+    measure(results, "supervisor_live_sync", sheet, supervisor.run)
+
+    supervisor.open_tab("📊 Production Reports")
+    report_start = supervisor.at.date_input(key="report_start")
+    measure(results, "production_reports_full_history", sheet,
+            lambda: supervisor.interact(report_start.set_value(farm.start)))
+    measure(results, "production_reports_rerun", sheet, supervisor.run)
+
+    # A simple action in a session whose report range spans the whole history
+    supervisor.open_tab("👥 Manage Workers")
+    [field for field in supervisor.at.text_input if field.label == "Worker Name"][0].input("Benchmark Worker")
+    add_worker = [button for button in supervisor.at.button if button.label == "Add Worker"][0]
+    measure(results, "add_worker", sheet, lambda: supervisor.interact(add_worker.click()))
+
+    archived = new_session().login("supervisor").open_tab("📊 Production Reports")
+    measure(results, "production_reports_archived", sheet,
+            lambda: archived.interact(archived.at.date_input(key="report_start").set_value(farm.start)))
+
+    daily = new_session().login("supervisor").open_tab("📋 Daily Records")
+    select_date = [field for field in daily.at.date_input if field.label == "Select Date"][0]
+    measure(results, "daily_records_old_date", sheet,
+            lambda: daily.interact(select_date.set_value(farm.start + timedelta(days=40))))
+
+    export = new_session().login("supervisor").open_tab("⚙️ System Settings")
+    prepare = [button for button in export.at.button if button.label == "📦 Prepare Export"][0]
+    measure(results, "export_csv", sheet, lambda: export.interact(prepare.click()))
+    # Another session exporting the same unchanged history reuses the file on disk
+    export = new_session().login("supervisor").open_tab("⚙️ System Settings")
+    prepare = [button for button in export.at.button if button.label == "📦 Prepare Export"][0]
+    measure(results, "export_csv_cached", sheet, lambda: export.interact(prepare.click()))
+
+
+def rss_bytes():
+    """Resident memory of this process (peak on platforms without /proc)"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def bench_farms(args):
+    """One process serving more and more farms: startup time and memory per added farm"""
+    farms = [SyntheticFarm(args.cows, args.workers, args.years, args.seed + i) for i in range(args.farms)]
+    sheets = [farm.spreadsheet(f"farm-{i}", args.latency) for i, farm in enumerate(farms)]
+    config = {f"farm{i}": {"name": f"Farm {i + 1}", "spreadsheet": sheet.id} for i, sheet in enumerate(sheets)}
+    sessions = []
+    workdir = os.getcwd()
+    with tempfile.TemporaryDirectory() as directory:
+        os.chdir(directory)
+        try:
+            gc.collect()
+            baseline = rss_bytes()
+            first = None
+            print(f"{len(farms[0].milk_frame()):,} records per farm")
+            for i, (farm, sheet) in enumerate(zip(farms, sheets)):
+                # A supervisor and a worker open each farm and stay connected
+                start = time.perf_counter()
+                sessions.append(AppSession(sheet, farms=config, farm_id=f"farm{i}").login("supervisor"))
+                sessions.append(AppSession(sheet, farms=config, farm_id=f"farm{i}").login("worker", farm.workers[0]))
+                startup = time.perf_counter() - start
+                gc.collect()
+                memory = rss_bytes() - baseline
+                first = first or (startup, memory)
+                count = i + 1
+                print(f"{count:>3} farms  startup of this farm {startup * 1000:7.0f}ms ({startup / first[0]:4.2f}x first)  "
+                      f"memory {memory / 2**20:7.1f}MB ({memory / (count * first[1]):4.2f}x of {count} x first farm)")
+        finally:
+            os.chdir(workdir)
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(APP_PATH), check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def bench_suite(args):
+    farm = SyntheticFarm(args.cows, args.workers, args.years, args.seed)
+    runs = []
+    workdir = os.getcwd()
+    with tempfile.TemporaryDirectory() as directory:
+        # Journals, archives and databases the app creates stay out of the checkout
+        os.chdir(directory)
+        try:
+            for repeat in range(args.repeat):
+                # A new spreadsheet id per repeat, so no process-wide cache carries over
+                sheet = farm.spreadsheet(f"benchmark-{args.seed}-{repeat}", args.latency)
+                results = []
+                run_scenarios(farm, sheet, results, not args.no_instrumentation)
+                runs.append(results)
+        finally:
+            os.chdir(workdir)
+
+    scenarios = []
+    for i, first in enumerate(runs[0]):
+        seconds = [run[i]["seconds"] for run in runs]
+        scenarios.append({
+            "scenario": first["scenario"],
+            "median_seconds": statistics.median(seconds),
+            "seconds": seconds,
+            "sheets_calls": first["sheets_calls"],
+        })
+    report = {
+        "generated_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "git_commit": git_commit(),
+        "versions": {"python": platform.python_version(), "pandas": pd.__version__,
+                     "numpy": np.__version__, "streamlit": streamlit.__version__},
+        "farm": {"cows": args.cows, "workers": args.workers, "years": args.years, "seed": args.seed,
+                 "records": len(farm.milk_frame())},
+        "latency_seconds": args.latency,
+        "instrumentation": not args.no_instrumentation,
+        "repeat": args.repeat,
+        "scenarios": scenarios,
+    }
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    print(output)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+    loader = subparsers.add_parser("loader", help="milk_data sheet parsing, old loop vs vectorized")
+    loader.add_argument("--rows", type=int, nargs="+", default=[100_000, 1_000_000])
+    store = subparsers.add_parser("store", help="list of dicts vs columnar MilkRecordStore")
+    store.add_argument("--rows", type=int, nargs="+", default=[100_000])
+    archive = subparsers.add_parser("archive", help="date-range report, store recompute vs columnar archive")
+    archive.add_argument("--rows", type=int, nargs="+", default=[1_000_000])
+    suite = subparsers.add_parser("suite", help="end-to-end app scenarios against a fake spreadsheet, as JSON")
+    suite.add_argument("--cows", type=int, default=100)
+    suite.add_argument("--workers", type=int, default=4)
+    suite.add_argument("--years", type=int, default=2)
+    suite.add_argument("--seed", type=int, default=0)
+    suite.add_argument("--latency", type=float, default=0.0, help="seconds added to every Sheets call")
+    suite.add_argument("--repeat", type=int, default=3)
+    suite.add_argument("--no-instrumentation", action="store_true",
+                       help="run with the app's diagnostics timers turned off, to measure their overhead")
+    suite.add_argument("--output", help="also write the JSON report to this file")
+    farms = subparsers.add_parser("farms", help="startup time and memory as one process serves more farms")
+    farms.add_argument("--farms", type=int, default=8)
+    farms.add_argument("--cows", type=int, default=100)
+    farms.add_argument("--workers", type=int, default=4)
+    farms.add_argument("--years", type=int, default=1)
+    farms.add_argument("--seed", type=int, default=0)
+    farms.add_argument("--latency", type=float, default=0.0, help="seconds added to every Sheets call")
+    args = parser.parse_args()
+
+    if args.benchmark == "loader":
+        bench_loader(args.rows)
+    elif args.benchmark == "store":
+        bench_store(args.rows)
+    elif args.benchmark == "archive":
+        bench_archive(args.rows)
+    elif args.benchmark == "suite":
+        bench_suite(args)
+    elif args.benchmark == "farms":
+        bench_farms(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,9 +1,33 @@
 import streamlit as st
+from streamlit.errors import StreamlitAPIException
 import pandas as pd
+import numpy as np
+import openpyxl
 from datetime import datetime, date
 import gspread
 from google.oauth2.service_account import Credentials
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+import abc
+import collections
+import copy
+import hashlib
+import hmac
+import io
 import json
+import os
+import random
+import re
+import sqlite3
+import threading
+import time
+import uuid
+import warnings
+try:
+    import fcntl
+except ImportError:
+    # Windows: storage writes are only serialized within one process
+    fcntl = None
 from datetime import datetime, date, timedelta  # Add timedelta here
 
 # Configure page
@@ -15,48 +39,72 @@ st.set_page_config(
 )
 
 # Google Sheets Integration Functions
+class GspreadClientPool:
+    """A few authorized gspread clients shared by every farm this process serves.
+
+    Spreadsheets are opened on the clients in turn. All clients share one
+    set of credentials, so the access token is refreshed once for the whole
+    process however many farms are open.
+    """
+
+    def __init__(self, credentials, size=4):
+        self.clients = [gspread.authorize(credentials) for _ in range(max(1, size))]
+        self.opened = 0
+        self.lock = threading.Lock()
+
+    def open(self, spreadsheet_id):
+        with self.lock:
+            client = self.clients[self.opened % len(self.clients)]
+            self.opened += 1
+        return client.open_by_key(spreadsheet_id)
+
+@st.cache_resource
+def get_gspread_pool():
+    """Authorized gspread clients for the service account in st.secrets; None without credentials"""
+    if "connections" not in st.secrets or "gsheet" not in st.secrets["connections"]:
+        return None
+
+    # Define the scope
+    scope = [
+        "https://www.googleapis.com/auth/spreadsheets",
+        "https://www.googleapis.com/auth/drive"
+    ]
+
+    # Get credentials from Streamlit secrets (updated path)
+    gsheet_config = st.secrets["connections"]["gsheet"]
+    credentials_dict = {
+        "type": gsheet_config["type"],
+        "project_id": gsheet_config["project_id"],
+        "private_key_id": gsheet_config["private_key_id"],
+        "private_key": gsheet_config["private_key"],
+        "client_email": gsheet_config["client_email"],
+        "client_id": gsheet_config["client_id"],
+        "auth_uri": gsheet_config["auth_uri"],
+        "token_uri": gsheet_config["token_uri"],
+        "auth_provider_x509_cert_url": gsheet_config.get("auth_provider_x509_cert_url", "https://www.googleapis.com/oauth2/v1/certs"),
+        "client_x509_cert_url": gsheet_config.get("client_x509_cert_url", f"https://www.googleapis.com/robot/v1/metadata/x509/{gsheet_config['client_email']}")
+    }
+
+    # Create credentials and authorize the shared clients
+    credentials = Credentials.from_service_account_info(credentials_dict, scopes=scope)
+    return GspreadClientPool(credentials, int(get_app_setting("sheets", "client_pool_size", 4)))
+
 @st.cache_resource
 # Replace your initialize_gsheets_connection function with this updated version:
 
 @st.cache_resource
-def initialize_gsheets_connection():
-    """Initialize Google Sheets connection using gspread"""
+def initialize_gsheets_connection(spreadsheet_id):
+    """Open a farm's spreadsheet through the shared client pool"""
     try:
-        # Check if secrets are available
-        if "connections" not in st.secrets or "gsheet" not in st.secrets["connections"]:
+        pool = get_gspread_pool()
+        if pool is None:
             st.warning("⚠️ Google Sheets credentials not found. Running in local mode.")
             return None
-            
-        # Define the scope
-        scope = [
-            "https://www.googleapis.com/auth/spreadsheets",
-            "https://www.googleapis.com/auth/drive"
-        ]
-        
-        # Get credentials from Streamlit secrets (updated path)
-        gsheet_config = st.secrets["connections"]["gsheet"]
-        credentials_dict = {
-            "type": gsheet_config["type"],
-            "project_id": gsheet_config["project_id"],
-            "private_key_id": gsheet_config["private_key_id"],
-            "private_key": gsheet_config["private_key"],
-            "client_email": gsheet_config["client_email"],
-            "client_id": gsheet_config["client_id"],
-            "auth_uri": gsheet_config["auth_uri"],
-            "token_uri": gsheet_config["token_uri"],
-            "auth_provider_x509_cert_url": gsheet_config.get("auth_provider_x509_cert_url", "https://www.googleapis.com/oauth2/v1/certs"),
-            "client_x509_cert_url": gsheet_config.get("client_x509_cert_url", f"https://www.googleapis.com/robot/v1/metadata/x509/{gsheet_config['client_email']}")
-        }
-        
-        # Create credentials
-        credentials = Credentials.from_service_account_info(credentials_dict, scopes=scope)
-        
-        # Authorize and return the client
-        gc = gspread.authorize(credentials)
+        if spreadsheet_id is None:
+            st.info("💾 No spreadsheet is configured for this farm. Running in local mode.")
+            return None
         
-        # Open the spreadsheet using the ID from secrets
-        spreadsheet_id = gsheet_config["spreadsheet"]
-        sheet = gc.open_by_key(spreadsheet_id)
+        sheet = pool.open(spreadsheet_id)
         
         st.success("✅ Successfully connected to Google Sheets!")
         return sheet
@@ -66,164 +114,2880 @@ def initialize_gsheets_connection():
         st.info("💡 The app will continue to work in local mode (data won't be saved to Google Sheets)")
         return None
 
+class SheetsQuotaError(Exception):
+    """Google Sheets kept throttling requests after all retries"""
+
+class TokenBucket:
+    """Token-bucket rate limiter shared by all threads of the process"""
+
+    def __init__(self, rate_per_minute, capacity):
+        self.rate = rate_per_minute / 60.0
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Take one token, sleeping until one is available; returns the seconds waited"""
+        waited = 0.0
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return waited
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+            waited += wait
+
+# Spreadsheet and worksheet methods that count against the read quota, everything else is a write
+SHEETS_READ_OPERATIONS = {
+    "worksheet", "worksheets", "fetch_sheet_metadata", "values_get", "values_batch_get",
+    "get", "batch_get", "get_values", "get_all_values", "get_all_records",
+    "row_values", "col_values", "acell", "cell", "find", "findall",
+}
+# Writes that leave the sheet the same however often they run. Other writes, like append_rows,
+# may have been applied when a 5xx comes back, so only a 429 (rejected before running) is retried
+SHEETS_IDEMPOTENT_WRITES = {
+    "update", "batch_update", "values_update", "values_batch_update",
+    "clear", "batch_clear", "values_clear", "values_batch_clear", "update_title", "resize",
+}
+
+class SheetsClient:
+    """Quota-aware wrapper around the gspread Spreadsheet handle.
+
+    Worksheet handles are cached, so only the first lookup of a worksheet
+    costs a metadata round trip. Every API call takes a token from a read or
+    write bucket sized to the Sheets per-user quotas (60 requests per minute
+    each by default), is retried with jittered exponential backoff on 429
+    responses, and on 5xx responses too for reads and idempotent writes,
+    and is counted per operation with its latency.
+
+    When several farms share the service account, each farm's client gets
+    its own share of the quota and also takes a token from the process-wide
+    buckets in shared_buckets, so together they stay within the quota.
+    """
+
+    def __init__(self, spreadsheet, read_per_minute=60, write_per_minute=60, burst=10,
+                 max_retries=5, base_delay=1.0, max_delay=32.0, shared_buckets=None):
+        self.spreadsheet = spreadsheet
+        self.read_bucket = TokenBucket(read_per_minute, burst)
+        self.write_bucket = TokenBucket(write_per_minute, burst)
+        self.shared_buckets = shared_buckets
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.worksheets = {}
+        self.worksheets_loaded = False
+        self.stats = {}
+        self.lock = threading.Lock()
+        # Serializes handle lookups so concurrent loaders never create the same worksheet twice
+        self.handles_lock = threading.RLock()
+
+    def _record(self, operation, **counts):
+        with self.lock:
+            stats = self.stats.setdefault(operation, {
+                'calls': 0, 'errors': 0, 'retries': 0, 'throttled_seconds': 0.0,
+                'total_seconds': 0.0, 'max_seconds': 0.0,
+            })
+            for name, value in counts.items():
+                stats[name] += value
+            if 'total_seconds' in counts:
+                stats['max_seconds'] = max(stats['max_seconds'], counts['total_seconds'])
+
+    def call(self, operation, func, *args, **kwargs):
+        """Run one API call under the rate limiter, retrying throttled and, where safe, server errors"""
+        kind = 'read' if operation in SHEETS_READ_OPERATIONS else 'write'
+        repeatable = kind == 'read' or operation in SHEETS_IDEMPOTENT_WRITES
+        bucket = self.read_bucket if kind == 'read' else self.write_bucket
+        for attempt in range(self.max_retries + 1):
+            throttled = bucket.acquire()
+            if self.shared_buckets:
+                throttled += self.shared_buckets[kind].acquire()
+            self._record(operation, throttled_seconds=throttled)
+            start = time.perf_counter()
+            try:
+                result = func(*args, **kwargs)
+            except gspread.exceptions.APIError as e:
+                self._record(operation, calls=1, errors=1, total_seconds=time.perf_counter() - start)
+                status = getattr(getattr(e, "response", None), "status_code", None) or getattr(e, "code", 0)
+                if (status == 429 or (status >= 500 and repeatable)) and attempt < self.max_retries:
+                    self._record(operation, retries=1)
+                    time.sleep(min(self.max_delay, self.base_delay * 2 ** attempt) * random.uniform(0.5, 1.5))
+                    continue
+                if status == 429:
+                    raise SheetsQuotaError(
+                        "Google Sheets request quota exceeded, please try again in a minute"
+                    ) from e
+                raise
+            self._record(operation, calls=1, total_seconds=time.perf_counter() - start)
+            return result
+
+    def worksheet(self, worksheet_name):
+        """Cached, metered handle for a worksheet, created if it does not exist"""
+        handle = self.worksheets.get(worksheet_name)
+        if handle is not None:
+            return handle
+        with self.handles_lock:
+            handle = self.worksheets.get(worksheet_name)
+            if handle is not None:
+                return handle
+            try:
+                if self.worksheets_loaded:
+                    # Every existing worksheet is already cached
+                    raise gspread.WorksheetNotFound(worksheet_name)
+                worksheet = self.call("worksheet", self.spreadsheet.worksheet, worksheet_name)
+            except gspread.WorksheetNotFound:
+                worksheet = self.call("add_worksheet", self.spreadsheet.add_worksheet,
+                                      title=worksheet_name, rows=1000, cols=10)
+            handle = MeteredWorksheet(self, worksheet)
+            self.worksheets[worksheet_name] = handle
+        return handle
+
+    def load_worksheets(self):
+        """Cache handles for every existing worksheet with a single metadata call"""
+        with self.handles_lock:
+            if self.worksheets_loaded:
+                return
+            for worksheet in self.call("worksheets", self.spreadsheet.worksheets):
+                self.worksheets.setdefault(worksheet.title, MeteredWorksheet(self, worksheet))
+            self.worksheets_loaded = True
+
+    def batch_values(self, worksheet_names, **params):
+        """Values of several whole worksheets in one values.batchGet request, keyed by name.
+
+        Missing worksheets are created first, since one bad range fails the
+        whole request. params are batchGet query parameters such as
+        valueRenderOption; rows are padded like gspread's get_values.
+        """
+        return self.batch_ranges({name: None for name in worksheet_names}, **params)
+
+    def batch_ranges(self, ranges, **params):
+        """Values of several worksheet ranges in one values.batchGet request.
+
+        ranges maps worksheet names to an A1 range within the sheet, or None
+        for the whole worksheet; the result is keyed by worksheet name.
+        """
+        self.load_worksheets()
+        for worksheet_name in ranges:
+            self.worksheet(worksheet_name)
+        a1_ranges = ["'" + name.replace("'", "''") + "'" + (f"!{cells}" if cells else "") for name, cells in ranges.items()]
+        response = self.call("values_batch_get", self.spreadsheet.values_batch_get, a1_ranges, params=params or None)
+        return {
+            name: gspread.utils.fill_gaps(value_range.get('values', []))
+            for name, value_range in zip(ranges, response.get('valueRanges', []))
+        }
+
+    def worksheet_names(self):
+        """Titles of all worksheets, without creating any"""
+        self.load_worksheets()
+        return list(self.worksheets)
+
+    def forget_worksheet(self, worksheet_name):
+        self.worksheets.pop(worksheet_name, None)
+        self.worksheets_loaded = False
+
+    def metrics(self):
+        """Per-operation call counts and latency as a DataFrame"""
+        with self.lock:
+            stats = {operation: dict(values) for operation, values in self.stats.items()}
+        frame = pd.DataFrame.from_dict(stats, orient="index")
+        if not frame.empty:
+            frame['avg_ms'] = (frame['total_seconds'] / frame['calls'].clip(lower=1) * 1000).round(1)
+        return frame
+
+class MeteredWorksheet:
+    """Worksheet proxy that sends every API method through a SheetsClient"""
+
+    def __init__(self, client, worksheet):
+        self._client = client
+        self._worksheet = worksheet
+
+    def __getattr__(self, name):
+        attribute = getattr(self._worksheet, name)
+        if name.startswith("_") or not callable(attribute):
+            return attribute
+
+        def metered(*args, **kwargs):
+            try:
+                return self._client.call(name, attribute, *args, **kwargs)
+            except gspread.exceptions.APIError:
+                # The worksheet may have been deleted or renamed, look it up again next time
+                self._client.forget_worksheet(self._worksheet.title)
+                raise
+        return metered
+
+@st.cache_resource
+def get_shared_quota():
+    """Process-wide read and write buckets for the service account's Sheets quota"""
+    burst = float(get_app_setting("sheets", "burst", 10))
+    return {
+        'read': TokenBucket(float(get_app_setting("sheets", "read_requests_per_minute", 60)), burst),
+        'write': TokenBucket(float(get_app_setting("sheets", "write_requests_per_minute", 60)), burst),
+    }
+
+@st.cache_resource
+def get_sheets_client(spreadsheet_id, _sheet):
+    """One quota-aware client per spreadsheet, shared by all sessions and the write queue"""
+    farms = get_farms()
+    farm = next((farm for farm in farms.values() if farm.spreadsheet_id == spreadsheet_id), None)
+    return SheetsClient(
+        _sheet,
+        read_per_minute=farm.read_per_minute if farm else float(get_app_setting("sheets", "read_requests_per_minute", 60)),
+        write_per_minute=farm.write_per_minute if farm else float(get_app_setting("sheets", "write_requests_per_minute", 60)),
+        burst=float(get_app_setting("sheets", "burst", 10)),
+        shared_buckets=get_shared_quota() if len(farms) > 1 else None,
+    )
+
 def get_worksheet(sheet, worksheet_name):
-    """Get or create a worksheet"""
+    """Get or create a worksheet through the quota-aware client"""
+    return get_sheets_client(sheet.id, sheet).worksheet(worksheet_name)
+
+def batch_read_worksheets(sheet, worksheet_names, **params):
+    """Read several worksheets in one request through the quota-aware client"""
+    return get_sheets_client(sheet.id, sheet).batch_values(worksheet_names, **params)
+
+@st.cache_resource
+def get_sheet_snapshots():
+    """Process-wide last-known contents of the synced worksheets"""
+    return {}
+
+def _snapshot_key(worksheet):
+    return (worksheet.spreadsheet.id, worksheet.id)
+
+def _normalize_row(row):
+    """Stringify a row the way Sheets returns it and drop trailing blanks"""
+    values = ["" if v is None else str(v) for v in row]
+    while values and values[-1] == "":
+        values.pop()
+    return values
+
+def sheet_records(values):
+    """Rows of normalized worksheet values (header row first) as dicts, skipping blank rows"""
+    if len(values) < 2:
+        return []
+    headers = values[0]
+    return [{h: (row[i] if i < len(row) else "") for i, h in enumerate(headers)} for row in values[1:] if any(row)]
+
+def read_sheet_records(worksheet, values=None):
+    """Read a worksheet as a list of dicts and remember its contents for diff-based syncing.
+
+    values may hold the worksheet contents from a batched read.
+    """
+    if values is None:
+        values = worksheet.get_all_values()
+    values = [_normalize_row(row) for row in values]
+    while values and not values[-1]:
+        values.pop()
+    get_sheet_snapshots()[_snapshot_key(worksheet)] = values
+    return sheet_records(values)
+
+def contiguous_runs(positions):
+    """[first, last] of each run of consecutive integers in sorted positions"""
+    runs = []
+    for position in positions:
+        if runs and runs[-1][1] == position - 1:
+            runs[-1][1] = position
+        else:
+            runs.append([position, position])
+    return runs
+
+def write_changed_rows(worksheet, old, new):
+    """Write the rows of new that differ from the normalized rows of old, in one batch update.
+
+    Changed rows are grouped into contiguous ranges, and rows new no longer
+    has are blanked in the same request. Returns the number of rows written.
+    """
+    normalized = [_normalize_row(row) for row in new]
+    changed = [i for i in range(max(len(old), len(new)))
+               if (old[i] if i < len(old) else []) != (normalized[i] if i < len(new) else [])]
+    if not changed:
+        return 0
+
+    data = []
+    for first, last in contiguous_runs(changed):
+        width = max(max(len(old[i]) if i < len(old) else 0, len(normalized[i]) if i < len(new) else 0)
+                    for i in range(first, last + 1))
+        values = []
+        for i in range(first, last + 1):
+            row = list(new[i]) if i < len(new) else []
+            values.append(row + [""] * (width - len(row)))
+        data.append({
+            "range": f"A{first + 1}:{gspread.utils.rowcol_to_a1(last + 1, width)}",
+            "values": values,
+        })
+    worksheet.batch_update(data)
+    return len(changed)
+
+def merge_keyed_rows(base, current, rows, key):
+    """Apply the changes from base to rows onto current, matching rows by their first key columns.
+
+    base and current are normalized worksheet values, rows the wanted
+    values; all have the header row first. Rows keep their place in
+    current: a removed row is blanked rather than shifting the rows below
+    it, and new rows fill blank rows before being added at the end. Rows
+    added or edited in current by someone else are kept. Returns the new
+    worksheet layout.
+    """
+    def key_of(row):
+        return tuple(row[:key]) if any(row) else None
+
+    base_rows = {key_of(row): row for row in base[1:] if any(row)}
+    wanted = {}
+    for row in rows[1:]:
+        normalized = _normalize_row(row)
+        if any(normalized):
+            wanted[key_of(normalized)] = (normalized, list(row))
+    removed = base_rows.keys() - wanted.keys()
+    changed = {k: row for k, (normalized, row) in wanted.items() if base_rows.get(k) != normalized}
+
+    layout = [list(rows[0])] + [list(row) for row in current[1:]]
+    placed = set()
+    for i, row in enumerate(current[1:], 1):
+        k = key_of(row)
+        if k in removed or (k in changed and k in placed):
+            layout[i] = []
+        elif k in changed:
+            layout[i] = changed[k]
+            placed.add(k)
+    holes = [i for i, row in enumerate(layout) if i and not any(_normalize_row(row))]
+    for k, row in changed.items():
+        if k in placed:
+            continue
+        if holes:
+            layout[holes.pop(0)] = row
+        else:
+            layout.append(row)
+    return layout
+
+def sync_rows_to_sheet(worksheet, rows, key=1):
+    """Save rows (header included) to a worksheet, writing only the rows that changed.
+
+    The worksheet is read again first and the changes since this process
+    last read or wrote it are merged in by key (the first `key` columns),
+    so rows another process or a person edited in the meantime are kept
+    and removing a row does not rewrite the rows below it. key=0 replaces
+    the contents row by row, for single-record tables. The write is one
+    batch update, so the sheet is never empty while the sync runs. Returns
+    the worksheet contents as saved, header first.
+    """
+    snapshots = get_sheet_snapshots()
+    snapshot_key = _snapshot_key(worksheet)
+    current = [_normalize_row(row) for row in worksheet.get_all_values()]
+    base = snapshots.get(snapshot_key, current)
+    header = _normalize_row(rows[0])
+    if key and current and base and current[0] == header and base[0] == header:
+        layout = merge_keyed_rows(base, current, rows, key)
+    else:
+        layout = [list(row) for row in rows]
+
     try:
-        return sheet.worksheet(worksheet_name)
-    except gspread.WorksheetNotFound:
-        # Create the worksheet if it doesn't exist
-        return sheet.add_worksheet(title=worksheet_name, rows=1000, cols=10)
+        write_changed_rows(worksheet, current, layout)
+    except Exception:
+        # The sheet may be partially written, re-read it on the next sync
+        snapshots.pop(snapshot_key, None)
+        raise
+    saved = [_normalize_row(row) for row in layout]
+    while saved and not saved[-1]:
+        saved.pop()
+    snapshots[snapshot_key] = saved
+    return saved
+
+DEFAULT_WORKERS = ["John Doe", "Mary Smith", "David Johnson", "Sarah Wilson"]
 
-def load_workers_from_sheets(sheet):
+def load_workers_from_sheets(sheet, values=None):
     """Load workers from Google Sheets"""
     try:
         worksheet = get_worksheet(sheet, "workers")
-        data = worksheet.get_all_records()
+        data = read_sheet_records(worksheet, values)
         
         if not data:
             # Initialize with default workers
-            default_workers = ["John Doe", "Mary Smith", "David Johnson", "Sarah Wilson"]
-            worksheet.clear()
-            worksheet.append_row(["name"])
-            for worker in default_workers:
-                worksheet.append_row([worker])
-            return default_workers
+            sync_rows_to_sheet(worksheet, [["name"]] + [[worker] for worker in DEFAULT_WORKERS])
+            return list(DEFAULT_WORKERS)
         
         return [row['name'] for row in data if row.get('name')]
     except Exception as e:
         st.error(f"Error loading workers: {e}")
-        return ["John Doe", "Mary Smith", "David Johnson", "Sarah Wilson"]
+        return list(DEFAULT_WORKERS)
 
 def save_workers_to_sheets(sheet, workers):
-    """Save workers to Google Sheets"""
+    """Save workers to Google Sheets, updating only the rows that changed.
+
+    Returns the workers as saved, which includes any added elsewhere in the
+    meantime, or None when the save failed.
+    """
     try:
         worksheet = get_worksheet(sheet, "workers")
-        worksheet.clear()
-        worksheet.append_row(["name"])
-        for worker in workers:
-            worksheet.append_row([worker])
-        return True
+        saved = sync_rows_to_sheet(worksheet, [["name"]] + [[worker] for worker in workers])
+        return [row['name'] for row in sheet_records(saved) if row.get('name')]
     except Exception as e:
         st.error(f"Failed to save workers: {e}")
-        return False
+        return None
 
-def load_cow_assignments_from_sheets(sheet):
+def load_cow_assignments_from_sheets(sheet, values=None):
     """Load cow assignments from Google Sheets"""
     try:
         worksheet = get_worksheet(sheet, "cow_assignments")
-        data = worksheet.get_all_records()
-        
-        if not data:
-            return {}
-        
-        assignments = {}
-        for row in data:
-            if row.get('cow_number') and row.get('worker_name'):
-                try:
-                    cow_num = int(row['cow_number'])
-                    assignments[cow_num] = row['worker_name']
-                except ValueError:
-                    continue
-        
-        return assignments
+        return cow_assignments_from_records(read_sheet_records(worksheet, values))
     except Exception as e:
         st.error(f"Error loading cow assignments: {e}")
         return {}
 
+def cow_assignments_from_records(data):
+    """Cow number -> worker name from cow_assignments rows, skipping incomplete ones"""
+    assignments = {}
+    for row in data:
+        if row.get('cow_number') and row.get('worker_name'):
+            try:
+                cow_num = int(row['cow_number'])
+                assignments[cow_num] = row['worker_name']
+            except ValueError:
+                continue
+    return assignments
+
 def save_cow_assignments_to_sheets(sheet, assignments):
-    """Save cow assignments to Google Sheets"""
+    """Save cow assignments to Google Sheets, updating only the rows that changed.
+
+    Returns the assignments as saved, or None when the save failed.
+    """
     try:
         worksheet = get_worksheet(sheet, "cow_assignments")
-        worksheet.clear()
-        worksheet.append_row(["cow_number", "worker_name"])
-        
-        for cow_number, worker_name in assignments.items():
-            worksheet.append_row([cow_number, worker_name])
-        
-        return True
+        rows = [["cow_number", "worker_name"]]
+        rows += [[cow_number, worker_name] for cow_number, worker_name in assignments.items()]
+        return cow_assignments_from_records(sheet_records(sync_rows_to_sheet(worksheet, rows)))
     except Exception as e:
         st.error(f"Failed to save cow assignments: {e}")
-        return False
+        return None
+
+# record_id is a unique id per record so replayed writes can be recognised
+MILK_DATA_HEADERS = ["date", "time", "cow_number", "milk_liters", "worker", "notes", "timestamp", "record_id"]
+
+def parse_milk_frame(values):
+    """Parse raw milk_data values (header row first) into a clean DataFrame in bulk.
+
+    Returns (frame, rejected) where rejected maps each rejection reason to
+    the number of rows dropped for it. Blank rows are ignored.
+    """
+    if len(values) < 2:
+        return pd.DataFrame(columns=MILK_DATA_HEADERS), {}
+
+    headers = [str(h).strip() for h in values[0]]
+    df = pd.DataFrame(values[1:])
+    df = df.reindex(columns=range(len(headers)))
+    df.columns = headers
+    return clean_milk_frame(df)
+
+def parse_datetimes(values):
+    """Parse a Series of date or timestamp cells in bulk; cells that do not parse become NaT.
+
+    ISO 8601 text (what the app writes) is parsed in one vectorized pass.
+    Anything else, like a hand-typed 10/17/2026 or a Sheets locale format,
+    is parsed leniently one distinct value at a time, month first when
+    ambiguous.
+    """
+    text = values.astype("string")
+    parsed = pd.to_datetime(text, format="ISO8601", errors="coerce")
+    retry = parsed.isna() & text.notna()
+    if retry.any():
+        with warnings.catch_warnings():
+            # pandas warns about every day-first value it had to guess
+            warnings.simplefilter("ignore", UserWarning)
+            lenient = {value: pd.to_datetime(value, errors="coerce") for value in text[retry].unique()}
+        parsed = parsed.astype(object)
+        parsed[retry] = text[retry].map(lenient)
+        parsed = pd.to_datetime(parsed, errors="coerce")
+    return parsed
+
+def clean_milk_frame(df):
+    """Validate and type a DataFrame with milk_data columns; returns (frame, rejected) like parse_milk_frame"""
+    df = df.copy()
+    for column in MILK_DATA_HEADERS:
+        if column not in df.columns:
+            df[column] = None
+    df = df.replace("", None)
+    df = df[df.notna().any(axis=1)]
+
+    dates = parse_datetimes(df['date'])
+    cows = pd.to_numeric(df['cow_number'], errors="coerce")
+    liters = pd.to_numeric(df['milk_liters'], errors="coerce")
+
+    # The first failing check is the reason a row is rejected
+    checks = [
+        ("missing date, cow_number or milk_liters",
+         df['date'].isna() | df['cow_number'].isna() | df['milk_liters'].isna() | (liters == 0)),
+        ("invalid date", dates.isna()),
+        ("invalid cow_number", cows.isna() | (cows % 1 != 0)),
+        ("invalid milk_liters", liters.isna() | (liters < 0)),
+    ]
+    rejected = {}
+    bad = pd.Series(False, index=df.index)
+    for reason, mask in checks:
+        new_bad = mask & ~bad
+        if new_bad.any():
+            rejected[reason] = int(new_bad.sum())
+        bad |= mask
+
+    good = ~bad
+    clean = df.loc[good].copy()
+    clean['date'] = dates[good].dt.strftime("%Y-%m-%d")
+    clean['cow_number'] = cows[good].astype("int64")
+    clean['milk_liters'] = liters[good].astype("float64")
+    for column in clean.columns.difference(['date', 'cow_number', 'milk_liters']):
+        clean[column] = clean[column].fillna("").astype(str)
+    return clean, rejected
+
+# Milk values are read unformatted so gspread skips per-row dict building, dates stay as text
+MILK_VALUE_RENDER = {"valueRenderOption": "UNFORMATTED_VALUE", "dateTimeRenderOption": "FORMATTED_STRING"}
+
+def read_milk_values(worksheet):
+    """Raw values of a milk worksheet"""
+    return worksheet.get_values(
+        value_render_option="UNFORMATTED_VALUE",
+        date_time_render_option="FORMATTED_STRING",
+    )
+
+# Natural key of a milk record, used to fold edit and delete events
+MILK_KEY = ["date", "time", "worker", "cow_number"]
+MILK_EVENT_HEADERS = ["event", "event_id"] + MILK_DATA_HEADERS
+
+def last_milk_events(events):
+    """The events that count, in log order: the last per record_id, and the last per natural key of events without one"""
+    targeted = events['record_id'] != ""
+    last = pd.concat([events[targeted].drop_duplicates(subset="record_id", keep="last"),
+                      events[~targeted].drop_duplicates(subset=MILK_KEY, keep="last")])
+    return last.sort_index(kind="stable")
+
+def fold_milk_events(base, events):
+    """Work out what the change log does to the base records; returns (superseded, upserts).
+
+    superseded is a boolean array over the base rows that events replace or
+    remove, upserts the rows that take their place. An event changes the
+    rows of the record it names by record_id, and the last event (by log
+    position) per record counts, so a cow logged again after a delete is a
+    new record and is kept however soon after the delete it was saved.
+    Events without a record_id, from older versions, change the rows of
+    their natural key that are not newer than the event.
+    """
+    last = last_milk_events(events)
+    targeted = (last['record_id'] != "").to_numpy()
+    by_id, by_key = last[targeted], last[~targeted].copy()
+    superseded = (base['record_id'].isin(by_id['record_id']) & (base['record_id'] != "")).to_numpy(copy=True)
+    upserts = [by_id[by_id['event'] == "upsert"]]
+
+    if not by_key.empty:
+        by_key['event_time'] = parse_datetimes(by_key['timestamp'].replace("", None))
+        lookup = base[MILK_KEY].merge(by_key[MILK_KEY + ['event_time']], on=MILK_KEY, how="left")
+        base_time = parse_datetimes(base['timestamp'].replace("", None))
+        has_event = lookup['event_time'].notna().to_numpy()
+        newer = (base_time.to_numpy() > lookup['event_time'].to_numpy())
+        superseded |= has_event & ~newer
+        # Keys re-logged after the event keep the newer record instead of the upsert
+        newer_keys = lookup.loc[has_event & newer, MILK_KEY].drop_duplicates()
+        keyed = by_key[by_key['event'] == "upsert"].merge(newer_keys, on=MILK_KEY, how="left", indicator=True)
+        upserts.append(keyed[keyed['_merge'] == "left_only"])
+
+    upserts = pd.concat(upserts, ignore_index=True).reindex(columns=base.columns)
+    return superseded, upserts
+
+def materialize_milk_events(base, events):
+    """Fold upsert and delete events into the base milk records, see fold_milk_events"""
+    if events.empty:
+        return base
+    superseded, upserts = fold_milk_events(base, events)
+    if upserts.empty:
+        return base[~superseded].reset_index(drop=True)
+    return pd.concat([base[~superseded], upserts], ignore_index=True)
+
+# Milk records are stored in one worksheet per month, e.g. milk_data_2026_10
+MILK_PARTITION_PREFIX = "milk_data_"
+MILK_PARTITION_PATTERN = re.compile(r"milk_data_(\d{4}_\d{2})")
+# Single worksheet used before partitioning, read until it is migrated
+LEGACY_MILK_SHEET = "milk_data"
+
+def milk_partition(day):
+    """Partition key ("2026_10") of a record date"""
+    return pd.Timestamp(day).strftime("%Y_%m")
+
+def milk_partition_keys(dates):
+    """Partition keys of a Series of YYYY-MM-DD date strings"""
+    return dates.astype(str).str[:7].str.replace("-", "_")
+
+def milk_partitions_between(start, end):
+    """Partition keys of every month from start to end, inclusive"""
+    months = pd.period_range(pd.Timestamp(start).to_period("M"), pd.Timestamp(end).to_period("M"), freq="M")
+    return [month.strftime("%Y_%m") for month in months]
+
+def milk_partition_sheet(partition):
+    return MILK_PARTITION_PREFIX + partition
+
+def milk_partitions_in_sheets(sheet):
+    """Partition keys that have a worksheet, oldest first"""
+    names = get_sheets_client(sheet.id, sheet).worksheet_names()
+    return sorted(match.group(1) for match in map(MILK_PARTITION_PATTERN.fullmatch, names) if match)
+
+def has_legacy_milk_sheet(sheet):
+    return LEGACY_MILK_SHEET in get_sheets_client(sheet.id, sheet).worksheet_names()
+
+def fetch_milk_data_from_sheets(sheet, partitions=None):
+    """Milk records of some monthly partitions (all when None) with the edit/delete log applied.
+
+    The partition worksheets and the log are read in one request. Returns
+    (frame, rejected counts); raises on failure and makes no Streamlit calls,
+    so it can run off the script thread.
+    """
+    available = milk_partitions_in_sheets(sheet)
+    wanted = available if partitions is None else [p for p in partitions if p in available]
+    names = [milk_partition_sheet(p) for p in wanted] + ["milk_events"]
+    legacy = has_legacy_milk_sheet(sheet)
+    if legacy:
+        names.append(LEGACY_MILK_SHEET)
+    values = batch_read_worksheets(sheet, names, **MILK_VALUE_RENDER)
+
+    frames, rejected = [], {}
+    for name in names:
+        if name == "milk_events":
+            continue
+        frame, dropped = parse_milk_frame(values[name])
+        if name == LEGACY_MILK_SHEET and partitions is not None:
+            frame = frame[milk_partition_keys(frame['date']).isin(partitions)]
+        frames.append(frame)
+        for reason, count in dropped.items():
+            rejected[reason] = rejected.get(reason, 0) + count
+    frame = pd.concat(frames, ignore_index=True) if frames else pd.DataFrame(columns=MILK_DATA_HEADERS)
+
+    events, _ = parse_milk_frame(values["milk_events"])
+    if partitions is not None and not events.empty:
+        events = events[milk_partition_keys(events['date']).isin(partitions)]
+    frame = materialize_milk_events(frame, events)
+    frame.attrs['sync_marks'] = {name: milk_sheet_mark(values[name]) for name in names if name != LEGACY_MILK_SHEET}
+    return frame, rejected
+
+def milk_sheet_mark(values):
+    """High-water mark of a worksheet read in full: its row count and its last row"""
+    return (len(values), _normalize_row(values[-1]) if values else [])
+
+def fetch_milk_changes_from_sheets(sheet, marks, partitions=None):
+    """Rows appended to the milk worksheets since their marks, in one request.
+
+    Reads each worksheet from its last known row down; when that row no
+    longer matches (the sheet was compacted or edited by hand) returns
+    None, and the caller reloads instead. Worksheets without a mark (a new
+    month) or that were empty are read in full. Returns (records, events, new marks).
+    """
+    available = milk_partitions_in_sheets(sheet)
+    names = ["milk_events"] + [milk_partition_sheet(p) for p in available if partitions is None or p in partitions]
+    ranges = {name: f"A{max(marks[name][0], 1)}:Z" if name in marks else None for name in names}
+    values = get_sheets_client(sheet.id, sheet).batch_ranges(ranges, **MILK_VALUE_RENDER)
+
+    frames, new_marks = {}, dict(marks)
+    for name in names:
+        rows = values[name]
+        if name not in marks or not marks[name][1]:
+            new_marks[name] = milk_sheet_mark(rows)
+            frames[name] = parse_milk_frame(rows)[0]
+            continue
+        count, last_row = marks[name]
+        if not rows or _normalize_row(rows[0]) != last_row:
+            return None
+        if len(rows) > 1:
+            new_marks[name] = (count + len(rows) - 1, _normalize_row(rows[-1]))
+            headers = get_worksheet_headers(get_worksheet(sheet, name))
+            frames[name] = parse_milk_frame([headers] + rows[1:])[0]
+    events = frames.pop("milk_events", pd.DataFrame(columns=MILK_EVENT_HEADERS))
+    records = pd.concat(frames.values(), ignore_index=True) if frames else pd.DataFrame(columns=MILK_DATA_HEADERS)
+    return records, events, new_marks
+
+def milk_month_version(*parts):
+    return hashlib.sha1(json.dumps(parts, default=str).encode()).hexdigest()[:16]
+
+def milk_month_versions_in_sheets(sheet, months):
+    """Month -> version from its worksheet's row count and the change-log events dated in it, in one request.
+
+    Records are appended and edits logged as events, which compaction
+    folds in and clears, so every change the app makes moves the version.
+    Only the first column of each month is read; cells edited by hand in
+    the middle of a worksheet are not noticed.
+    """
+    available = set(milk_partitions_in_sheets(sheet))
+    ranges = {"milk_events": None}
+    ranges.update({milk_partition_sheet(month): "A1:A" for month in months if month in available})
+    values = get_sheets_client(sheet.id, sheet).batch_ranges(ranges, **MILK_VALUE_RENDER)
+    events = parse_milk_frame(values["milk_events"])[0].reindex(columns=MILK_EVENT_HEADERS, fill_value="")
+    event_months = milk_partition_keys(events['date'])
+    return {
+        month: milk_month_version(len(values.get(milk_partition_sheet(month), [])),
+                                  sorted(events.loc[event_months == month, 'event_id']))
+        for month in months
+    }
+
+def warn_rejected_milk_rows(rejected):
+    if rejected:
+        details = ", ".join(f"{count} {reason}" for reason, count in rejected.items())
+        st.warning(f"⚠️ Skipped {sum(rejected.values())} invalid milk_data rows ({details})")
 
 def load_milk_data_from_sheets(sheet):
-    """Load milk data from Google Sheets"""
+    """Load milk data from Google Sheets as a DataFrame, with the edit/delete log applied"""
     try:
-        worksheet = get_worksheet(sheet, "milk_data")
-        data = worksheet.get_all_records()
-        
-        if not data:
-            return []
-        
-        # Clean and validate data
-        clean_data = []
-        for row in data:
-            if row.get('date') and row.get('cow_number') and row.get('milk_liters'):
-                try:
-                    # Ensure numeric values are properly converted
-                    row['cow_number'] = int(row['cow_number'])
-                    row['milk_liters'] = float(row['milk_liters'])
-                    clean_data.append(row)
-                except (ValueError, TypeError):
-                    continue
-        
-        return clean_data
+        frame, rejected = fetch_milk_data_from_sheets(sheet)
+        warn_rejected_milk_rows(rejected)
+        return frame
     except Exception as e:
         st.error(f"Error loading milk data: {e}")
-        return []
+        return pd.DataFrame(columns=MILK_DATA_HEADERS)
 
-def append_milk_data_to_sheets(sheet, new_records):
-    """Append only new milk data to Google Sheets, never clear the sheet."""
+# Rollup name -> record column it groups by
+ROLLUP_DIMENSIONS = {"day": "date", "cow": "cow_number", "worker": "worker", "session": "time"}
+
+class ProductionRollups:
+    """Running milk sum and record count per day, cow, worker and session.
+
+    Built once from the full history, then kept up to date as records are
+    appended, edited or deleted, so reports cost O(groups) instead of
+    O(records).
+    """
+
+    def __init__(self):
+        self.groups = {name: {} for name in ROLLUP_DIMENSIONS}
+        self.total = 0.0
+        self.count = 0
+
+    @classmethod
+    def from_frame(cls, frame):
+        """Full recompute from a typed record frame"""
+        rollups = cls()
+        for name, column in ROLLUP_DIMENSIONS.items():
+            grouped = frame.groupby(column, observed=True)['milk_liters'].agg(['sum', 'count'])
+            rollups.groups[name] = {
+                key: [total, count]
+                for key, total, count in zip(grouped.index.tolist(), grouped['sum'].tolist(), grouped['count'].tolist())
+            }
+        rollups.total = float(frame['milk_liters'].sum())
+        rollups.count = len(frame)
+        return rollups
+
+    def add(self, frame, sign=1):
+        """Add (sign=1) or remove (sign=-1) the records of a typed frame"""
+        self._add_columns({column: frame[column].tolist() for column in ROLLUP_DIMENSIONS.values()},
+                          frame['milk_liters'].tolist(), sign)
+
+    def add_record(self, record, sign=1):
+        """Add (sign=1) or remove (sign=-1) one MilkRecord"""
+        self._add_columns({'date': [pd.Timestamp(record.date)], 'cow_number': [record.cow_number],
+                           'worker': [record.worker], 'time': [record.time]},
+                          [record.milk_liters], sign)
+
+    def _add_columns(self, columns, liters, sign):
+        for name, column in ROLLUP_DIMENSIONS.items():
+            groups = self.groups[name]
+            for key, value in zip(columns[column], liters):
+                entry = groups.setdefault(key, [0.0, 0])
+                entry[0] += sign * value
+                entry[1] += sign
+                if entry[1] == 0:
+                    del groups[key]
+        self.total += sign * sum(liters)
+        self.count += sign * len(liters)
+
+    def merged(self, other):
+        """New rollups covering the records of both"""
+        result = ProductionRollups()
+        for source in (self, other):
+            for name, groups in source.groups.items():
+                target = result.groups[name]
+                for key, (total, count) in groups.items():
+                    entry = target.setdefault(key, [0.0, 0])
+                    entry[0] += total
+                    entry[1] += count
+            result.total += source.total
+            result.count += source.count
+        return result
+
+    def mismatches(self, other, tolerance=1e-6):
+        """(rollup, key) pairs whose sum or count differ from another rollup"""
+        found = []
+        for name in ROLLUP_DIMENSIONS:
+            mine, theirs = self.groups[name], other.groups[name]
+            for key in mine.keys() | theirs.keys():
+                a, b = mine.get(key, [0.0, 0]), theirs.get(key, [0.0, 0])
+                if a[1] != b[1] or abs(a[0] - b[0]) > tolerance:
+                    found.append((name, key))
+        if self.count != other.count or abs(self.total - other.total) > tolerance:
+            found.append(("total", None))
+        return found
+
+    def summary(self):
+        """Aggregates for the Production Reports tab"""
+        daily = pd.DataFrame(
+            sorted((day, entry[0]) for day, entry in self.groups['day'].items()),
+            columns=['date', 'milk_liters'],
+        )
+        by_worker = pd.DataFrame(
+            [(worker, entry[0]) for worker, entry in self.groups['worker'].items()],
+            columns=['worker', 'milk_liters'],
+        )
+        by_session = pd.DataFrame(
+            [(session, entry[0]) for session, entry in self.groups['session'].items()],
+            columns=['time', 'milk_liters'],
+        )
+        by_cow = pd.DataFrame(
+            [(cow, entry[0], entry[0] / entry[1], entry[1]) for cow, entry in self.groups['cow'].items()],
+            columns=['cow_number', 'sum', 'mean', 'count'],
+        ).set_index('cow_number')
+        return {
+            'total': self.total,
+            'mean': self.total / self.count if self.count else 0.0,
+            'active_cows': len(self.groups['cow']),
+            'records': self.count,
+            'daily': daily,
+            'by_worker': by_worker,
+            'by_session': by_session,
+            'by_cow': by_cow,
+        }
+
+MILK_CATEGORY_COLUMNS = ["time", "worker", "notes"]
+
+class MilkRecord:
+    """One milking of one cow"""
+    __slots__ = ("row_id", "date", "time", "cow_number", "milk_liters", "worker", "notes", "timestamp", "record_id")
+
+    def __init__(self, row_id, date, time, cow_number, milk_liters, worker, notes="", timestamp="", record_id=""):
+        self.row_id = row_id
+        self.date = date
+        self.time = time
+        self.cow_number = cow_number
+        self.milk_liters = milk_liters
+        self.worker = worker
+        self.notes = notes
+        self.timestamp = timestamp
+        self.record_id = record_id
+
+    @classmethod
+    def from_dict(cls, row_id, record):
+        return cls(row_id, str(record['date']), record['time'], int(record['cow_number']),
+                   float(record['milk_liters']), record['worker'],
+                   record.get('notes', ""), record.get('timestamp', ""), record.get('record_id', ""))
+
+    def to_dict(self):
+        return {header: getattr(self, header) for header in MILK_DATA_HEADERS}
+
+def select_milk_records(frame, start=None, end=None, workers=None, cows=None):
+    """Rows of a typed record frame in a date range, optionally only some workers and cows, in date order"""
+    mask = np.ones(len(frame), dtype=bool)
+    if start is not None:
+        mask &= (frame['date'] >= pd.Timestamp(start)).to_numpy()
+    if end is not None:
+        mask &= (frame['date'] <= pd.Timestamp(end)).to_numpy()
+    if workers:
+        mask &= frame['worker'].isin(workers).to_numpy()
+    if cows:
+        mask &= frame['cow_number'].isin(cows).to_numpy()
+    return frame[mask].sort_values(['date', 'timestamp'], kind="stable")
+
+class MilkRecordStore:
+    """Columnar in-memory store for milk records.
+
+    All records live in one DataFrame indexed by a stable row id, with dates
+    and timestamps as datetime64 and time (session), worker and notes as
+    categoricals. Appends are kept as MilkRecord objects in a small pending
+    buffer that is folded into the frame the next time a full view is
+    requested, so a submit never copies the whole history.
+
+    The store also maintains the production rollups and two indexes of row
+    ids: by (date, session, worker) for the worker dashboard and by date for
+    the Daily Records tab, so lookups do not scan the history.
+
+    partitions is the set of monthly partitions loaded so far, or None when
+    the store holds the whole history; older months are added on demand.
+    sync_marks are the storage high-water marks the loaded records were
+    read at, from which merge_changes() catches up with other sessions.
+    """
+
+    def __init__(self, frame=None, partitions=None):
+        if frame is None:
+            frame = pd.DataFrame(columns=MILK_DATA_HEADERS)
+        self.partitions = None if partitions is None else set(partitions)
+        self.sync_marks = frame.attrs.get('sync_marks')
+        self._frame = self._typed(frame.reset_index(drop=True))
+        self._pending = []
+        self._next_id = len(self._frame)
+        self.version = 0
+        self.rollups = ProductionRollups.from_frame(self._frame)
+        self._by_session = {}
+        self._by_date = {}
+        self._index_frame(self._frame)
+
+    @staticmethod
+    def _typed(frame):
+        """Cast record columns to the store's compact dtypes"""
+        frame = frame.copy()
+        for column in MILK_DATA_HEADERS:
+            if column not in frame.columns:
+                frame[column] = ""
+        frame['date'] = parse_datetimes(frame['date'])
+        frame['timestamp'] = parse_datetimes(frame['timestamp'].replace("", None))
+        frame['cow_number'] = frame['cow_number'].astype("int32")
+        frame['milk_liters'] = frame['milk_liters'].astype("float64")
+        for column in frame.columns.difference(['date', 'timestamp', 'cow_number', 'milk_liters']):
+            frame[column] = frame[column].fillna("").astype(str)
+        for column in MILK_CATEGORY_COLUMNS:
+            frame[column] = frame[column].astype("category")
+        return frame
+
+    @staticmethod
+    def _export(frame):
+        """Turn typed columns back into the plain values stored in the sheets"""
+        frame = frame.copy()
+        frame['date'] = frame['date'].dt.strftime("%Y-%m-%d")
+        frame['timestamp'] = frame['timestamp'].dt.strftime("%Y-%m-%d %H:%M:%S").fillna("")
+        for column in MILK_CATEGORY_COLUMNS:
+            frame[column] = frame[column].astype(str)
+        return frame
+
+    def _index_add(self, row_id, day, session, worker):
+        self._by_session.setdefault((day, session, worker), set()).add(row_id)
+        self._by_date.setdefault(day, set()).add(row_id)
+
+    def _index_remove(self, row_id, day, session, worker):
+        for index, key in ((self._by_session, (day, session, worker)), (self._by_date, day)):
+            row_ids = index.get(key)
+            if row_ids is not None:
+                row_ids.discard(row_id)
+                if not row_ids:
+                    del index[key]
+
+    def _index_frame(self, frame, remove=False):
+        """Add (or remove) the rows of a typed frame to the lookup indexes"""
+        update = self._index_remove if remove else self._index_add
+        days = frame['date'].dt.strftime("%Y-%m-%d").tolist()
+        for row_id, day, session, worker in zip(frame.index.tolist(), days, frame['time'].tolist(), frame['worker'].tolist()):
+            update(row_id, day, session, worker)
+
+    def _flush(self):
+        if not self._pending:
+            return
+        new = self._typed(pd.DataFrame([record.to_dict() for record in self._pending]))
+        new.index = pd.Index([record.row_id for record in self._pending])
+        self._pending = []
+        self._concat(new)
+
+    def _concat(self, new):
+        if self._frame.empty:
+            self._frame = new
+            return
+        # Align categories so concat keeps the categorical dtypes
+        for column in MILK_CATEGORY_COLUMNS:
+            missing = new[column].cat.categories.difference(self._frame[column].cat.categories)
+            if len(missing):
+                self._frame[column] = self._frame[column].cat.add_categories(missing)
+            new[column] = new[column].cat.set_categories(self._frame[column].cat.categories)
+        self._frame = pd.concat([self._frame, new])
+
+    def __len__(self):
+        return len(self._frame) + len(self._pending)
+
+    def frame(self):
+        """Typed view of all records, indexed by row id. Do not modify it in place."""
+        self._flush()
+        return self._frame
+
+    def export_frame(self):
+        """All records with dates and timestamps formatted as text"""
+        return self._export(self.frame())
+
+    def select(self, start=None, end=None, workers=None, cows=None):
+        """Typed records in a date range, optionally only some workers and cows, in date order"""
+        return select_milk_records(self.frame(), start, end, workers, cows)
+
+    def export_chunks(self, frame, chunk_rows):
+        """Selected records with dates and timestamps formatted as text, chunk_rows at a time"""
+        for start in range(0, len(frame), chunk_rows):
+            yield self._export(frame.iloc[start:start + chunk_rows])
+
+    def append(self, record):
+        record = MilkRecord.from_dict(self._next_id, record)
+        self._next_id += 1
+        self._pending.append(record)
+        self._index_add(record.row_id, record.date, record.time, record.worker)
+        self.rollups.add_record(record)
+        self.version += 1
+
+    def extend(self, records):
+        for record in records:
+            self.append(record)
+
+    def missing_partitions(self, partitions):
+        """Which of the given partitions still have to be loaded"""
+        if self.partitions is None:
+            return []
+        return [partition for partition in partitions if partition not in self.partitions]
+
+    def add_partitions(self, frame, partitions=None):
+        """Add the records of newly loaded monthly partitions (None: all remaining history)"""
+        self._flush()
+        new = self._typed(frame.reset_index(drop=True))
+        new.index = pd.RangeIndex(self._next_id, self._next_id + len(new))
+        self._next_id += len(new)
+        self._concat(new)
+        self.rollups.add(new)
+        self._index_frame(new)
+        if partitions is None:
+            self.partitions = None
+        elif self.partitions is not None:
+            self.partitions.update(partitions)
+        if self.sync_marks is not None:
+            # Keep the older mark of a source both reads saw; rows read twice merge once
+            for source, mark in frame.attrs.get('sync_marks', {}).items():
+                self.sync_marks.setdefault(source, mark)
+        self.version += 1
+
+    def merge_changes(self, records, events):
+        """Merge records and change-log events saved elsewhere; returns how many records changed.
+
+        Records already held (same record_id) and records of months not
+        loaded are skipped. Events replace or remove the rows they apply to
+        as in fold_milk_events, so merging the same changes twice is harmless.
+        """
+        if self.partitions is not None:
+            records = records[milk_partition_keys(records['date']).isin(self.partitions)]
+            events = events[milk_partition_keys(events['date']).isin(self.partitions)]
+        changed = 0
+        if not records.empty:
+            held = self.frame()['record_id']
+            new = records[~records['record_id'].isin(held[held != ""].unique()) | (records['record_id'] == "")]
+            new = new[(new['record_id'] == "") | ~new['record_id'].duplicated()]
+            self.extend(new.to_dict('records'))
+            changed += len(new)
+        if events.empty:
+            return changed
+        last = last_milk_events(events)
+        frame = self.frame()
+        targets = frame[frame['record_id'].isin(last['record_id']) & (frame['record_id'] != "")]
+        rows_by_id = targets.groupby('record_id', observed=True).groups
+        for event in last.to_dict('records'):
+            if event['record_id']:
+                rows = self.records(rows_by_id.get(event['record_id'], []))
+                superseded = rows
+            else:
+                event_time = parse_datetimes(pd.Series([event['timestamp'] or None])).iloc[0]
+                row_ids = self.session_row_ids(event['date'], event['time'], event['worker'], int(event['cow_number']))
+                rows = self.records(row_ids)
+                superseded = [row for row in rows if not row.timestamp or pd.isna(event_time)
+                              or pd.Timestamp(row.timestamp) <= event_time]
+            if event['event'] == "delete":
+                if superseded:
+                    self.delete([row.row_id for row in superseded])
+                    changed += len(superseded)
+                continue
+            stale = [row for row in superseded
+                     if (row.milk_liters, row.notes, milk_entry_version(row.timestamp))
+                     != (float(event['milk_liters']), event['notes'], milk_entry_version(event['timestamp']))]
+            if stale:
+                self.update([row.row_id for row in stale], milk_liters=float(event['milk_liters']),
+                            notes=event['notes'], timestamp=event['timestamp'])
+                changed += len(stale)
+            elif not rows:
+                self.append({header: event[header] for header in MILK_DATA_HEADERS})
+                changed += 1
+        return changed
+
+    def session_row_ids(self, day, session, worker, cow_number=None):
+        """Row ids for one worker's session, optionally narrowed to one cow"""
+        row_ids = self._by_session.get((str(day), session, worker), set())
+        if cow_number is None:
+            return sorted(row_ids)
+        return [record.row_id for record in self.records(row_ids) if record.cow_number == cow_number]
+
+    def session_records(self, day, session, worker):
+        """MilkRecords for one worker's session, sorted by cow"""
+        return sorted(self.records(self.session_row_ids(day, session, worker)), key=lambda r: r.cow_number)
+
+    def date_frame(self, day):
+        """Typed frame of all records for one date"""
+        row_ids = sorted(self._by_date.get(str(day), ()))
+        return self.frame().loc[row_ids]
+
+    def row_ids_for(self, record_ids):
+        """Row ids of the records with the given record_ids"""
+        frame = self.frame()
+        return frame.index[frame['record_id'].isin(list(record_ids))].tolist()
+
+    def records(self, row_ids):
+        """MilkRecords for the given row ids, without flushing pending appends"""
+        row_ids = list(row_ids)
+        first_pending = self._pending[0].row_id if self._pending else self._next_id
+        pending = [self._pending[row_id - first_pending] for row_id in row_ids if row_id >= first_pending]
+        stored = [row_id for row_id in row_ids if row_id < first_pending]
+        if not stored:
+            return pending
+        frame = self._export(self._frame.loc[stored])
+        return [
+            MilkRecord(row_id, *values)
+            for row_id, *values in zip(frame.index.tolist(), *(frame[header].tolist() for header in MILK_DATA_HEADERS))
+        ] + pending
+
+    def update(self, row_ids, **values):
+        self._flush()
+        before = self._frame.loc[row_ids]
+        self.rollups.add(before, sign=-1)
+        self._index_frame(before, remove=True)
+        for column, value in values.items():
+            if column in ('date', 'timestamp'):
+                value = pd.Timestamp(value)
+            elif column in MILK_CATEGORY_COLUMNS and value not in self._frame[column].cat.categories:
+                self._frame[column] = self._frame[column].cat.add_categories([value])
+            self._frame.loc[row_ids, column] = value
+        after = self._frame.loc[row_ids]
+        self.rollups.add(after)
+        self._index_frame(after)
+        self.version += 1
+
+    def delete(self, row_ids):
+        self._flush()
+        removed = self._frame.loc[row_ids]
+        self.rollups.add(removed, sign=-1)
+        self._index_frame(removed, remove=True)
+        self._frame = self._frame.drop(index=row_ids)
+        self.version += 1
+
+    def clear(self):
+        self._frame = self._typed(pd.DataFrame(columns=MILK_DATA_HEADERS))
+        self._pending = []
+        self.rollups = ProductionRollups()
+        self._by_session = {}
+        self._by_date = {}
+        self.version += 1
+
+    def rollup_mismatches(self):
+        """Check the incremental rollups against a full recompute of the history"""
+        return self.rollups.mismatches(ProductionRollups.from_frame(self.frame()))
+
+    def range_rollups(self, start=None, end=None):
+        """Rollups of the records in a date range.
+
+        The maintained rollups when every loaded record falls in the range,
+        otherwise recomputed from the records in the range.
+        """
+        days = self.rollups.groups['day']
+        start = pd.Timestamp(start) if start is not None else None
+        end = pd.Timestamp(end) if end is not None else None
+        if all((start is None or day >= start) and (end is None or day <= end) for day in days):
+            return self.rollups
+        frame = self.frame()
+        mask = pd.Series(True, index=frame.index)
+        if start is not None:
+            mask &= frame['date'] >= start
+        if end is not None:
+            mask &= frame['date'] <= end
+        return ProductionRollups.from_frame(frame[mask])
+
+    def summary(self, start=None, end=None):
+        """Production Reports aggregates, optionally for a date range"""
+        return self.range_rollups(start, end).summary()
+
+    def rebuild_rollups(self):
+        self.rollups = ProductionRollups.from_frame(self.frame())
+
+class CowAssignments:
+    """Cow to worker assignments with a maintained worker to cows index"""
+
+    def __init__(self, assignments=None):
+        self._worker_by_cow = {}
+        self._cows_by_worker = {}
+        for cow, worker in (assignments or {}).items():
+            self[cow] = worker
+
+    def __setitem__(self, cow, worker):
+        self.unassign(cow)
+        self._worker_by_cow[cow] = worker
+        self._cows_by_worker.setdefault(worker, set()).add(cow)
+
+    def __getitem__(self, cow):
+        return self._worker_by_cow[cow]
+
+    def __contains__(self, cow):
+        return cow in self._worker_by_cow
+
+    def __len__(self):
+        return len(self._worker_by_cow)
+
+    def items(self):
+        return self._worker_by_cow.items()
+
+    def unassign(self, cow):
+        worker = self._worker_by_cow.pop(cow, None)
+        if worker is not None:
+            cows = self._cows_by_worker[worker]
+            cows.discard(cow)
+            if not cows:
+                del self._cows_by_worker[worker]
+
+    def cows_for(self, worker):
+        """Sorted cow numbers assigned to a worker"""
+        return sorted(self._cows_by_worker.get(worker, ()))
+
+    def by_worker(self):
+        """Worker -> set of assigned cows"""
+        return self._cows_by_worker
+
+    def remove_worker(self, worker):
+        for cow in self.cows_for(worker):
+            self.unassign(cow)
+
+    def remove_cows_above(self, total_cows):
+        for cow in [cow for cow in self._worker_by_cow if cow > total_cows]:
+            self.unassign(cow)
+
+@st.cache_resource
+def get_header_cache():
+    """Process-wide cache of worksheet header rows, shared by all sessions"""
+    return {}
+
+def get_worksheet_headers(worksheet):
+    """Return the cached header row of a worksheet, reading row 1 only on first use"""
+    cache = get_header_cache()
+    key = (worksheet.spreadsheet.id, worksheet.id)
+    if key not in cache:
+        cache[key] = worksheet.row_values(1)
+    return cache[key]
+
+def append_records_to_sheet(sheet, worksheet_name, default_headers, new_records):
+    """Append records to a worksheet in a single batched request, adding any missing header columns"""
+    worksheet = get_worksheet(sheet, worksheet_name)
+    if not new_records:
+        return
     try:
-        worksheet = get_worksheet(sheet, "milk_data")
-        if new_records:
-            headers = list(new_records[0].keys())
-            if not worksheet.get_all_records():
-                worksheet.append_row(headers)
-            for record in new_records:
-                row = [record.get(header, '') for header in headers]
-                worksheet.append_row(row)
-        return True
-    except Exception as e:
-        st.error(f"Failed to append milk data: {e}")
-        return False
+        headers = get_worksheet_headers(worksheet)
+        rows = []
+        if not headers:
+            # Empty sheet: write the header row in the same request as the data
+            headers = default_headers + [k for k in new_records[0].keys() if k not in default_headers]
+            rows.append(headers)
+        elif any(header not in headers for header in default_headers):
+            # Sheet created by an older version: add the new columns to the header row
+            headers = headers + [header for header in default_headers if header not in headers]
+            worksheet.update(range_name="A1", values=[headers])
+        for record in new_records:
+            rows.append([record.get(header, '') for header in headers])
+        # Insert rather than overwrite, in case blank rows were left inside the data
+        worksheet.append_rows(rows, insert_data_option="INSERT_ROWS")
+        get_header_cache()[(worksheet.spreadsheet.id, worksheet.id)] = headers
+    except Exception:
+        # Header state may be stale after a failure, re-read it next time
+        get_header_cache().pop((worksheet.spreadsheet.id, worksheet.id), None)
+        raise
+
+def group_by_partition(records):
+    """Partition key -> records dated in that month"""
+    groups = {}
+    for record in records:
+        groups.setdefault(milk_partition(record['date']), []).append(record)
+    return groups
+
+def append_milk_data_to_sheets(sheet, new_records):
+    """Append only new milk data to its monthly worksheets, one batched request per month, never clear a sheet.
+
+    Errors are raised rather than shown: the writes run on the write-behind
+    thread, which reports them to the sessions.
+    """
+    for partition, records in sorted(group_by_partition(new_records).items()):
+        append_records_to_sheet(sheet, milk_partition_sheet(partition), MILK_DATA_HEADERS, records)
+    return True
+
+def append_milk_events_to_sheets(sheet, events):
+    """Append edit and delete events to the milk_events change log; raises on failure"""
+    append_records_to_sheet(sheet, "milk_events", MILK_EVENT_HEADERS, events)
+    return True
+
+def existing_ids_in_sheet(sheet, worksheet_name, id_column, ids):
+    """Return which of the given ids are already in a worksheet's id column"""
+    worksheet = get_worksheet(sheet, worksheet_name)
+    headers = get_worksheet_headers(worksheet)
+    if id_column not in headers:
+        return set()
+    return set(worksheet.col_values(headers.index(id_column) + 1)) & set(ids)
+
+def existing_record_ids_in_sheets(sheet, records):
+    """Return the record_ids of records already in their monthly worksheet"""
+    available = set(milk_partitions_in_sheets(sheet))
+    found = set()
+    for partition, group in group_by_partition(records).items():
+        if partition in available:
+            found |= existing_ids_in_sheet(sheet, milk_partition_sheet(partition), "record_id",
+                                           [record['record_id'] for record in group])
+    return found
+
+def migrate_milk_data_to_partitions(sheet, chunk_size=5000):
+    """Split the single legacy milk_data worksheet into monthly partition worksheets.
+
+    Rows a partition already holds are skipped, so an interrupted run can
+    simply be repeated. The legacy worksheet is then renamed to
+    milk_data_migrated_<date> as a backup; rows that fail validation are only
+    left there. Returns the number of rows copied per partition.
+    """
+    if not has_legacy_milk_sheet(sheet):
+        return {}
+    client = get_sheets_client(sheet.id, sheet)
+    legacy, _ = parse_milk_frame(read_milk_values(client.worksheet(LEGACY_MILK_SHEET)))
+    legacy['partition'] = milk_partition_keys(legacy['date'])
+    partitions = sorted(legacy['partition'].unique())
+    available = set(milk_partitions_in_sheets(sheet))
+    existing = batch_read_worksheets(
+        sheet, [milk_partition_sheet(p) for p in partitions if p in available], **MILK_VALUE_RENDER
+    )
+
+    copied = {}
+    for partition, rows in legacy.groupby('partition', sort=True):
+        rows = rows.drop(columns='partition')
+        current, _ = parse_milk_frame(existing.get(milk_partition_sheet(partition), []))
+        if not current.empty:
+            merged = rows.merge(current[MILK_DATA_HEADERS].drop_duplicates(), on=MILK_DATA_HEADERS,
+                                how="left", indicator=True)
+            rows = rows[(merged['_merge'] == "left_only").to_numpy()]
+        records = rows.to_dict("records")
+        for start in range(0, len(records), chunk_size):
+            append_records_to_sheet(sheet, milk_partition_sheet(partition), MILK_DATA_HEADERS,
+                                    records[start:start + chunk_size])
+        copied[partition] = len(records)
+
+    client.worksheet(LEGACY_MILK_SHEET).update_title(f"{LEGACY_MILK_SHEET}_migrated_{date.today():%Y%m%d}")
+    client.forget_worksheet(LEGACY_MILK_SHEET)
+    return copied
+
+def compact_milk_data_in_sheets(sheet):
+    """Fold the milk_events log into the monthly milk_data worksheets and clear the consumed events.
+
+    Only the partitions the events touch are read, and in them only the
+    rows the events replace or remove are written: upserts overwrite the
+    rows they supersede, removed rows are blanked in place and any other
+    upserts are appended. Rows that fail validation are left as they are,
+    in the partitions and in the change log. A legacy milk_data worksheet
+    is migrated first. Returns the number of events folded in.
+    """
+    migrate_milk_data_to_partitions(sheet)
+    events_worksheet = get_worksheet(sheet, "milk_events")
+    events_values = read_milk_values(events_worksheet)
+    events, _ = parse_milk_frame(events_values)
+    if events.empty:
+        return 0
+    events_partition = milk_partition_keys(events['date'])
+    available = set(milk_partitions_in_sheets(sheet))
+    partitions = sorted(events_partition.unique())
+    bases = batch_read_worksheets(
+        sheet, [milk_partition_sheet(p) for p in partitions if p in available], **MILK_VALUE_RENDER
+    )
+    for partition in partitions:
+        name = milk_partition_sheet(partition)
+        values = bases.get(name, [])
+        base, _ = parse_milk_frame(values)
+        superseded, upserts = fold_milk_events(base, events[events_partition == partition])
+        fold_milk_rows(sheet, name, values, base, superseded, upserts)
+    # Blank only the events that were read and folded in, later appends are kept
+    width = max(len(row) for row in events_values)
+    events_worksheet.batch_clear([f"A{first + 2}:{gspread.utils.rowcol_to_a1(last + 2, width)}"
+                                  for first, last in contiguous_runs(events.index)])
+    return len(events)
+
+def fold_milk_rows(sheet, name, values, base, superseded, upserts):
+    """Write the result of fold_milk_events to one milk worksheet, touching only the rows it changes.
+
+    values are the raw worksheet values base was parsed from; base's index
+    is the position of each row below the header. An upsert overwrites the
+    row of the record it replaces, or failing that another superseded row;
+    superseded rows left over are blanked and upserts left over appended.
+    """
+    worksheet = get_worksheet(sheet, name)
+    headers = [str(header) for header in values[0]] if values else []
+    headers += [header for header in MILK_DATA_HEADERS if header not in headers]
+    freed = [position + 1 for position in base.index[superseded]]
+    row_of = {record_id: position + 1 for record_id, position
+              in zip(base['record_id'][superseded], base.index[superseded]) if record_id}
+
+    placed, unplaced = {}, []
+    for record in upserts.fillna("").to_dict('records'):
+        position = row_of.pop(record['record_id'], None) if record['record_id'] else None
+        if position is None:
+            unplaced.append(record)
+        else:
+            placed[position] = record
+    spare = [position for position in freed if position not in placed]
+    placed.update(zip(spare, unplaced))
+    appended = unplaced[len(spare):]
+
+    layout = [headers] + [list(row) for row in values[1:]]
+    for position in freed:
+        record = placed.get(position)
+        layout[position] = [] if record is None else [record.get(header, "") for header in headers]
+
+    write_changed_rows(worksheet, [_normalize_row(row) for row in values], layout)
+    get_header_cache()[(worksheet.spreadsheet.id, worksheet.id)] = headers
+    if appended:
+        append_records_to_sheet(sheet, name, MILK_DATA_HEADERS, appended)
+
+def save_milk_event(event, record, **changes):
+    """Queue an upsert or delete of a record for the milk_events change log.
+
+    The event is based on the record as this session last saw it; if the
+    record was changed elsewhere since, the event is reported as a conflict.
+    """
+    entry = record.to_dict()
+    entry['timestamp'] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    entry.update(changes)
+    entry['event'] = event
+    entry['event_id'] = uuid.uuid4().hex
+    return get_session_write_queue().submit(st.session_state.session_id, [entry], kind='event', bases=[record.timestamp])
 
 def auto_save_milk_data():
-    if st.session_state.gsheets_conn and st.session_state.unsaved_milk_data:
-        success = append_milk_data_to_sheets(st.session_state.gsheets_conn, st.session_state.unsaved_milk_data)
+    """Hand unsaved records to the background write queue"""
+    if st.session_state.unsaved_milk_data:
+        success = get_session_write_queue().submit(st.session_state.session_id, st.session_state.unsaved_milk_data)
         if success:
             st.session_state.unsaved_milk_data = []
         return success
     return False
 
-def load_system_config_from_sheets(sheet):
+def load_system_config_from_sheets(sheet, values=None):
     """Load system config from Google Sheets"""
     try:
         worksheet = get_worksheet(sheet, "system_config")
-        data = worksheet.get_all_records()
+        data = read_sheet_records(worksheet, values)
         
         if not data:
             # Initialize with default config
-            worksheet.clear()
-            worksheet.append_row(["total_cows", "last_updated"])
-            worksheet.append_row([50, datetime.now().isoformat()])
+            sync_rows_to_sheet(worksheet, [["total_cows", "last_updated"], [50, datetime.now().isoformat()]], key=0)
             return 50
         
-        return int(data[0].get('total_cows', 50))
+        return int(data[0].get('total_cows') or 50)
     except Exception as e:
         st.error(f"Error loading system config: {e}")
         return 50
 
 def save_system_config_to_sheets(sheet, total_cows):
-    """Save system config to Google Sheets"""
+    """Save system config to Google Sheets; returns the herd size saved, or None when the save failed"""
     try:
         worksheet = get_worksheet(sheet, "system_config")
-        worksheet.clear()
-        worksheet.append_row(["total_cows", "last_updated"])
-        worksheet.append_row([total_cows, datetime.now().isoformat()])
-        return True
+        sync_rows_to_sheet(worksheet, [["total_cows", "last_updated"], [total_cows, datetime.now().isoformat()]], key=0)
+        return total_cows
     except Exception as e:
         st.error(f"Failed to save system config: {e}")
+        return None
+
+# Storage backends
+def get_app_setting(section, key, default=None):
+    """Read an optional setting from st.secrets, falling back to a default"""
+    try:
+        return st.secrets[section][key]
+    except Exception:
+        return default
+
+# Farms served by this deployment
+class Farm:
+    """One farm: its spreadsheet, local database and resource limits.
+
+    Each farm's data stays in its own spreadsheet or database file, so the
+    per-storage caches, write queues and archives are partitioned by farm.
+    The limits keep one large farm from starving the others: its share of
+    the Sheets quota, and how many of the shared loader threads its
+    sessions may occupy at once.
+    """
+
+    def __init__(self, farm_id, name, spreadsheet_id=None, sqlite_path="dairy_farm.db",
+                 read_per_minute=60, write_per_minute=60, max_concurrent_loads=4, supervisor_password=None):
+        self.farm_id = farm_id
+        self.name = name
+        self.spreadsheet_id = spreadsheet_id
+        self.sqlite_path = sqlite_path
+        self.read_per_minute = read_per_minute
+        self.write_per_minute = write_per_minute
+        self.load_slots = threading.BoundedSemaphore(max(1, max_concurrent_loads))
+        self.supervisor_password = None if supervisor_password is None else str(supervisor_password)
+
+    def supervisor_password_matches(self, password):
+        """Whether password is this farm's supervisor password; never true when the farm has none"""
+        if not self.supervisor_password or not password:
+            return False
+        return hmac.compare_digest(str(password).encode(), self.supervisor_password.encode())
+
+@st.cache_resource
+def get_farms():
+    """Farms configured as [farms.<id>] sections in st.secrets, or one default farm.
+
+    Each section may set name, spreadsheet, sqlite_path, supervisor_password,
+    read_requests_per_minute, write_requests_per_minute and
+    max_concurrent_loads. Unset quota limits split the [sheets] quota evenly.
+    A farm without a supervisor_password has no supervisor access. The
+    single default farm uses [supervisor] password, and likewise has no
+    supervisor access when that is not set.
+    """
+    read_per_minute = float(get_app_setting("sheets", "read_requests_per_minute", 60))
+    write_per_minute = float(get_app_setting("sheets", "write_requests_per_minute", 60))
+    try:
+        configured = {str(farm_id): dict(section) for farm_id, section in st.secrets["farms"].items()}
+    except Exception:
+        configured = {}
+    if not configured:
+        try:
+            spreadsheet_id = st.secrets["connections"]["gsheet"]["spreadsheet"]
+        except Exception:
+            spreadsheet_id = None
+        farm = Farm("default", "Dairy Farm", spreadsheet_id,
+                    get_app_setting("storage", "sqlite_path", "dairy_farm.db"),
+                    read_per_minute, write_per_minute, LOADER_THREADS,
+                    get_app_setting("supervisor", "password"))
+        return {farm.farm_id: farm}
+
+    share = len(configured)
+    return {
+        farm_id: Farm(
+            farm_id,
+            section.get("name", farm_id),
+            section.get("spreadsheet"),
+            section.get("sqlite_path", f"dairy_farm_{farm_id}.db"),
+            float(section.get("read_requests_per_minute", read_per_minute / share)),
+            float(section.get("write_requests_per_minute", write_per_minute / share)),
+            int(section.get("max_concurrent_loads", max(1, LOADER_THREADS // 2))),
+            section.get("supervisor_password"),
+        )
+        for farm_id, section in configured.items()
+    }
+
+def current_farm():
+    """The farm this session works on"""
+    return get_farms()[st.session_state.farm_id]
+
+class StorageBackend(abc.ABC):
+    """Interface for where farm data is persisted"""
+    name = "storage"
+    is_local = False
+    cache_key = None
+
+    @abc.abstractmethod
+    def load_workers(self):
+        """Worker names in display order"""
+
+    @abc.abstractmethod
+    def save_workers(self, workers):
+        """Save the worker list; returns the workers as stored, or None when the save failed"""
+
+    @abc.abstractmethod
+    def load_cow_assignments(self):
+        """Cow number -> worker name"""
+
+    @abc.abstractmethod
+    def save_cow_assignments(self, assignments):
+        """Save the cow assignments; returns them as stored, or None when the save failed"""
+
+    def prefetch(self, tables):
+        """Fetch several reference tables ahead of their load calls, where the backend can batch them"""
+
+    def discard_prefetched(self):
+        """Drop prefetched tables that were not loaded, so later loads read fresh data"""
+
+    @abc.abstractmethod
+    def milk_partitions(self):
+        """Keys ("2026_10") of the months that have milk records, oldest first"""
+
+    @abc.abstractmethod
+    def fetch_milk_data(self, partitions=None):
+        """Return (milk records of the given monthly partitions or all, rejected row counts).
+
+        Raises instead of reporting errors, so it is safe to call from a background thread.
+        """
+
+    def load_milk_data(self):
+        """Return all milk records as a DataFrame"""
+        return self.fetch_milk_data()[0]
+
+    @abc.abstractmethod
+    def fetch_milk_changes(self, marks, partitions=None):
+        """Milk records and change-log events saved since the sync marks fetch_milk_data left in frame.attrs.
+
+        Returns (records, events, new marks), or None when the data was
+        rewritten since and has to be loaded again. Rows already loaded may
+        come back; merging them is idempotent.
+        """
+
+    @abc.abstractmethod
+    def milk_month_versions(self, months):
+        """Month -> a cheap version of its stored records that changes when they do; raises on failure"""
+
+    def milk_entries_for_dates(self, days):
+        """Milk records of some dates with the change log applied; raises like fetch_milk_data"""
+        days = [str(day) for day in days]
+        frame, _ = self.fetch_milk_data(sorted({milk_partition(day) for day in days}))
+        return frame[frame['date'].astype(str).isin(days)]
+
+    @abc.abstractmethod
+    def append_milk_data(self, records):
+        """Append new milk records; raises on failure, as it runs off the script thread"""
+
+    @abc.abstractmethod
+    def existing_record_ids(self, records):
+        """record_ids of the given records that have already been written"""
+
+    @abc.abstractmethod
+    def append_milk_events(self, events):
+        """Append upsert/delete events to the change log; raises on failure"""
+
+    @abc.abstractmethod
+    def existing_event_ids(self, events):
+        """event_ids of the given events that have already been written"""
+
+    @abc.abstractmethod
+    def compact_milk_data(self):
+        """Fold the change log into the base milk data and clear it; returns the events folded"""
+
+    @abc.abstractmethod
+    def load_total_cows(self):
+        """Herd size from the system config"""
+
+    @abc.abstractmethod
+    def save_total_cows(self, total_cows):
+        """Save the herd size; returns it as stored, or None when the save failed"""
+
+class GoogleSheetsBackend(StorageBackend):
+    """Persist farm data in a Google Spreadsheet through gspread"""
+    name = "Google Sheets"
+
+    def __init__(self, sheet):
+        self.sheet = sheet
+        self.cache_key = ("sheets", sheet.id)
+        # Worksheet values from prefetch(), each used by the next load of that table
+        self.prefetched = {}
+
+    def prefetch(self, tables):
+        try:
+            self.prefetched.update(batch_read_worksheets(self.sheet, list(tables)))
+        except Exception:
+            # The per-table loads fetch and report on their own
+            self.prefetched.clear()
+
+    def discard_prefetched(self):
+        self.prefetched.clear()
+
+    def load_workers(self):
+        return load_workers_from_sheets(self.sheet, self.prefetched.pop("workers", None))
+
+    def save_workers(self, workers):
+        return save_workers_to_sheets(self.sheet, workers)
+
+    def load_cow_assignments(self):
+        return load_cow_assignments_from_sheets(self.sheet, self.prefetched.pop("cow_assignments", None))
+
+    def save_cow_assignments(self, assignments):
+        return save_cow_assignments_to_sheets(self.sheet, assignments)
+
+    def load_milk_data(self):
+        return load_milk_data_from_sheets(self.sheet)
+
+    def milk_partitions(self):
+        return milk_partitions_in_sheets(self.sheet)
+
+    def fetch_milk_data(self, partitions=None):
+        return fetch_milk_data_from_sheets(self.sheet, partitions)
+
+    def fetch_milk_changes(self, marks, partitions=None):
+        return fetch_milk_changes_from_sheets(self.sheet, marks, partitions)
+
+    def milk_month_versions(self, months):
+        return milk_month_versions_in_sheets(self.sheet, months)
+
+    def append_milk_data(self, records):
+        return append_milk_data_to_sheets(self.sheet, records)
+
+    def existing_record_ids(self, records):
+        return existing_record_ids_in_sheets(self.sheet, records)
+
+    def append_milk_events(self, events):
+        return append_milk_events_to_sheets(self.sheet, events)
+
+    def existing_event_ids(self, events):
+        return existing_ids_in_sheet(self.sheet, "milk_events", "event_id", [event['event_id'] for event in events])
+
+    def compact_milk_data(self):
+        return compact_milk_data_in_sheets(self.sheet)
+
+    def load_total_cows(self):
+        return load_system_config_from_sheets(self.sheet, self.prefetched.pop("system_config", None))
+
+    def save_total_cows(self, total_cows):
+        return save_system_config_to_sheets(self.sheet, total_cows)
+
+class SQLiteBackend(StorageBackend):
+    """Persist farm data in a local SQLite database so the app can run offline"""
+    name = "SQLite"
+    is_local = True
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS workers (
+            position INTEGER PRIMARY KEY,
+            name TEXT NOT NULL UNIQUE
+        );
+        CREATE TABLE IF NOT EXISTS cow_assignments (
+            cow_number INTEGER PRIMARY KEY,
+            worker_name TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS milk_data (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            date TEXT NOT NULL,
+            time TEXT NOT NULL,
+            cow_number INTEGER NOT NULL,
+            milk_liters REAL NOT NULL,
+            worker TEXT NOT NULL,
+            notes TEXT DEFAULT '',
+            timestamp TEXT,
+            record_id TEXT
+        );
+        CREATE INDEX IF NOT EXISTS idx_milk_date_time_worker ON milk_data (date, time, worker);
+        CREATE INDEX IF NOT EXISTS idx_milk_cow ON milk_data (cow_number);
+        CREATE TABLE IF NOT EXISTS milk_events (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            event TEXT NOT NULL,
+            event_id TEXT UNIQUE,
+            date TEXT NOT NULL,
+            time TEXT NOT NULL,
+            cow_number INTEGER NOT NULL,
+            milk_liters REAL NOT NULL,
+            worker TEXT NOT NULL,
+            notes TEXT DEFAULT '',
+            timestamp TEXT,
+            record_id TEXT
+        );
+        CREATE TABLE IF NOT EXISTS system_config (
+            key TEXT PRIMARY KEY,
+            value TEXT
+        );
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.cache_key = ("sqlite", path)
+        # One connection shared by all sessions, serialized by a lock
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.row_factory = sqlite3.Row
+        self.lock = threading.Lock()
+        with self.lock, self.conn:
+            self.conn.executescript(self.SCHEMA)
+            # Databases created before record ids existed
+            columns = [row['name'] for row in self.conn.execute("PRAGMA table_info(milk_data)")]
+            if "record_id" not in columns:
+                self.conn.execute("ALTER TABLE milk_data ADD COLUMN record_id TEXT")
+            self.conn.execute(
+                "CREATE UNIQUE INDEX IF NOT EXISTS idx_milk_record_id ON milk_data (record_id) WHERE record_id <> ''"
+            )
+
+    def _query(self, sql, params=()):
+        with self.lock:
+            return self.conn.execute(sql, params).fetchall()
+
+    def _execute(self, statements):
+        """Run (sql, params) pairs in one transaction; raises on failure"""
+        with self.lock, self.conn:
+            for sql, params in statements:
+                if isinstance(params, list):
+                    self.conn.executemany(sql, params)
+                else:
+                    self.conn.execute(sql, params)
+        return True
+
+    def _write(self, statements):
+        """Run (sql, params) pairs in one transaction, showing any error"""
+        try:
+            return self._execute(statements)
+        except sqlite3.Error as e:
+            st.error(f"Failed to write to local database: {e}")
+            return False
+
+    def load_workers(self):
+        rows = self._query("SELECT name FROM workers ORDER BY position")
+        if not rows:
+            self.save_workers(DEFAULT_WORKERS)
+            return list(DEFAULT_WORKERS)
+        return [row['name'] for row in rows]
+
+    def save_workers(self, workers):
+        if self._write([
+            ("DELETE FROM workers", ()),
+            ("INSERT INTO workers (position, name) VALUES (?, ?)", list(enumerate(workers))),
+        ]):
+            return list(workers)
+        return None
+
+    def load_cow_assignments(self):
+        rows = self._query("SELECT cow_number, worker_name FROM cow_assignments ORDER BY rowid")
+        return {row['cow_number']: row['worker_name'] for row in rows}
+
+    def save_cow_assignments(self, assignments):
+        if self._write([
+            ("DELETE FROM cow_assignments", ()),
+            ("INSERT INTO cow_assignments (cow_number, worker_name) VALUES (?, ?)", list(assignments.items())),
+        ]):
+            return dict(assignments.items())
+        return None
+
+    def milk_partitions(self):
+        rows = self._query("SELECT DISTINCT substr(date, 1, 7) AS month FROM milk_data ORDER BY month")
+        return [row['month'].replace("-", "_") for row in rows]
+
+    def fetch_milk_data(self, partitions=None):
+        where, params = "", []
+        if partitions is not None:
+            params = [partition.replace("_", "-") for partition in partitions]
+            where = f"WHERE substr(date, 1, 7) IN ({', '.join('?' * len(params))})"
+        with self.lock:
+            marks = self._sync_marks()
+            base = pd.read_sql_query(
+                f"SELECT {', '.join(MILK_DATA_HEADERS)} FROM milk_data {where} ORDER BY id", self.conn, params=params
+            )
+            events = pd.read_sql_query(
+                f"SELECT {', '.join(MILK_EVENT_HEADERS)} FROM milk_events {where} ORDER BY id", self.conn, params=params
+            )
+        frame = materialize_milk_events(base.fillna(""), events.fillna(""))
+        frame.attrs['sync_marks'] = marks
+        return frame, {}
+
+    def _sync_marks(self):
+        """Last row ids of the milk tables and how often they were compacted; call with the lock held"""
+        marks = {
+            table: self.conn.execute(f"SELECT COALESCE(MAX(id), 0) FROM {table}").fetchone()[0]
+            for table in ("milk_data", "milk_events")
+        }
+        row = self.conn.execute("SELECT value FROM system_config WHERE key = 'milk_compactions'").fetchone()
+        marks['compactions'] = int(row[0]) if row else 0
+        return marks
+
+    def milk_month_versions(self, months):
+        params = [month.replace("_", "-") for month in months]
+        where = f"WHERE substr(date, 1, 7) IN ({', '.join('?' * len(params))})"
+        # A checksum of each month's rows that survives compaction renumbering them, plus its pending events
+        with self.lock:
+            data = {row[0]: tuple(row[1:]) for row in self.conn.execute(
+                f"SELECT substr(date, 1, 7), COUNT(*), ROUND(TOTAL(milk_liters), 3), ROUND(TOTAL(cow_number * milk_liters), 3) "
+                f"FROM milk_data {where} GROUP BY 1", params)}
+            events = {row[0]: tuple(row[1:]) for row in self.conn.execute(
+                f"SELECT substr(date, 1, 7), COUNT(*), MAX(id) FROM milk_events {where} GROUP BY 1", params)}
+        return {month: milk_month_version(data.get(key), events.get(key)) for month, key in zip(months, params)}
+
+    def fetch_milk_changes(self, marks, partitions=None):
+        with self.lock:
+            new_marks = self._sync_marks()
+            if new_marks['compactions'] != marks['compactions']:
+                # Compaction rewrote milk_data under new ids
+                return None
+            records = pd.read_sql_query(
+                f"SELECT {', '.join(MILK_DATA_HEADERS)} FROM milk_data WHERE id > ? ORDER BY id", self.conn,
+                params=(marks['milk_data'],)
+            )
+            events = pd.read_sql_query(
+                f"SELECT {', '.join(MILK_EVENT_HEADERS)} FROM milk_events WHERE id > ? ORDER BY id", self.conn,
+                params=(marks['milk_events'],)
+            )
+        return records.fillna(""), events.fillna(""), new_marks
+
+    def milk_entries_for_dates(self, days):
+        params = [str(day) for day in days]
+        where = f"WHERE date IN ({', '.join('?' * len(params))})"
+        with self.lock:
+            base = pd.read_sql_query(
+                f"SELECT {', '.join(MILK_DATA_HEADERS)} FROM milk_data {where} ORDER BY id", self.conn, params=params
+            )
+            events = pd.read_sql_query(
+                f"SELECT {', '.join(MILK_EVENT_HEADERS)} FROM milk_events {where} ORDER BY id", self.conn, params=params
+            )
+        return materialize_milk_events(base.fillna(""), events.fillna(""))
+
+    def append_milk_data(self, records):
+        rows = [tuple(record.get(header, '') for header in MILK_DATA_HEADERS) for record in records]
+        # Records already written (same record_id) are skipped
+        return self._execute([
+            (f"INSERT OR IGNORE INTO milk_data ({', '.join(MILK_DATA_HEADERS)}) VALUES ({', '.join('?' * len(MILK_DATA_HEADERS))})", rows),
+        ])
+
+    def _existing_ids(self, table, column, ids):
+        ids = list(ids)
+        found = set()
+        for start in range(0, len(ids), 500):
+            chunk = ids[start:start + 500]
+            rows = self._query(f"SELECT {column} FROM {table} WHERE {column} IN ({', '.join('?' * len(chunk))})", chunk)
+            found.update(row[column] for row in rows)
+        return found
+
+    def existing_record_ids(self, records):
+        return self._existing_ids("milk_data", "record_id", [record['record_id'] for record in records])
+
+    def append_milk_events(self, events):
+        rows = [tuple(event.get(header, '') for header in MILK_EVENT_HEADERS) for event in events]
+        return self._execute([
+            (f"INSERT OR IGNORE INTO milk_events ({', '.join(MILK_EVENT_HEADERS)}) VALUES ({', '.join('?' * len(MILK_EVENT_HEADERS))})", rows),
+        ])
+
+    def existing_event_ids(self, events):
+        return self._existing_ids("milk_events", "event_id", [event['event_id'] for event in events])
+
+    def compact_milk_data(self):
+        with self.lock, self.conn:
+            # Take the write lock before reading, so records and events other
+            # connections save meanwhile wait instead of being deleted unread
+            self.conn.execute("BEGIN IMMEDIATE")
+            base = pd.read_sql_query(f"SELECT {', '.join(MILK_DATA_HEADERS)} FROM milk_data ORDER BY id", self.conn)
+            events = pd.read_sql_query(f"SELECT {', '.join(MILK_EVENT_HEADERS)} FROM milk_events ORDER BY id", self.conn)
+            if events.empty:
+                return 0
+            merged = materialize_milk_events(base.fillna(""), events.fillna(""))
+            self.conn.execute("DELETE FROM milk_data")
+            self.conn.executemany(
+                f"INSERT INTO milk_data ({', '.join(MILK_DATA_HEADERS)}) VALUES ({', '.join('?' * len(MILK_DATA_HEADERS))})",
+                merged[MILK_DATA_HEADERS].values.tolist(),
+            )
+            self.conn.execute("DELETE FROM milk_events")
+            self.conn.execute(
+                "INSERT INTO system_config (key, value) VALUES ('milk_compactions', '1') "
+                "ON CONFLICT (key) DO UPDATE SET value = CAST(value AS INTEGER) + 1"
+            )
+        return len(events)
+
+    def load_total_cows(self):
+        rows = self._query("SELECT value FROM system_config WHERE key = 'total_cows'")
+        if not rows:
+            self.save_total_cows(50)
+            return 50
+        return int(rows[0]['value'])
+
+    def save_total_cows(self, total_cows):
+        if self._write([
+            ("INSERT OR REPLACE INTO system_config (key, value) VALUES ('total_cows', ?)", (str(total_cows),)),
+            ("INSERT OR REPLACE INTO system_config (key, value) VALUES ('last_updated', ?)", (datetime.now().isoformat(),)),
+        ]):
+            return total_cows
+        return None
+
+@st.cache_resource
+def get_sqlite_backend(path):
+    """One SQLite backend per database file, shared by all sessions"""
+    return SQLiteBackend(path)
+
+def create_storage_backend(sheet, farm):
+    """Pick the farm's storage backend: Google Sheets when connected, otherwise its local SQLite database"""
+    backend = get_app_setting("storage", "backend", "sheets" if sheet else "sqlite")
+    if backend == "sheets" and sheet:
+        return GoogleSheetsBackend(sheet)
+    path = farm.sqlite_path
+    try:
+        return get_sqlite_backend(path)
+    except sqlite3.Error as e:
+        st.error(f"Could not open local database {path}: {e}")
+        return get_sqlite_backend(":memory:")
+
+# Shared reference data cache
+class ReferenceCache:
+    """Process-wide read-through cache for the small reference tables.
+
+    Entries are keyed by storage backend and table. Every load or write
+    gets a new version number, so sessions can tell when their private copy
+    is stale. Entries expire after a TTL; a save writes the stored value
+    through with put(), so the saving session does not read it back.
+    """
+
+    def __init__(self, ttl_seconds):
+        self.ttl_seconds = ttl_seconds
+        self.entries = {}
+        self.next_version = 1
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        # Per key, held while loading so concurrent sessions wait for one fetch instead of each fetching
+        self.load_locks = {}
+
+    def _fresh_entry(self, key):
+        entry = self.entries.get(key)
+        if entry and time.monotonic() - entry['loaded_at'] < self.ttl_seconds:
+            return entry
+        return None
+
+    def version(self, storage, table):
+        """Version of the cached table, or None when it must be reloaded"""
+        with self.lock:
+            entry = self._fresh_entry((storage.cache_key, table))
+            return entry['version'] if entry else None
+
+    def _store(self, key, value):
+        """Cache a value under a new version; call with the lock held"""
+        entry = {'value': value, 'version': self.next_version, 'loaded_at': time.monotonic()}
+        self.next_version += 1
+        self.entries[key] = entry
+        return entry
+
+    def get(self, storage, table, loader):
+        """Return (private copy of the table, version), loading it on a miss"""
+        key = (storage.cache_key, table)
+        with self.lock:
+            entry = self._fresh_entry(key)
+            if entry:
+                self.hits += 1
+                return copy.deepcopy(entry['value']), entry['version']
+            load_lock = self.load_locks.setdefault(key, threading.Lock())
+        with load_lock:
+            # Another session may have loaded it while we waited
+            with self.lock:
+                entry = self._fresh_entry(key)
+            if not entry:
+                value = loader()
+                with self.lock:
+                    self.misses += 1
+                    entry = self._store(key, value)
+            else:
+                with self.lock:
+                    self.hits += 1
+        return copy.deepcopy(entry['value']), entry['version']
+
+    def put(self, storage, table, value):
+        """Cache the value a session just saved; returns (private copy, version)"""
+        with self.lock:
+            entry = self._store((storage.cache_key, table), copy.deepcopy(value))
+        return copy.deepcopy(entry['value']), entry['version']
+
+    def invalidate(self, storage, table):
+        with self.lock:
+            self.entries.pop((storage.cache_key, table), None)
+
+# Reference tables, named after their worksheets
+REFERENCE_TABLES = ["workers", "cow_assignments", "system_config"]
+
+@st.cache_resource
+def get_reference_cache():
+    """One reference cache per server process, shared by all sessions"""
+    return ReferenceCache(float(get_app_setting("cache", "reference_ttl_seconds", 300)))
+
+# Background write queue
+def milk_entry_key(record):
+    """Slot a record fills: (date, session, cow); at most one record may hold it"""
+    return (str(record['date']), str(record['time']), int(record['cow_number']))
+
+def milk_entry_version(timestamp):
+    """Optimistic version of a record: its timestamp, which every edit changes, in one canonical format"""
+    if not timestamp:
+        return ""
+    try:
+        return pd.Timestamp(timestamp).strftime("%Y-%m-%d %H:%M:%S")
+    except ValueError:
+        return str(timestamp)
+
+class MilkEntryLedger:
+    """Which record holds each (date, session, cow) slot, so saving is idempotent and conflicts are caught.
+
+    A slot's holder is a record_id with a version (the record's timestamp).
+    New records claim free slots; a record whose own id already holds its
+    slot is a duplicate (a retried save), and one whose slot another record
+    holds is a conflict. Edits and deletes carry the version they were
+    based on and are conflicts when the slot has moved on since.
+
+    Slots are read from storage a day at a time and re-read after
+    ttl_seconds, so records written by other processes are seen. Claims
+    accepted here but not yet written shadow the stored slots until the
+    write lands. verify() reads the days of a batch again right before it
+    is written.
+
+    The ledger is per process, and the storage check and the append that
+    follows it are two requests, not one atomic write. Two processes that
+    write the same slot within that gap can therefore both save it, and the
+    slot then has two records until one of them is deleted.
+    """
+
+    def __init__(self, storage, ttl_seconds=120):
+        self.storage = storage
+        self.ttl_seconds = ttl_seconds
+        self.lock = threading.Lock()
+        self.days = {}
+        # Slot key -> holder (None once deleted) for accepted items not yet written
+        self.claims = {}
+
+    @staticmethod
+    def _holder(record):
+        return {'record_id': record.get('record_id', ""), 'version': milk_entry_version(record.get('timestamp')),
+                'worker': record['worker'], 'milk_liters': float(record['milk_liters'])}
+
+    def _read_days(self, days):
+        """Stored slots of some days, read from storage now: day -> (read at, slots)"""
+        frame = self.storage.milk_entries_for_dates(days)
+        read = {day: (time.monotonic(), {}) for day in days}
+        for record in frame.to_dict('records'):
+            key = milk_entry_key(record)
+            read[key[0]][1][key] = self._holder(record)
+        return read
+
+    def _stored_day(self, day):
+        """Stored slots of a day, read again when they are older than the ttl"""
+        loaded = self.days.get(day)
+        if loaded is None or time.monotonic() - loaded[0] > self.ttl_seconds:
+            loaded = self.days[day] = self._read_days([day])[day]
+        return loaded[1]
+
+    def _stored(self, key):
+        return self._stored_day(key[0]).get(key)
+
+    def _current(self, key):
+        return self.claims[key] if key in self.claims else self._stored(key)
+
+    def _apply(self, entry):
+        """Holder of the entry's slot once the entry is applied"""
+        record = entry['record']
+        return None if record.get('event') == "delete" else self._holder(record)
+
+    def admit(self, entries):
+        """Claim the slots of queue entries; returns (accepted, duplicates, conflicts).
+
+        Each conflict is (entry, holder) with the holder that blocked it, None when the slot is empty.
+        """
+        accepted, duplicates, conflicts = [], [], []
+        with self.lock:
+            for entry in entries:
+                record = entry['record']
+                key = milk_entry_key(record)
+                holder = self._current(key)
+                if entry.get('kind', 'record') == 'record':
+                    if holder is None:
+                        accepted.append(entry)
+                    elif holder['record_id'] == record.get('record_id', ""):
+                        duplicates.append(entry)
+                        continue
+                    else:
+                        conflicts.append((entry, holder))
+                        continue
+                elif holder is None or holder['record_id'] != record.get('record_id', "") or holder['version'] != entry.get('base'):
+                    conflicts.append((entry, holder))
+                    continue
+                else:
+                    accepted.append(entry)
+                self.claims[key] = self._apply(entry)
+        return accepted, duplicates, conflicts
+
+    def session_holders(self, day, session):
+        """Cow -> holder of every filled slot of one session"""
+        day = str(day)
+        with self.lock:
+            holders = {key[2]: holder for key, holder in self._stored_day(day).items() if key[1] == session}
+            for key, holder in self.claims.items():
+                if key[0] == day and key[1] == session:
+                    if holder is None:
+                        holders.pop(key[2], None)
+                    else:
+                        holders[key[2]] = holder
+            return holders
+
+    def restore(self, entries):
+        """Claim the slots of entries accepted before a restart and not written yet"""
+        with self.lock:
+            for entry in entries:
+                self.claims[milk_entry_key(entry['record'])] = self._apply(entry)
+
+    def release(self, entries):
+        """Drop the claims of entries that will not be written"""
+        with self.lock:
+            for entry in entries:
+                self.claims.pop(milk_entry_key(entry['record']), None)
+
+    def verify(self, entries):
+        """Split new records about to be written into (to write, already written, conflicts) by what storage holds.
+
+        The batch's days are read from storage again, however recently they were read.
+        """
+        fresh, written, conflicts = [], [], []
+        read = self._read_days(sorted({milk_entry_key(entry['record'])[0] for entry in entries}))
+        with self.lock:
+            self.days.update(read)
+            for entry in entries:
+                holder = self._stored(milk_entry_key(entry['record']))
+                if holder is None:
+                    fresh.append(entry)
+                elif holder['record_id'] == entry['record'].get('record_id', ""):
+                    written.append(entry)
+                else:
+                    conflicts.append((entry, holder))
+        return fresh, written, conflicts
+
+    def written(self, entries):
+        """Move the claims of entries that were written into the stored slots"""
+        with self.lock:
+            for entry in entries:
+                key = milk_entry_key(entry['record'])
+                loaded = self.days.get(key[0])
+                if loaded is not None:
+                    holder = self._apply(entry)
+                    if holder is None:
+                        loaded[1].pop(key, None)
+                    else:
+                        loaded[1][key] = holder
+                if key in self.claims and self.claims[key] == self._apply(entry):
+                    del self.claims[key]
+
+class WriteBehindQueue:
+    """Process-level queue that saves milk records and edit events in the background.
+
+    Submitted items are first appended to an on-disk journal (JSON lines),
+    so they survive a restart. A flusher thread coalesces the items of all
+    sessions into batched writes to the storage backend and retries failed
+    writes with exponential backoff. Items left in the journal by a previous
+    run are replayed on start, skipping any whose id is already stored.
+    Once enough events have been written the change log is compacted.
+
+    Every item passes a MilkEntryLedger on submit and new records again
+    just before they are written, so a retried save is written once and a
+    cow logged twice for the same session keeps only the first record. The
+    items turned away are reported to their session as conflicts.
+    """
+
+    # kind -> (storage method that writes the items, method that finds stored ids, id field, what to call them)
+    WRITERS = {
+        'record': ("append_milk_data", "existing_record_ids", "record_id", "milk records"),
+        'event': ("append_milk_events", "existing_event_ids", "event_id", "record changes"),
+    }
+
+    def __init__(self, storage, journal_path, coalesce_seconds=0.5, max_batch=500,
+                 base_delay=2.0, max_delay=300.0, compact_after_events=500, ledger_ttl_seconds=120,
+                 lock_path=None):
+        self.storage = storage
+        self.ledger = MilkEntryLedger(storage, ledger_ttl_seconds)
+        self.journal_path = journal_path
+        self.coalesce_seconds = coalesce_seconds
+        self.max_batch = max_batch
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.compact_after_events = compact_after_events
+        self.events_since_compaction = 0
+        self.cond = threading.Condition()
+        # Held while writing to storage, so compaction never races a flush; the
+        # StorageWriteLock extends that to farm jobs compacting from another process
+        self.write_lock = threading.Lock()
+        self.storage_lock = StorageWriteLock(lock_path) if lock_path else nullcontext()
+        self.pending = []
+        self.sessions = {}
+        self.failures = 0
+        self.retry_at = 0.0
+        self.last_error = None
+        self.check_existing = False
+        self._replay()
+        self.thread = threading.Thread(target=self._run, name="milk-write-behind", daemon=True)
+        self.thread.start()
+
+    def _replay(self):
+        if not os.path.exists(self.journal_path):
+            return
+        entries = {}
+        with open(self.journal_path, encoding="utf-8") as journal:
+            for line in journal:
+                try:
+                    item = json.loads(line)
+                except ValueError:
+                    # Torn last line from a crash mid-write
+                    continue
+                if item['op'] == 'add':
+                    entries[item['id']] = item
+                elif item['op'] == 'done':
+                    for entry_id in item['ids']:
+                        entries.pop(entry_id, None)
+        self.pending = list(entries.values())
+        for entry in self.pending:
+            self._session(entry['session'])['pending'] += 1
+        self.ledger.restore(self.pending)
+        # A crash may have happened after the write but before it was journaled as done
+        self.check_existing = bool(self.pending)
+        self._rewrite_journal()
+
+    def _rewrite_journal(self):
+        """Compact the journal down to the entries still pending"""
+        tmp_path = self.journal_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as journal:
+            for entry in self.pending:
+                journal.write(json.dumps(entry) + "\n")
+            journal.flush()
+            os.fsync(journal.fileno())
+        os.replace(tmp_path, self.journal_path)
+
+    def _append_journal(self, items):
+        with open(self.journal_path, "a", encoding="utf-8") as journal:
+            for item in items:
+                journal.write(json.dumps(item) + "\n")
+            journal.flush()
+            os.fsync(journal.fileno())
+
+    def _session(self, session_id):
+        return self.sessions.setdefault(session_id, {'pending': 0, 'saved': 0, 'last_saved': None, 'conflicts': []})
+
+    def _report_conflicts(self, conflicts):
+        """Tell each session which of its items were turned away, and what holds the slot instead"""
+        for entry, holder in conflicts:
+            self._session(entry['session'])['conflicts'].append({
+                'kind': entry.get('kind', 'record'),
+                'record': entry['record'],
+                'holder': holder,
+            })
+
+    def submit(self, session_id, records, kind='record', bases=None):
+        """Journal records (or events) for saving; returns False if they could not be journaled.
+
+        bases are the versions (timestamps) events were based on. Records
+        already accepted are skipped, and items that conflict are not
+        journaled but reported by take_conflicts().
+        """
+        entries = [{'op': 'add', 'id': uuid.uuid4().hex, 'session': session_id, 'kind': kind, 'record': record}
+                   for record in records]
+        for entry, base in zip(entries, bases or ()):
+            entry['base'] = milk_entry_version(base)
+        try:
+            entries, _, conflicts = self.ledger.admit(entries)
+        except Exception as e:
+            self.last_error = f"Could not check for conflicting entries: {e}"
+            return False
+        with self.cond:
+            self._report_conflicts(conflicts)
+            try:
+                self._append_journal(entries)
+            except OSError as e:
+                self.ledger.release(entries)
+                self.last_error = f"Could not write journal: {e}"
+                return False
+            self.pending.extend(entries)
+            self._session(session_id)['pending'] += len(entries)
+            self.cond.notify()
+        return True
+
+    def take_conflicts(self, session_id):
+        """Conflicts reported to a session since the last call"""
+        with self.cond:
+            status = self._session(session_id)
+            conflicts, status['conflicts'] = status['conflicts'], []
+            return conflicts
+
+    def session_status(self, session_id):
+        """Pending/saved counts for one session plus the queue's last error"""
+        with self.cond:
+            status = dict(self._session(session_id))
+            status['conflicts'] = len(status['conflicts'])
+            status['last_error'] = self.last_error if self.failures else None
+            status['retry_in'] = max(0.0, self.retry_at - time.monotonic()) if self.failures else 0.0
+            return status
+
+    def depth(self):
+        with self.cond:
+            return len(self.pending)
+
+    def retry_now(self):
+        with self.cond:
+            self.retry_at = 0.0
+            self.cond.notify()
+
+    def _run(self):
+        while True:
+            with self.cond:
+                while not self.pending or time.monotonic() < self.retry_at:
+                    timeout = self.retry_at - time.monotonic() if self.pending else None
+                    self.cond.wait(timeout)
+            # Give other sessions a moment to add to the same batch
+            time.sleep(self.coalesce_seconds)
+            with self.cond:
+                batch = self.pending[:self.max_batch]
+            self._flush(batch)
+
+    def compact(self):
+        """Fold the change log into the base milk data, between flushes"""
+        with self.write_lock, self.storage_lock:
+            folded = self.storage.compact_milk_data()
+            self.events_since_compaction = 0
+            return folded
+
+    def _write(self, kind, entries):
+        """Write one kind of item to storage; returns (conflicts, error message or None)"""
+        write, find_existing, id_field, label = self.WRITERS[kind]
+        conflicts = []
+        try:
+            if kind == 'record':
+                # Another process may have filled a slot since it was claimed
+                entries, _, conflicts = self.ledger.verify(entries)
+            items = [entry['record'] for entry in entries]
+            if self.check_existing:
+                existing = getattr(self.storage, find_existing)([item for item in items if item.get(id_field)])
+                items = [item for item in items if item.get(id_field) not in existing]
+            if items:
+                getattr(self.storage, write)(items)
+            return conflicts, None
+        except Exception as e:
+            return conflicts, f"Could not save {label} to {self.storage.name}: {e}"
+
+    def _flush(self, batch):
+        done, conflicts, error = [], [], None
+        with self.write_lock, self.storage_lock:
+            # Records before events; events are applied on top of the records when loading
+            for kind in self.WRITERS:
+                entries = [entry for entry in batch if entry.get('kind', 'record') == kind]
+                if not entries:
+                    continue
+                turned_away, error = self._write(kind, entries)
+                if error:
+                    break
+                conflicts.extend(turned_away)
+                done.extend(entries)
+                if kind == 'event':
+                    self.events_since_compaction += len(entries)
+        rejected = [entry for entry, _ in conflicts]
+        self.ledger.release(rejected)
+        rejected_ids = {entry['id'] for entry in rejected}
+        self.ledger.written([entry for entry in done if entry['id'] not in rejected_ids])
+
+        with self.cond:
+            if not error:
+                self.check_existing = False
+            if done:
+                done_ids = {entry['id'] for entry in done}
+                self.pending = [entry for entry in self.pending if entry['id'] not in done_ids]
+                now = datetime.now().isoformat(timespec="seconds")
+                self._report_conflicts(conflicts)
+                for entry in done:
+                    status = self._session(entry['session'])
+                    status['pending'] -= 1
+                    if entry['id'] not in rejected_ids:
+                        status['saved'] += 1
+                        status['last_saved'] = now
+                try:
+                    if self.pending:
+                        self._append_journal([{'op': 'done', 'ids': sorted(done_ids)}])
+                    else:
+                        self._rewrite_journal()
+                except OSError:
+                    # The items are saved, a later replay skips them by id
+                    self.check_existing = True
+            if error:
+                # A failed batch may have been written in part (one month's worksheet of several),
+                # so the retry skips items that already landed
+                self.check_existing = True
+                self.failures += 1
+                self.last_error = error
+                delay = min(self.max_delay, self.base_delay * 2 ** (self.failures - 1))
+                self.retry_at = time.monotonic() + delay * random.uniform(0.5, 1.0)
+                return
+            self.failures = 0
+            self.last_error = None
+
+        if self.events_since_compaction >= self.compact_after_events:
+            try:
+                self.compact()
+            except Exception:
+                # Compaction is an optimisation, the change log stays valid without it
+                pass
+
+class StorageWriteLock:
+    """Exclusive lock on a file, held across processes while milk data is written or compacted.
+
+    The write-behind queue takes it for each flush and compaction, and
+    farm_jobs takes it to compact, so a nightly job never folds the change
+    log while the app is appending. Without fcntl it does nothing.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.file = None
+
+    def __enter__(self):
+        self.file = open(self.path, "a")
+        if fcntl is not None:
+            fcntl.flock(self.file.fileno(), fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *exc):
+        # Closing the file releases the lock
+        self.file.close()
+        self.file = None
+        return False
+
+def storage_journal_path(cache_key, extension):
+    """Path of a storage backend's write-behind journal ("jsonl") or write lock ("lock")"""
+    journal_dir = get_app_setting("storage", "journal_dir", "journal")
+    os.makedirs(journal_dir, exist_ok=True)
+    name = hashlib.sha1(repr(cache_key).encode()).hexdigest()[:12]
+    return os.path.join(journal_dir, f"milk_{name}.{extension}")
+
+def storage_write_lock(cache_key):
+    """Lock a storage backend's milk data against writes from other processes"""
+    return StorageWriteLock(storage_journal_path(cache_key, "lock"))
+
+@st.cache_resource
+def get_write_queue(cache_key, _storage):
+    """One write-behind queue per storage backend, shared by all sessions"""
+    return WriteBehindQueue(_storage, storage_journal_path(cache_key, "jsonl"),
+                            ledger_ttl_seconds=float(get_app_setting("storage", "entry_ledger_ttl_seconds", 120)),
+                            lock_path=storage_journal_path(cache_key, "lock"))
+
+def get_session_write_queue():
+    storage = st.session_state.storage
+    return get_write_queue(storage.cache_key, storage)
+
+def month_checksum(frame):
+    """Order-independent checksum of a typed record frame"""
+    canonical = pd.DataFrame({
+        'date': frame['date'].to_numpy().astype("datetime64[D]").astype("int64"),
+        'time': frame['time'].astype(str),
+        'cow_number': frame['cow_number'].astype("int64"),
+        'milk_liters': frame['milk_liters'].astype("float64"),
+        'worker': frame['worker'].astype(str),
+    })
+    hashes = np.sort(pd.util.hash_pandas_object(canonical, index=False).to_numpy())
+    return hashlib.sha1(hashes.tobytes()).hexdigest()
+
+class MilkArchive:
+    """Local columnar archive of closed months for multi-year reports.
+
+    Each archived month is a set of fixed-width .npy column files: date as
+    int32 days since 1970-01-01, cow as uint16, session and worker as uint8
+    and uint16 codes into dictionaries kept in the manifest, and liters as
+    float32. Reports open them memory-mapped and aggregate with numpy, so
+    old months are neither fetched from storage nor held as Python objects.
+
+    The manifest records a checksum of every month's records and the
+    storage version (StorageBackend.milk_month_versions) it was archived
+    at. sync() writes closed months the live store holds that are missing
+    or whose checksum changed; revalidate() drops months whose storage
+    version has moved on, so they are read from storage again. Column files
+    are named after the checksum and the manifest is replaced atomically,
+    so readers never see a half-written month; it is read again when
+    another process has replaced it.
+    """
+
+    COLUMNS = {"date": "int32", "cow": "uint16", "session": "uint8", "worker": "uint16", "liters": "float32"}
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        self.manifest_path = os.path.join(directory, "manifest.json")
+        self.manifest_mtime = None
+        self.manifest = {"sessions": [], "workers": [], "months": {}}
+        self._reload()
+
+    def _reload(self):
+        """Read the manifest again if it was replaced since it was read"""
+        try:
+            mtime = os.stat(self.manifest_path).st_mtime_ns
+            if mtime != self.manifest_mtime:
+                with open(self.manifest_path) as f:
+                    self.manifest = json.load(f)
+                self.manifest_mtime = mtime
+        except (OSError, ValueError):
+            pass
+
+    def months(self):
+        return sorted(self.manifest["months"])
+
+    def has(self, month):
+        return month in self.manifest["months"]
+
+    def _path(self, month, checksum, column):
+        return os.path.join(self.directory, f"{month}.{checksum[:12]}.{column}.npy")
+
+    def _codes(self, dictionary, values, dtype):
+        """Dictionary-encode values, adding new names to the dictionary"""
+        for value in pd.unique(values):
+            if value not in dictionary:
+                dictionary.append(value)
+        if len(dictionary) > np.iinfo(dtype).max + 1:
+            raise ValueError(f"Too many distinct values to archive as {dtype}")
+        return pd.Categorical(values, categories=dictionary).codes.astype(dtype)
+
+    def _write_month(self, month, frame, checksum):
+        cows = frame['cow_number'].to_numpy()
+        if len(cows) and (cows.min() < 0 or cows.max() > np.iinfo("uint16").max):
+            raise ValueError(f"cow_number out of range for the archive in {month}")
+        columns = {
+            "date": frame['date'].to_numpy().astype("datetime64[D]").astype("int32"),
+            "cow": cows.astype("uint16"),
+            "session": self._codes(self.manifest["sessions"], frame['time'].astype(str), "uint8"),
+            "worker": self._codes(self.manifest["workers"], frame['worker'].astype(str), "uint16"),
+            "liters": frame['milk_liters'].to_numpy().astype("float32"),
+        }
+        for column, values in columns.items():
+            np.save(self._path(month, checksum, column), np.ascontiguousarray(values, dtype=self.COLUMNS[column]))
+
+    def _save_manifest(self):
+        tmp_path = self.manifest_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.manifest, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.manifest_path)
+        self.manifest_mtime = os.stat(self.manifest_path).st_mtime_ns
+
+    def sync(self, store, current_month, versions=None):
+        """Archive the closed months held by the store that are missing or stale; returns the months written.
+
+        versions are the storage versions of the months, read before the
+        store's records were; a month archived without one is dropped by the
+        next revalidate().
+        """
+        versions = versions or {}
+        frame = store.frame()
+        partitions = milk_partition_keys(frame['date'].dt.strftime("%Y-%m-%d"))
+        months = set(partitions.unique()) if store.partitions is None else set(store.partitions)
+        written, changed = [], False
+        with self.lock:
+            self._reload()
+            for month in sorted(m for m in months if m < current_month):
+                rows = frame[(partitions == month).to_numpy()]
+                checksum = month_checksum(rows)
+                entry = self.manifest["months"].get(month)
+                if entry and entry["checksum"] == checksum:
+                    if versions.get(month) and entry.get("version") != versions[month]:
+                        entry["version"] = versions[month]
+                        changed = True
+                    continue
+                self._write_month(month, rows, checksum)
+                self.manifest["months"][month] = {"checksum": checksum, "rows": len(rows), "version": versions.get(month)}
+                written.append((month, entry))
+            if written or changed:
+                self._save_manifest()
+                # Old column files can go once the manifest no longer points at them
+                for month, old in written:
+                    if old and old["checksum"] != self.manifest["months"][month]["checksum"]:
+                        for column in self.COLUMNS:
+                            try:
+                                os.remove(self._path(month, old["checksum"], column))
+                            except OSError:
+                                pass
+        return [month for month, _ in written]
+
+    def revalidate(self, versions):
+        """Drop archived months whose storage version differs from versions; returns the months dropped"""
+        with self.lock:
+            self._reload()
+        stale = [month for month, version in versions.items()
+                 if self.has(month) and self.manifest["months"][month].get("version") != version]
+        self.forget(stale)
+        return stale
+
+    def forget(self, months):
+        """Drop months whose records changed in storage; they are archived again from the store"""
+        with self.lock:
+            self._reload()
+            dropped = [(month, self.manifest["months"].pop(month)) for month in months if month in self.manifest["months"]]
+            if dropped:
+                self._save_manifest()
+                for month, entry in dropped:
+                    for column in self.COLUMNS:
+                        try:
+                            os.remove(self._path(month, entry["checksum"], column))
+                        except OSError:
+                            pass
+
+    def _open(self, month):
+        checksum = self.manifest["months"][month]["checksum"]
+        return {column: np.load(self._path(month, checksum, column), mmap_mode="r") for column in self.COLUMNS}
+
+    def rollups(self, months, start=None, end=None):
+        """ProductionRollups of the archived months, limited to a date range"""
+        first = np.int32((pd.Timestamp(start) - pd.Timestamp(0)).days) if start is not None else None
+        last = np.int32((pd.Timestamp(end) - pd.Timestamp(0)).days) if end is not None else None
+        sessions, workers = self.manifest["sessions"], self.manifest["workers"]
+        totals = {
+            "session": [np.zeros(len(sessions)), np.zeros(len(sessions), dtype="int64")],
+            "worker": [np.zeros(len(workers)), np.zeros(len(workers), dtype="int64")],
+            "cow": [np.zeros(0), np.zeros(0, dtype="int64")],
+        }
+        days = {}
+        for month in months:
+            columns = self._open(month)
+            dates = columns["date"]
+            mask = np.ones(len(dates), dtype=bool)
+            if first is not None:
+                mask &= dates >= first
+            if last is not None:
+                mask &= dates <= last
+            liters = columns["liters"][mask].astype("float64")
+            if not len(liters):
+                continue
+            for name, codes in (("session", columns["session"][mask]), ("worker", columns["worker"][mask]),
+                                ("cow", columns["cow"][mask])):
+                sums, counts = totals[name]
+                size = max(len(sums), int(codes.max()) + 1)
+                totals[name] = [
+                    np.bincount(codes, weights=liters, minlength=size) + np.pad(sums, (0, size - len(sums))),
+                    np.bincount(codes, minlength=size) + np.pad(counts, (0, size - len(counts))),
+                ]
+            month_dates = dates[mask]
+            offset = int(month_dates.min())
+            day_sums = np.bincount(month_dates - offset, weights=liters)
+            day_counts = np.bincount(month_dates - offset)
+            for i in np.flatnonzero(day_counts):
+                days[offset + int(i)] = [float(day_sums[i]), int(day_counts[i])]
+
+        rollups = ProductionRollups()
+        keys = {"session": sessions, "worker": workers}
+        for name, (sums, counts) in totals.items():
+            group = rollups.groups[name]
+            for code in np.flatnonzero(counts):
+                key = keys[name][code] if name in keys else int(code)
+                group[key] = [float(sums[code]), int(counts[code])]
+        day_keys = pd.to_datetime(list(days), unit="D").tolist()
+        rollups.groups["day"] = dict(zip(day_keys, days.values()))
+        rollups.count = sum(count for _, count in days.values())
+        rollups.total = sum(total for total, _ in days.values())
+        return rollups
+
+@st.cache_resource
+def get_milk_archive(cache_key):
+    """One report archive per storage backend, shared by all sessions"""
+    archive_dir = get_app_setting("storage", "archive_dir", "archive")
+    name = hashlib.sha1(repr(cache_key).encode()).hexdigest()[:12]
+    return MilkArchive(os.path.join(archive_dir, name))
+
+# Runtime instrumentation
+class Metrics:
+    """Process-wide timers and counters for the Diagnostics tab.
+
+    A timer keeps its count, sum and max plus a window of recent samples
+    for percentiles; recording one costs two perf_counter calls and a lock.
+    When disabled, timer() returns a shared no-op context manager.
+    """
+
+    def __init__(self, enabled=True, window=512):
+        self.enabled = enabled
+        self.window = window
+        self.timers = {}
+        self.counters = collections.Counter()
+        self.lock = threading.Lock()
+        self.started = time.time()
+
+    @staticmethod
+    def _key(name, labels):
+        return (name, tuple(sorted(labels.items())))
+
+    def observe(self, name, seconds, **labels):
+        key = self._key(name, labels)
+        with self.lock:
+            timer = self.timers.get(key)
+            if timer is None:
+                timer = self.timers[key] = {'count': 0, 'sum': 0.0, 'max': 0.0,
+                                            'recent': collections.deque(maxlen=self.window)}
+            timer['count'] += 1
+            timer['sum'] += seconds
+            timer['max'] = max(timer['max'], seconds)
+            timer['recent'].append(seconds)
+
+    def timer(self, name, **labels):
+        """Context manager that records the wall time of its block"""
+        if not self.enabled:
+            return nullcontext()
+        return _MetricsTimer(self, name, labels)
+
+    def increment(self, name, value=1, **labels):
+        if self.enabled:
+            with self.lock:
+                self.counters[self._key(name, labels)] += value
+
+    def reset(self):
+        with self.lock:
+            self.timers.clear()
+            self.counters.clear()
+            self.started = time.time()
+
+    def timer_table(self):
+        """One row per timer with count and latency in milliseconds"""
+        with self.lock:
+            timers = [(name, dict(labels), dict(timer, recent=list(timer['recent'])))
+                      for (name, labels), timer in self.timers.items()]
+        rows = []
+        for name, labels, timer in sorted(timers, key=lambda t: (t[0], sorted(t[1].items()))):
+            recent = np.array(timer['recent'])
+            rows.append({
+                'timer': name,
+                'labels': ", ".join(f"{k}={v}" for k, v in labels.items()),
+                'count': timer['count'],
+                'avg_ms': round(timer['sum'] / timer['count'] * 1000, 1),
+                'p50_ms': round(float(np.percentile(recent, 50)) * 1000, 1),
+                'p95_ms': round(float(np.percentile(recent, 95)) * 1000, 1),
+                'max_ms': round(timer['max'] * 1000, 1),
+            })
+        return pd.DataFrame(rows)
+
+    def samples(self):
+        """(metric, labels, value) samples of every timer and counter"""
+        samples = []
+        with self.lock:
+            for (name, labels), timer in self.timers.items():
+                labels = dict(labels)
+                samples.append((f"{name}_seconds_count", labels, timer['count']))
+                samples.append((f"{name}_seconds_sum", labels, timer['sum']))
+                samples.append((f"{name}_seconds_max", labels, timer['max']))
+                for quantile in (0.5, 0.95):
+                    value = float(np.percentile(timer['recent'], quantile * 100))
+                    samples.append((f"{name}_seconds", dict(labels, quantile=str(quantile)), value))
+            for (name, labels), value in self.counters.items():
+                samples.append((f"{name}_total", dict(labels), value))
+        return samples
+
+class _MetricsTimer:
+    __slots__ = ("metrics", "name", "labels", "start")
+
+    def __init__(self, metrics, name, labels):
+        self.metrics = metrics
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        # Also recorded when st.rerun() or st.stop() ends the block early
+        self.metrics.observe(self.name, time.perf_counter() - self.start, **self.labels)
         return False
+
+@st.cache_resource
+def get_metrics():
+    """One metrics registry per server process"""
+    enabled = str(get_app_setting("diagnostics", "enabled", True)).lower() not in ("0", "false", "no")
+    return Metrics(enabled)
+
+def diagnostics_samples():
+    """Timers and counters plus Sheets call stats, queue depth and cache hit rates, as (metric, labels, value)"""
+    samples = [(f"dairy_{name}", labels, value) for name, labels, value in get_metrics().samples()]
+    storage = st.session_state.storage
+    queue = get_session_write_queue()
+    samples.append(("dairy_write_queue_depth", {}, queue.depth()))
+    samples.append(("dairy_session_unsaved_records", {}, len(st.session_state.unsaved_milk_data)))
+    samples.append(("dairy_write_queue_failures", {}, queue.failures))
+    cache = get_reference_cache()
+    lookups = cache.hits + cache.misses
+    samples.append(("dairy_reference_cache_hits_total", {}, cache.hits))
+    samples.append(("dairy_reference_cache_misses_total", {}, cache.misses))
+    samples.append(("dairy_reference_cache_hit_ratio", {}, cache.hits / lookups if lookups else 0.0))
+    if not storage.is_local:
+        sheet = st.session_state.gsheets_conn
+        for operation, stats in get_sheets_client(sheet.id, sheet).metrics().iterrows():
+            labels = {'operation': operation}
+            samples.append(("dairy_sheets_calls_total", labels, stats['calls']))
+            samples.append(("dairy_sheets_errors_total", labels, stats['errors']))
+            samples.append(("dairy_sheets_retries_total", labels, stats['retries']))
+            samples.append(("dairy_sheets_call_seconds_sum", labels, stats['total_seconds']))
+            samples.append(("dairy_sheets_call_seconds_max", labels, stats['max_seconds']))
+            samples.append(("dairy_sheets_throttled_seconds_sum", labels, stats['throttled_seconds']))
+    return samples
+
+def _prometheus_label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def format_prometheus(samples):
+    """Samples in the Prometheus text exposition format"""
+    lines = []
+    for name, labels, value in samples:
+        label_text = ",".join(f'{key}="{_prometheus_label(val)}"' for key, val in labels.items())
+        lines.append(f"{name}{{{label_text}}} {float(value):.6g}" if label_text else f"{name} {float(value):.6g}")
+    return "\n".join(lines) + "\n"
+
+def format_json_lines(samples):
+    """Samples as JSON lines, one per metric, stamped with the export time"""
+    now = datetime.now().isoformat(timespec="seconds")
+    return "".join(json.dumps({'time': now, 'metric': name, 'labels': labels, 'value': float(value)}) + "\n"
+                   for name, labels, value in samples)
+
 # Password protection system
 def check_password():
     """Returns True if password is correct, False otherwise"""
@@ -270,22 +3034,16 @@ def check_password():
 # NEW FUNCTION - Add this after the check_password function
 # Replace your check_supervisor_password function with this corrected version:
 
-def check_supervisor_password():
-    """Returns True if supervisor password is correct, False otherwise"""
-    
-    def supervisor_password_entered():
-        # Check if the password field exists and has content
-        if "supervisor_password" in st.session_state and st.session_state["supervisor_password"]:
-            if st.session_state["supervisor_password"] == "7441":
-                st.session_state["supervisor_password_correct"] = True
-                del st.session_state["supervisor_password"]  # Clear password from session
-            else:
-                st.session_state["supervisor_password_correct"] = False
-        else:
-            st.session_state["supervisor_password_correct"] = False
-
-    # Check if supervisor password is already verified
-    if st.session_state.get("supervisor_password_correct", False):
+def check_supervisor_password():
+    """Returns True if supervisor password is correct, False otherwise.
+
+    Access is granted for the farm whose password was entered:
+    supervisor_password_correct holds that farm's id.
+    """
+    farm = current_farm()
+
+    # Check if supervisor password is already verified for this farm
+    if st.session_state.get("supervisor_password_correct") == farm.farm_id:
         return True
     
     # Show supervisor password input
@@ -311,9 +3069,12 @@ def check_supervisor_password():
         )
         
         # Check password when button is clicked
-        if st.button("Submit Password", use_container_width=True, type="primary"):
-            if supervisor_password == "7441":
-                st.session_state["supervisor_password_correct"] = True
+        if farm.supervisor_password is None:
+            where = "password to the [supervisor]" if farm.farm_id == "default" else f"supervisor_password to its [farms.{farm.farm_id}]"
+            st.error(f"❌ No supervisor password is set for {farm.name}. Add {where} section in the secrets.")
+        elif st.button("Submit Password", use_container_width=True, type="primary"):
+            if farm.supervisor_password_matches(supervisor_password):
+                st.session_state["supervisor_password_correct"] = farm.farm_id
                 st.success("✅ Access granted!")
                 st.rerun()
             else:
@@ -332,56 +3093,670 @@ def check_supervisor_password():
     
     return False
 # Initialize session state with Google Sheets
+LOADER_THREADS = 4
+
+@st.cache_resource
+def get_loader_pool():
+    """Threads that load and parse the milk history while the first page renders, shared by all farms"""
+    return ThreadPoolExecutor(max_workers=LOADER_THREADS, thread_name_prefix="milk-loader")
+
+def submit_milk_load(farm, storage, partitions):
+    """Load milk records on the shared loader pool while the farm has a free slot there.
+
+    A farm whose sessions already hold all its slots loads in the calling
+    session instead, so it cannot queue the other farms' loads behind its own.
+    Returns a future, or None when the caller has to load itself.
+    """
+    if not farm.load_slots.acquire(blocking=False):
+        return None
+    try:
+        future = get_loader_pool().submit(load_milk_store, storage, partitions)
+    except RuntimeError:
+        farm.load_slots.release()
+        return None
+    future.add_done_callback(lambda _: farm.load_slots.release())
+    return future
+
+def load_milk_store(storage, partitions=None):
+    """Fetch, parse and index milk records of some monthly partitions; returns (store, rejected row counts)"""
+    frame, rejected = storage.fetch_milk_data(partitions)
+    return MilkRecordStore(frame, partitions), rejected
+
 def initialize_session_state():
     if 'role' not in st.session_state:
         st.session_state.role = None
     if 'current_user' not in st.session_state:
         st.session_state.current_user = None
+    if 'session_id' not in st.session_state:
+        st.session_state.session_id = uuid.uuid4().hex
+    farm = current_farm()
     if 'gsheets_conn' not in st.session_state:
-        st.session_state.gsheets_conn = initialize_gsheets_connection()
+        st.session_state.gsheets_conn = initialize_gsheets_connection(farm.spreadsheet_id)
+    if 'storage' not in st.session_state:
+        st.session_state.storage = create_storage_backend(st.session_state.gsheets_conn, farm)
     
-    if st.session_state.gsheets_conn:
-        # Load data from Google Sheets
-        if 'workers' not in st.session_state:
-            st.session_state.workers = load_workers_from_sheets(st.session_state.gsheets_conn)
-        if 'cow_assignments' not in st.session_state:
-            st.session_state.cow_assignments = load_cow_assignments_from_sheets(st.session_state.gsheets_conn)
-        if 'milk_data' not in st.session_state:
-            st.session_state.milk_data = load_milk_data_from_sheets(st.session_state.gsheets_conn)
-        if 'cows' not in st.session_state:
-            total_cows = load_system_config_from_sheets(st.session_state.gsheets_conn)
-            st.session_state.cows = list(range(1, total_cows + 1))
-    else:
-        # Fallback to default values if connection fails
-        if 'workers' not in st.session_state:
-            st.session_state.workers = ["John Doe", "Mary Smith", "David Johnson", "Sarah Wilson"]
-        if 'cow_assignments' not in st.session_state:
-            st.session_state.cow_assignments = {}
-        if 'milk_data' not in st.session_state:
-            st.session_state.milk_data = []
-        if 'cows' not in st.session_state:
-            st.session_state.cows = list(range(1, 51))
+    # Load reference tables through the shared cache, refreshing this session's copy when it changed
+    storage = st.session_state.storage
+    cache = get_reference_cache()
+    if 'reference_versions' not in st.session_state:
+        st.session_state.reference_versions = {}
+    versions = st.session_state.reference_versions
+
+    # Start the current month's milk download first, so it overlaps the reference tables and the
+    # role-selection page; older months are loaded when a report needs them
+    if 'milk_data' not in st.session_state and 'milk_data_future' not in st.session_state:
+        st.session_state.milk_data_future = submit_milk_load(farm, storage, [milk_partition(date.today())])
+
+    # Tables with an edit that failed to save keep the edit instead of the stored data
+    if 'unsaved_reference_tables' not in st.session_state:
+        st.session_state.unsaved_reference_tables = set()
+    unsaved = st.session_state.unsaved_reference_tables
+
+    # Fetch every reference table the cache has to reload in one batched request
+    stale = [table for table in REFERENCE_TABLES if cache.version(storage, table) is None]
+    if len(stale) > 1:
+        storage.prefetch(stale)
+    if 'workers' not in st.session_state or ('workers' not in unsaved and versions.get('workers') != cache.version(storage, 'workers')):
+        st.session_state.workers, versions['workers'] = cache.get(storage, 'workers', storage.load_workers)
+    if 'cow_assignments' not in st.session_state or ('cow_assignments' not in unsaved and versions.get('cow_assignments') != cache.version(storage, 'cow_assignments')):
+        assignments, versions['cow_assignments'] = cache.get(storage, 'cow_assignments', storage.load_cow_assignments)
+        st.session_state.cow_assignments = CowAssignments(assignments)
+    if 'cows' not in st.session_state or ('system_config' not in unsaved and versions.get('system_config') != cache.version(storage, 'system_config')):
+        total_cows, versions['system_config'] = cache.get(storage, 'system_config', storage.load_total_cows)
+        st.session_state.cows = list(range(1, total_cows + 1))
+    storage.discard_prefetched()
 
     if 'unsaved_milk_data' not in st.session_state:
         st.session_state.unsaved_milk_data = []
 
-initialize_session_state()
+def ensure_milk_data():
+    """Wait for the milk history load started by initialize_session_state; returns False if it failed.
+
+    A failed load is shown and dropped, so the next run starts a new one
+    instead of carrying on with an empty store.
+    """
+    if 'milk_data' in st.session_state:
+        return True
+    future = st.session_state.pop('milk_data_future', None)
+    with st.spinner("Loading production history..."), get_metrics().timer("section", section="milk_data_wait"):
+        try:
+            store, rejected = (future.result() if future else
+                               load_milk_store(st.session_state.storage, [milk_partition(date.today())]))
+        except Exception as e:
+            st.error(f"Error loading milk data: {e}")
+            st.button("🔄 Try again", key="retry_milk_load")
+            return False
+    warn_rejected_milk_rows(rejected)
+    st.session_state.milk_data = store
+    st.session_state.milk_synced_at = time.monotonic()
+    return True
+
+def ensure_milk_range(start=None, end=None):
+    """Load the monthly partitions a date range needs into this session's store (all when no range)"""
+    store = st.session_state.milk_data
+    if start is None:
+        if store.partitions is not None:
+            load_milk_partitions(None)
+    else:
+        load_milk_partitions(store.missing_partitions(milk_partitions_between(start, end)))
+
+def load_milk_partitions(missing):
+    """Fetch monthly partitions into this session's store; None fetches all it does not hold yet"""
+    store = st.session_state.milk_data
+    if missing is not None and not missing:
+        return
+    get_metrics().increment("milk_partitions_loaded", len(missing) if missing is not None else 1)
+    with st.spinner("Loading older production records..."), get_metrics().timer("section", section="load_partitions"):
+        try:
+            frame, rejected = st.session_state.storage.fetch_milk_data(missing)
+        except Exception as e:
+            st.error(f"Error loading milk data: {e}")
+            return
+    if missing is None:
+        # Everything was read, keep only the months this session did not have yet
+        frame = frame[~milk_partition_keys(frame['date']).isin(store.partitions)]
+    warn_rejected_milk_rows(rejected)
+    store.add_partitions(frame, missing)
+
+def sync_milk_data():
+    """Catch this session's records up with what other sessions saved since they were read.
+
+    Only the rows appended to storage since the store's sync marks are
+    fetched and merged; when storage was rewritten in between (compaction)
+    the loaded months are read again instead. Returns the number of records
+    that changed.
+    """
+    store = st.session_state.milk_data
+    storage = st.session_state.storage
+    if store.sync_marks is None:
+        return 0
+    with get_metrics().timer("section", section="milk_sync"):
+        try:
+            changes = storage.fetch_milk_changes(store.sync_marks, store.partitions)
+            if changes is None:
+                partitions = None if store.partitions is None else sorted(store.partitions)
+                reloaded, rejected = load_milk_store(storage, partitions)
+                warn_rejected_milk_rows(rejected)
+                st.session_state.milk_data = reloaded
+                get_metrics().increment("milk_sync_reloads")
+                return len(reloaded)
+        except Exception as e:
+            # Live updates are best effort, the next interval tries again
+            get_metrics().increment("milk_sync_errors")
+            st.session_state.milk_sync_error = str(e)
+            return 0
+        records, events, marks = changes
+        changed = store.merge_changes(records, events)
+        store.sync_marks = marks
+    st.session_state.pop('milk_sync_error', None)
+    get_metrics().increment("milk_sync_records", changed)
+    return changed
+
+def show_live_sync():
+    """Merge other sessions' records every [storage] sync_interval_seconds while the dashboard is open"""
+    interval = float(get_app_setting("storage", "sync_interval_seconds", 30))
+    if interval <= 0:
+        return
+
+    # Only the first call is part of a full run; later ones are the fragment's timer
+    full_run = [True]
+
+    @st.fragment(run_every=interval)
+    def live_sync():
+        in_full_run = full_run and full_run.pop()
+        last = st.session_state.get('milk_synced_at', 0.0)
+        if time.monotonic() - last >= interval * 0.9:
+            st.session_state.milk_synced_at = time.monotonic()
+            if sync_milk_data() and not in_full_run:
+                # Redraw the tabs with the new records
+                st.rerun()
+        if st.session_state.get('milk_sync_error'):
+            st.caption(f"⚠️ Live updates paused: {st.session_state.milk_sync_error}")
+
+    live_sync()
+
+def production_summary(start, end):
+    """Production Reports aggregates for a date range.
+
+    Closed months in the local archive are scanned there, unless their
+    records changed in storage since they were archived; other months are
+    loaded into the session store, and closed ones then archived for the
+    next report.
+    """
+    store = st.session_state.milk_data
+    storage = st.session_state.storage
+    archive = get_milk_archive(storage.cache_key)
+    current_month = milk_partition(date.today())
+    held = storage.milk_partitions() if store.partitions is None else store.partitions
+    months = sorted({month for month in [*milk_partitions_between(start, end), *held] if month < current_month})
+    checked = st.session_state.get('archive_versions')
+    if checked and checked[1] == months and time.monotonic() - checked[0] < float(
+            get_app_setting("storage", "archive_check_seconds", 60)):
+        versions = checked[2]
+    else:
+        try:
+            # Read before the records are caught up below, so what gets archived is at least as new as its version
+            versions = storage.milk_month_versions(months)
+            st.session_state.archive_versions = (time.monotonic(), months, versions)
+        except Exception as e:
+            st.warning(f"⚠️ Could not check the report archive against storage, reading from storage: {e}")
+            versions = None
+        if versions is not None and archive.revalidate(versions):
+            st.session_state.pop('archive_synced_version', None)
+        sync_milk_data()
+        store = st.session_state.milk_data
+
+    missing = store.missing_partitions(milk_partitions_between(start, end))
+    archived = [month for month in missing if month < current_month and archive.has(month) and versions is not None]
+    load_milk_partitions([month for month in missing if month not in archived])
+    if st.session_state.get('archive_synced_version') != (id(store), store.version):
+        try:
+            archive.sync(store, current_month, versions)
+        except (OSError, ValueError) as e:
+            st.warning(f"⚠️ Could not update the report archive: {e}")
+        st.session_state.archive_synced_version = (id(store), store.version)
+    return production_rollups(store, archive, start, end, use_archive=versions is not None).summary()
+
+def production_rollups(store, archive, start, end, use_archive=True):
+    """Rollups of a date range over the months the store holds plus the archived months it does not"""
+    archived = [month for month in store.missing_partitions(milk_partitions_between(start, end))
+                if use_archive and archive.has(month)]
+    rollups = store.range_rollups(start, end)
+    if archived:
+        get_metrics().increment("archive_months_scanned", len(archived))
+        rollups = rollups.merged(archive.rollups(archived, start, end))
+    return rollups
 
 # Auto-save functions
+def save_reference_table(table, save, value):
+    """Save this session's edit of a reference table and write the stored value through the shared cache.
+
+    Returns the value as stored (which may include changes saved elsewhere
+    meanwhile), or None when the save failed. A failed edit stays in this
+    session, marked unsaved so it is not replaced by the stored data, and
+    can be saved again from the dashboard.
+    """
+    stored = save(value)
+    if stored is None:
+        st.session_state.unsaved_reference_tables.add(table)
+        return None
+    stored, st.session_state.reference_versions[table] = get_reference_cache().put(st.session_state.storage, table, stored)
+    st.session_state.unsaved_reference_tables.discard(table)
+    return stored
+
 def auto_save_workers():
-    if st.session_state.gsheets_conn:
-        return save_workers_to_sheets(st.session_state.gsheets_conn, st.session_state.workers)
-    return False
+    stored = save_reference_table('workers', st.session_state.storage.save_workers, st.session_state.workers)
+    if stored is None:
+        return False
+    st.session_state.workers = stored
+    return True
 
 def auto_save_cow_assignments():
-    if st.session_state.gsheets_conn:
-        return save_cow_assignments_to_sheets(st.session_state.gsheets_conn, st.session_state.cow_assignments)
-    return False
+    stored = save_reference_table('cow_assignments', st.session_state.storage.save_cow_assignments,
+                                  st.session_state.cow_assignments)
+    if stored is None:
+        return False
+    st.session_state.cow_assignments = CowAssignments(stored)
+    return True
 
 def auto_save_system_config():
-    if st.session_state.gsheets_conn:
-        return save_system_config_to_sheets(st.session_state.gsheets_conn, len(st.session_state.cows))
-    return False
+    stored = save_reference_table('system_config', st.session_state.storage.save_total_cows, len(st.session_state.cows))
+    if stored is None:
+        return False
+    st.session_state.cows = list(range(1, stored + 1))
+    return True
+
+# Reference table -> its auto-save function, to retry edits whose save failed
+REFERENCE_SAVERS = {
+    'workers': auto_save_workers,
+    'cow_assignments': auto_save_cow_assignments,
+    'system_config': auto_save_system_config,
+}
+
+def show_unsaved_reference_tables():
+    """Warn about reference edits whose save failed, with a button to save them again"""
+    unsaved = st.session_state.unsaved_reference_tables
+    if not unsaved:
+        return
+    names = ", ".join(table.replace("_", " ") for table in sorted(unsaved))
+    st.warning(f"⚠️ Changes to {names} are not saved yet. They are kept in this session until they are.")
+    if st.button("💾 Save changes again", key="retry_reference_saves"):
+        for table in sorted(unsaved):
+            REFERENCE_SAVERS[table]()
+        st.rerun()
+
+# Yield anomaly detection
+class YieldBaselines:
+    """Robust per-cow yield baselines, kept separately for the Morning and Evening sessions.
+
+    Each (cow, session) baseline is the median and the median absolute
+    deviation (MAD) of that cow's last `sessions` yields in the records it
+    is built from. score() checks a whole batch of entries against them at
+    once: the robust z-score is (liters - median) / (1.4826 * MAD), with the
+    MAD floored so very steady cows are not flagged for small changes.
+    Cows with fewer than `min_sessions` past yields are never flagged.
+    """
+
+    def __init__(self, frame, sessions=14, min_sessions=5, threshold=3.5):
+        self.min_sessions = min_sessions
+        self.threshold = threshold
+        recent = pd.DataFrame({
+            'date': frame['date'].to_numpy(),
+            'cow_number': frame['cow_number'].astype("int64").to_numpy(),
+            'time': frame['time'].astype(str).to_numpy(),
+            'milk_liters': frame['milk_liters'].astype("float64").to_numpy(),
+        }).sort_values('date', kind="stable")
+        recent = recent.groupby(['cow_number', 'time']).tail(sessions)
+        grouped = recent.groupby(['cow_number', 'time'])['milk_liters']
+        deviation = (recent['milk_liters'] - grouped.transform('median')).abs()
+        self.table = pd.DataFrame({
+            'median': grouped.median(),
+            'mad': deviation.groupby([recent['cow_number'], recent['time']]).median(),
+            'count': grouped.size(),
+        })
+
+    def __len__(self):
+        return len(self.table)
+
+    def score(self, batch):
+        """Score entries with cow_number, time and milk_liters columns.
+
+        Returns one row per entry with the usual yield, the robust z-score
+        and a flag: "" when normal, "low", "high" or "decimal slip" (about ten
+        times the usual yield, like 120 typed for 12.0).
+        """
+        index = pd.MultiIndex.from_arrays([batch['cow_number'].astype("int64").to_numpy(),
+                                           batch['time'].astype(str).to_numpy()])
+        base = self.table.reindex(index)
+        liters = batch['milk_liters'].astype("float64").to_numpy()
+        median = base['median'].to_numpy()
+        known = base['count'].fillna(0).to_numpy() >= self.min_sessions
+        scale = 1.4826 * np.maximum(base['mad'].to_numpy(), np.maximum(0.05 * median, 0.2))
+        with np.errstate(invalid="ignore", divide="ignore"):
+            z = np.where(known, (liters - median) / scale, np.nan)
+            ratio = liters / median
+        flag = np.select(
+            [known & (ratio >= 8) & (ratio <= 12), known & (z > self.threshold), known & (z < -self.threshold)],
+            ["decimal slip", "high", "low"],
+            default="",
+        )
+        return pd.DataFrame({
+            'cow_number': batch['cow_number'].to_numpy(),
+            'time': batch['time'].astype(str).to_numpy(),
+            'milk_liters': liters,
+            'usual': median,
+            'z': z,
+            'flag': flag,
+        })
+
+BASELINE_DAYS = 30
+
+def session_yield_baselines(day):
+    """Baselines from the records of the BASELINE_DAYS before a day, rebuilt when this session's records change"""
+    day = pd.Timestamp(day).date()
+    start = day - timedelta(days=BASELINE_DAYS)
+    ensure_milk_range(start, day)
+    store = st.session_state.milk_data
+    key = (id(store), store.version, day)
+    cached = st.session_state.get('yield_baselines')
+    if cached and cached[0] == key:
+        return cached[1]
+    baselines = build_yield_baselines(store.select(start, day - timedelta(days=1)))
+    st.session_state.yield_baselines = (key, baselines)
+    return baselines
+
+def build_yield_baselines(frame):
+    """YieldBaselines of some records with the [analytics] settings"""
+    return YieldBaselines(
+        frame,
+        sessions=int(get_app_setting("analytics", "baseline_sessions", 14)),
+        min_sessions=int(get_app_setting("analytics", "min_sessions", 5)),
+        threshold=float(get_app_setting("analytics", "threshold", 3.5)),
+    )
+
+# Data export, written a chunk at a time and cached on disk by the stored months' versions
+EXPORT_CHUNK_ROWS = 100_000
+EXPORT_KEEP_FILES = 10
+# Months fetched from storage per read while writing an export
+EXPORT_FETCH_MONTHS = 6
+EXCEL_MAX_ROWS = 1_048_575
+
+# label -> (file extension, MIME type)
+EXPORT_FORMATS = {
+    "CSV": ("csv", "text/csv"),
+    "Excel": ("xlsx", "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"),
+    "Parquet": ("parquet", "application/vnd.apache.parquet"),
+}
+
+def write_milk_export(chunks, path, extension):
+    """Write text-formatted record chunks to a CSV, XLSX or Parquet file, replacing it atomically"""
+    tmp_path = path + ".tmp"
+    try:
+        empty = pd.DataFrame(columns=MILK_DATA_HEADERS)
+        if extension == "csv":
+            with open(tmp_path, "w", newline="", encoding="utf-8") as f:
+                header = True
+                for chunk in chunks:
+                    chunk.to_csv(f, index=False, header=header)
+                    header = False
+                if header:
+                    empty.to_csv(f, index=False)
+        elif extension == "xlsx":
+            workbook = openpyxl.Workbook(write_only=True)
+            worksheet = workbook.create_sheet("milk_data")
+            header = True
+            for chunk in chunks:
+                if header:
+                    worksheet.append(list(chunk.columns))
+                    header = False
+                for row in chunk.itertuples(index=False, name=None):
+                    worksheet.append(row)
+            if header:
+                worksheet.append(MILK_DATA_HEADERS)
+            workbook.save(tmp_path)
+        elif extension == "parquet":
+            # Only Parquet exports need pyarrow
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+            writer = None
+            try:
+                for chunk in chunks:
+                    table = pa.Table.from_pandas(chunk, preserve_index=False)
+                    if writer is None:
+                        writer = pq.ParquetWriter(tmp_path, table.schema)
+                    writer.write_table(table.cast(writer.schema))
+                if writer is None:
+                    pq.write_table(pa.Table.from_pandas(empty.astype(str), preserve_index=False), tmp_path)
+            finally:
+                if writer is not None:
+                    writer.close()
+        else:
+            raise ValueError(f"Unknown export format {extension}")
+    except BaseException:
+        # A failed or stopped export leaves no partial file behind
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    os.replace(tmp_path, path)
+
+def export_months(storage, start=None, end=None):
+    """Stored months an export of the date range reads, oldest first"""
+    stored = storage.milk_partitions()
+    if start is None:
+        return list(stored)
+    wanted = set(milk_partitions_between(start, end))
+    return [month for month in stored if month in wanted]
+
+def milk_export_chunks(storage, months, start=None, end=None, workers=None, cows=None, max_rows=None):
+    """Selected records read from storage a few months at a time, formatted as text in date order.
+
+    Only EXPORT_FETCH_MONTHS months are held in memory at once, so an
+    all-history export does not load the history into the session.
+    counts['rows'] has the number of records yielded so far.
+    """
+    counts = {'rows': 0}
+
+    def chunks():
+        for first in range(0, len(months), EXPORT_FETCH_MONTHS):
+            frame, _ = storage.fetch_milk_data(months[first:first + EXPORT_FETCH_MONTHS])
+            selected = select_milk_records(MilkRecordStore._typed(frame), start, end, workers, cows)
+            counts['rows'] += len(selected)
+            if max_rows is not None and counts['rows'] > max_rows:
+                raise ValueError(f"More than {max_rows:,} records do not fit in one Excel sheet, choose CSV or Parquet")
+            for offset in range(0, len(selected), EXPORT_CHUNK_ROWS):
+                yield MilkRecordStore._export(selected.iloc[offset:offset + EXPORT_CHUNK_ROWS])
+
+    return chunks(), counts
+
+def prepare_milk_export(storage, extension, start=None, end=None, workers=None, cows=None):
+    """Return (path, records) of an export file for the selected records, reusing one written for the same data.
+
+    Files are named after the request and the stored months' versions, so a
+    repeated export costs one version read and nothing is loaded when the
+    months are unchanged. The record count is kept in the file name.
+    """
+    months = export_months(storage, start, end)
+    versions = storage.milk_month_versions(months)
+    request = (start, end, sorted(workers or []), sorted(cows or []), sorted(versions.items()))
+    key = hashlib.sha1(repr(request).encode()).hexdigest()[:20]
+    directory = os.path.join(get_app_setting("storage", "export_dir", "exports"),
+                             hashlib.sha1(repr(storage.cache_key).encode()).hexdigest()[:12])
+    os.makedirs(directory, exist_ok=True)
+    for name in os.listdir(directory):
+        if name.startswith(key + "-") and name.endswith("." + extension):
+            path = os.path.join(directory, name)
+            os.utime(path)
+            return path, int(name[len(key) + 1:-len(extension) - 1])
+
+    chunks, counts = milk_export_chunks(storage, months, start, end, workers, cows,
+                                        EXCEL_MAX_ROWS if extension == "xlsx" else None)
+    tmp_path = os.path.join(directory, f"{key}.{extension}")
+    write_milk_export(chunks, tmp_path, extension)
+    path = os.path.join(directory, f"{key}-{counts['rows']}.{extension}")
+    os.replace(tmp_path, path)
+    # Keep only the most recent exports
+    files = sorted((os.path.join(directory, name) for name in os.listdir(directory) if not name.endswith(".tmp")),
+                   key=os.path.getmtime, reverse=True)
+    for old in files[EXPORT_KEEP_FILES:]:
+        try:
+            os.remove(old)
+        except OSError:
+            pass
+    return path, counts['rows']
+
+def read_export_file(path):
+    with open(path, "rb") as f:
+        return f.read()
+
+# Bulk import of production history from CSV or Excel files
+IMPORT_CHUNK_ROWS = 50_000
+IMPORT_BATCH_ROWS = 10_000
+
+# Lower-case header names (spaces and underscores removed) recognised for each milk_data column
+IMPORT_COLUMN_ALIASES = {
+    'date': ["date", "day", "milkingdate", "दिनांक", "तारीख"],
+    'time': ["time", "session", "shift", "सत्र"],
+    'cow_number': ["cownumber", "cow", "cowno", "cowid", "cow#", "गाय"],
+    'milk_liters': ["milkliters", "milk", "liters", "litres", "milklitres", "yield", "quantity", "दूध"],
+    'worker': ["worker", "milker", "workername", "कामगार"],
+    'notes': ["notes", "note", "remarks", "comment", "comments", "नोट"],
+}
+
+IMPORT_SESSION_ALIASES = {
+    "morning": "Morning", "am": "Morning", "m": "Morning", "सुबह": "Morning",
+    "evening": "Evening", "pm": "Evening", "e": "Evening", "शाम": "Evening",
+}
+
+def read_import_chunks(file, file_name, chunk_rows=IMPORT_CHUNK_ROWS):
+    """Stream a CSV or XLSX file as DataFrames of raw cells, yielding (chunk, fraction of the file read).
+
+    Excel files are read with openpyxl in read-only mode, so neither format
+    is ever held as one DataFrame.
+    """
+    file.seek(0)
+    if file_name.lower().endswith((".xlsx", ".xlsm")):
+        workbook = openpyxl.load_workbook(file, read_only=True, data_only=True)
+        try:
+            worksheet = workbook.worksheets[0]
+            total = worksheet.max_row or 0
+            rows = worksheet.iter_rows(values_only=True)
+            headers = next((row for row in rows if any(cell is not None for cell in row)), None)
+            if headers is None:
+                return
+            headers = [str(h).strip() if h is not None else f"column_{i + 1}" for i, h in enumerate(headers)]
+            batch, read = [], 1
+            for row in rows:
+                batch.append(row)
+                read += 1
+                if len(batch) == chunk_rows:
+                    yield pd.DataFrame(batch).reindex(columns=range(len(headers))).set_axis(headers, axis=1), (read / total if total else 0.0)
+                    batch = []
+            if batch:
+                yield pd.DataFrame(batch).reindex(columns=range(len(headers))).set_axis(headers, axis=1), 1.0
+        finally:
+            workbook.close()
+    else:
+        size = file.seek(0, os.SEEK_END)
+        file.seek(0)
+        # Our own text wrapper, detached at the end, so pandas never closes the uploaded file
+        text = io.TextIOWrapper(file, encoding="utf-8-sig", newline="")
+        try:
+            for chunk in pd.read_csv(text, chunksize=chunk_rows, dtype=str, keep_default_na=False):
+                chunk.columns = [str(c).strip() for c in chunk.columns]
+                yield chunk, (min(1.0, file.tell() / size) if size else 1.0)
+        finally:
+            text.detach()
+
+def preview_import_file(file, file_name, rows=5):
+    """The first rows of an import file, for the column mapping"""
+    chunks = read_import_chunks(file, file_name, rows)
+    try:
+        return next(chunks, (pd.DataFrame(), 0.0))[0]
+    finally:
+        chunks.close()
+
+def guess_import_mapping(headers):
+    """Map milk_data columns to the file headers that look like them"""
+    normalized = {re.sub(r"[\s_]+", "", str(header).lower()): header for header in headers}
+    mapping = {}
+    for column, aliases in IMPORT_COLUMN_ALIASES.items():
+        mapping[column] = next((normalized[alias] for alias in aliases if alias in normalized), None)
+    return mapping
+
+def milk_record_keys(frame):
+    """Hash of each record's natural key (date, session, cow) as uint64, for vectorized duplicate checks"""
+    keys = frame['date'].astype(str) + "|" + frame['time'].astype(str) + "|" + frame['cow_number'].astype("int64").astype(str)
+    return pd.util.hash_array(keys.to_numpy(dtype=object))
+
+def prepare_import_chunk(chunk, mapping, default_session, default_worker, timestamp):
+    """Map a raw chunk to milk_data columns and validate it; returns (frame, rejected)"""
+    df = pd.DataFrame({column: chunk[source] for column, source in mapping.items() if source}, index=chunk.index)
+    frame, rejected = clean_milk_frame(df)
+    sessions = frame['time'].replace("", default_session).str.strip().str.lower().map(IMPORT_SESSION_ALIASES)
+    invalid = sessions.isna()
+    if invalid.any():
+        rejected["invalid session"] = int(invalid.sum())
+    frame = frame[~invalid].copy()
+    frame['time'] = sessions[~invalid]
+    frame['worker'] = frame['worker'].str.strip().replace("", default_worker)
+    frame['timestamp'] = frame['timestamp'].replace("", timestamp)
+    # Ids follow the natural key, so importing the same row twice gives the same id
+    frame['record_id'] = ["imp-%016x" % key for key in milk_record_keys(frame)]
+    return frame[MILK_DATA_HEADERS], rejected
+
+def import_milk_file(storage, file, file_name, mapping, default_session="Morning", default_worker="import",
+                     progress=None, write_lock=None, chunk_rows=IMPORT_CHUNK_ROWS, batch_rows=IMPORT_BATCH_ROWS):
+    """Stream a file into storage, skipping invalid rows and records already stored.
+
+    Duplicates are found by natural key (date, session, cow) against the
+    months the file touches, which are fetched once each, and within the
+    file itself. Memory is bounded by the chunk size plus eight bytes per
+    stored record of those months. progress(fraction, summary) is called
+    after every chunk. An error stops the import and is returned in
+    summary['error'], with the counts of what was stored before it.
+    """
+    summary = {'rows': 0, 'imported': 0, 'duplicates': 0, 'rejected': collections.Counter(), 'months': set()}
+    # Sorted natural-key hashes of the records stored in each month seen so far
+    known = {}
+    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    try:
+        for chunk, fraction in read_import_chunks(file, file_name, chunk_rows):
+            summary['rows'] += len(chunk)
+            frame, rejected = prepare_import_chunk(chunk, mapping, default_session, default_worker, timestamp)
+            summary['rejected'].update(rejected)
+
+            keys = milk_record_keys(frame)
+            partitions = milk_partition_keys(frame['date']).to_numpy()
+            missing = [partition for partition in pd.unique(partitions) if partition not in known]
+            if missing:
+                existing, _ = storage.fetch_milk_data(missing)
+                existing_partitions = milk_partition_keys(existing['date']).to_numpy()
+                existing_keys = milk_record_keys(existing) if len(existing) else np.array([], dtype="uint64")
+                for partition in missing:
+                    known[partition] = np.sort(existing_keys[existing_partitions == partition])
+            duplicate = pd.Series(keys).duplicated().to_numpy(copy=True)
+            for partition in pd.unique(partitions):
+                rows = partitions == partition
+                duplicate[rows] |= np.isin(keys[rows], known[partition])
+            summary['duplicates'] += int(duplicate.sum())
+
+            # Grouped by month, so each batch appends to as few monthly sheets as possible
+            order = np.argsort(partitions[~duplicate], kind="stable")
+            new = frame[~duplicate].iloc[order]
+            new_keys, new_partitions = keys[~duplicate][order], partitions[~duplicate][order]
+            for start in range(0, len(new), batch_rows):
+                records = new.iloc[start:start + batch_rows].to_dict('records')
+                with write_lock or nullcontext():
+                    storage.append_milk_data(records)
+                summary['imported'] += len(records)
+                summary['months'].update(pd.unique(new_partitions[start:start + batch_rows]))
+            for partition in pd.unique(new_partitions):
+                known[partition] = np.union1d(known[partition], new_keys[new_partitions == partition])
+            if progress:
+                progress(fraction, summary)
+    except Exception as e:
+        summary['error'] = str(e)
+    return summary
 
 # Custom CSS
 st.markdown("""
@@ -437,6 +3812,40 @@ st.markdown("""
 """, unsafe_allow_html=True)
 
 # Role Selection Page
+def select_farm():
+    """Pick this session's farm from the ?farm= link, or show the farm picker; True once a farm is chosen"""
+    if 'farm_id' in st.session_state:
+        return True
+    farms = get_farms()
+    requested = st.query_params.get("farm")
+    if requested in farms or len(farms) == 1:
+        st.session_state.farm_id = requested if requested in farms else next(iter(farms))
+        return True
+
+    st.markdown("""
+    <div class="role-selector">
+        <h1>🐄 Dairy Farm Management System</h1>
+        <p>Select your farm to continue</p>
+    </div>
+    """, unsafe_allow_html=True)
+    
+    col1, col2, col3 = st.columns([1, 2, 1])
+    
+    with col2:
+        farm_id = st.selectbox("Farm", list(farms), format_func=lambda farm_id: farms[farm_id].name)
+        if st.button("Continue", use_container_width=True, type="primary"):
+            st.session_state.farm_id = farm_id
+            # Bookmarkable link straight to this farm
+            st.query_params["farm"] = farm_id
+            st.rerun()
+    return False
+
+def switch_farm():
+    """Forget this session's farm and everything loaded for it"""
+    for key in list(st.session_state.keys()):
+        del st.session_state[key]
+    st.query_params.pop("farm", None)
+
 def show_role_selection():
     st.markdown("""
     <div class="role-selector">
@@ -448,6 +3857,12 @@ def show_role_selection():
     col1, col2, col3 = st.columns([1, 2, 1])
     
     with col2:
+        if len(get_farms()) > 1:
+            st.markdown(f"### 🏡 {current_farm().name}")
+            if st.button("🔄 Switch Farm", use_container_width=True):
+                switch_farm()
+                st.rerun()
+
         st.markdown("### Choose Your Role")
         
         col_sup, col_work = st.columns(2)
@@ -490,30 +3905,22 @@ def show_worker_selection():
             st.rerun()
 
 # Supervisor Dashboard
-def show_supervisor_dashboard():
-    st.markdown("""
-    <div class="supervisor-header">
-        <h1>👔 Supervisor Dashboard</h1>
-        <p>Manage workers, assign cows, and monitor production</p>
-    </div>
-    """, unsafe_allow_html=True)
-    
-    # Connection status
-    if st.session_state.gsheets_conn:
-        st.success("✅ Connected to Google Sheets")
-    else:
-        st.error("❌ Google Sheets connection failed - data will be stored locally only")
-    
-    # Logout button
-    if st.button("🚪 Logout", key="supervisor_logout"):
-        st.session_state.role = None
-        st.session_state.current_user = None
+def rerun_panel():
+    """Rerun just the dashboard panel after a change; a full rerun when the panel ran as part of one.
+
+    After a failed save the whole page reruns, so the unsaved-changes warning above the tabs shows.
+    """
+    if st.session_state.unsaved_reference_tables:
         st.rerun()
-    
-    # Tabs for different supervisor functions
-    tab1, tab2, tab3, tab4, tab5 = st.tabs(["👥 Manage Workers", "🐄 Assign Cows", "📊 Production Reports", "📋 Daily Records", "⚙️ System Settings"])
-    
-    with tab1:
+    try:
+        st.rerun(scope="fragment")
+    except StreamlitAPIException:
+        st.rerun()
+
+@st.fragment
+def show_manage_workers_panel():
+    """Worker list with add and remove"""
+    with get_metrics().timer("section", section="manage_workers"):
         st.subheader("Worker Management")
         
         col1, col2 = st.columns(2)
@@ -528,11 +3935,11 @@ def show_supervisor_dashboard():
                     if st.button("Remove", key=f"remove_{i}"):
                         st.session_state.workers.remove(worker)
                         # Remove cow assignments for this worker
-                        st.session_state.cow_assignments = {k: v for k, v in st.session_state.cow_assignments.items() if v != worker}
+                        st.session_state.cow_assignments.remove_worker(worker)
                         # Save to Google Sheets
                         if auto_save_workers() and auto_save_cow_assignments():
                             st.success(f"Removed {worker} successfully")
-                        st.rerun()
+                        rerun_panel()
         
         with col2:
             st.markdown("#### Add New Worker")
@@ -545,11 +3952,14 @@ def show_supervisor_dashboard():
                         st.success(f"Added {new_worker_name} as a worker")
                     else:
                         st.error("Failed to save to Google Sheets")
-                    st.rerun()
+                    rerun_panel()
                 else:
                     st.error("Worker already exists")
-    
-    with tab2:
+
+@st.fragment
+def show_cow_assignments_panel():
+    """Assign cows to workers and review assignments"""
+    with get_metrics().timer("section", section="assign_cows"):
         st.subheader("Cow Assignments")
         
         col1, col2 = st.columns(2)
@@ -576,51 +3986,53 @@ def show_supervisor_dashboard():
                     st.success(f"Assigned {len(selected_cows)} cows to {selected_worker}")
                 else:
                     st.error("Failed to save assignments to Google Sheets")
-                st.rerun()
+                rerun_panel()
         
         with col2:
             st.markdown("#### Current Assignments")
             
             if st.session_state.cow_assignments:
-                # Group assignments by worker
-                assignments_by_worker = {}
-                for cow, worker in st.session_state.cow_assignments.items():
-                    if worker not in assignments_by_worker:
-                        assignments_by_worker[worker] = []
-                    assignments_by_worker[worker].append(cow)
-                
-                for worker, cows in assignments_by_worker.items():
+                for worker, cows in list(st.session_state.cow_assignments.by_worker().items()):
                     with st.expander(f"{worker} ({len(cows)} cows)"):
                         cows_str = ", ".join([f"#{cow}" for cow in sorted(cows)])
                         st.write(cows_str)
                         
                         # Option to remove all assignments for this worker
                         if st.button(f"Remove all assignments for {worker}", key=f"remove_all_{worker}"):
-                            st.session_state.cow_assignments = {k: v for k, v in st.session_state.cow_assignments.items() if v != worker}
+                            st.session_state.cow_assignments.remove_worker(worker)
                             if auto_save_cow_assignments():
                                 st.success(f"Removed all assignments for {worker}")
-                            st.rerun()
+                            rerun_panel()
             else:
                 st.info("No cow assignments yet")
-    
-    with tab3:
+
+@st.fragment
+def show_production_reports_panel():
+    """Production totals and charts for a date range"""
+    with get_metrics().timer("section", section="production_reports"):
         st.subheader("Production Reports")
         
-        if st.session_state.milk_data:
-            df = pd.DataFrame(st.session_state.milk_data)
-            df['date'] = pd.to_datetime(df['date'])
+        col_start, col_end = st.columns(2)
+        with col_start:
+            report_start = st.date_input("From", value=date.today().replace(day=1), key="report_start")
+        with col_end:
+            report_end = st.date_input("To", value=date.today(), key="report_end")
+        # Older months come from the local archive, or are fetched when the selected range reaches them
+        summary = production_summary(report_start, report_end)
+        
+        if summary['records']:
             
             # Summary metrics
             col1, col2, col3, col4 = st.columns(4)
             
             with col1:
-                st.metric("Total Production", f"{df['milk_liters'].sum():.1f}L")
+                st.metric("Total Production", f"{summary['total']:.1f}L")
             with col2:
-                st.metric("Average per Session", f"{df['milk_liters'].mean():.1f}L")
+                st.metric("Average per Session", f"{summary['mean']:.1f}L")
             with col3:
-                st.metric("Active Cows", df['cow_number'].nunique())
+                st.metric("Active Cows", summary['active_cows'])
             with col4:
-                st.metric("Total Records", len(df))
+                st.metric("Total Records", summary['records'])
             
             # Charts
             col1, col2 = st.columns(2)
@@ -628,56 +4040,88 @@ def show_supervisor_dashboard():
             with col1:
                 # Daily production
                 st.markdown("#### Daily Production Trend")
-                daily_production = df.groupby('date')['milk_liters'].sum().reset_index()
-                daily_production['date'] = pd.to_datetime(daily_production['date'])
-                daily_production = daily_production.sort_values('date')
+                daily_production = summary['daily']
                 st.line_chart(daily_production.set_index('date')['milk_liters'])
             
             with col2:
                 # Worker performance
                 st.markdown("#### Production by Worker")
-                worker_production = df.groupby('worker')['milk_liters'].sum().reset_index()
+                worker_production = summary['by_worker']
                 st.bar_chart(worker_production.set_index('worker')['milk_liters'])
             
             # Top performing cows
             st.subheader("Top Performing Cows")
-            cow_performance = df.groupby('cow_number')['milk_liters'].agg(['sum', 'mean', 'count']).round(2)
+            cow_performance = summary['by_cow'].round(2)
             cow_performance.columns = ['Total (L)', 'Average (L)', 'Sessions']
             cow_performance = cow_performance.sort_values('Total (L)', ascending=False)
             st.dataframe(cow_performance.head(10), use_container_width=True)
             
+            st.markdown("#### Production by Session")
+            st.bar_chart(summary['by_session'].set_index('time')['milk_liters'])
+            
         else:
-            st.info("No production data available yet")
-    
-    with tab4:
+            st.info("No production data for the selected period")
+
+@st.fragment
+def show_daily_records_panel():
+    """Records of a single day"""
+    with get_metrics().timer("section", section="daily_records"):
         st.subheader("Daily Records")
         
-        if st.session_state.milk_data:
-            df = pd.DataFrame(st.session_state.milk_data)
-            
-            # Filter by date
-            selected_date = st.date_input("Select Date", value=date.today())
+        # Filter by date
+        selected_date = st.date_input("Select Date", value=date.today())
+        ensure_milk_range(selected_date, selected_date)
+        
+        daily_records = st.session_state.milk_data.date_frame(selected_date)
+        
+        if not daily_records.empty:
+            st.dataframe(daily_records[['cow_number', 'milk_liters', 'worker', 'time', 'notes']], 
+                       use_container_width=True)
             
-            daily_records = df[df['date'] == str(selected_date)]
+            # Daily summary
+            col1, col2, col3 = st.columns(3)
+            with col1:
+                st.metric("Total Milk", f"{daily_records['milk_liters'].sum():.1f}L")
+            with col2:
+                st.metric("Cows Milked", daily_records['cow_number'].nunique())
+            with col3:
+                st.metric("Sessions", len(daily_records))
             
-            if not daily_records.empty:
-                st.dataframe(daily_records[['cow_number', 'milk_liters', 'worker', 'time', 'notes']], 
-                           use_container_width=True)
-                
-                # Daily summary
-                col1, col2, col3 = st.columns(3)
-                with col1:
-                    st.metric("Total Milk", f"{daily_records['milk_liters'].sum():.1f}L")
-                with col2:
-                    st.metric("Cows Milked", daily_records['cow_number'].nunique())
-                with col3:
-                    st.metric("Sessions", len(daily_records))
-            else:
-                st.info(f"No records found for {selected_date}")
+            show_yield_alerts(daily_records, selected_date)
         else:
-            st.info("No records available")
-    
-    with tab5:
+            st.info(f"No records found for {selected_date}")
+
+def show_yield_alerts(daily_records, day):
+    """Cows well below their usual yield on a day, and the herd total against its usual"""
+    st.markdown("#### 🚨 Yield Alerts")
+    scores = session_yield_baselines(day).score(daily_records)
+    if scores['usual'].isna().all():
+        st.caption("Not enough history yet to know the usual yields")
+        return
+    # Decimal slips would swamp the herd comparison
+    known = scores[scores['usual'].notna() & (scores['flag'] != "decimal slip")]
+    if not known.empty:
+        expected = known['usual'].sum()
+        change = (known['milk_liters'].sum() - expected) / expected * 100
+        st.metric("Herd vs Usual", f"{known['milk_liters'].sum():.1f}L", f"{change:+.1f}% of {expected:.1f}L usual")
+        if change < -10:
+            st.warning(f"Herd production is {-change:.0f}% below usual — check feed, water and health across the herd")
+    drops = scores[scores['flag'] == "low"].sort_values('z')
+    if drops.empty:
+        st.success("No cow is far below her usual yield")
+    else:
+        st.dataframe(pd.DataFrame({
+            'Cow': drops['cow_number'],
+            'Session': drops['time'],
+            'Liters': drops['milk_liters'],
+            'Usual': drops['usual'].round(1),
+            'Drop': ((1 - drops['milk_liters'] / drops['usual']) * 100).round(0).astype(int).astype(str) + "%",
+        }), hide_index=True, use_container_width=True)
+
+@st.fragment
+def show_system_settings_panel():
+    """Cow count and data management"""
+    with get_metrics().timer("section", section="system_settings"):
         st.subheader("System Settings")
         
         col1, col2 = st.columns(2)
@@ -689,34 +4133,386 @@ def show_supervisor_dashboard():
             if st.button("Update Cow Count"):
                 st.session_state.cows = list(range(1, total_cows + 1))
                 # Remove assignments for cows that no longer exist
-                st.session_state.cow_assignments = {k: v for k, v in st.session_state.cow_assignments.items() if k <= total_cows}
+                st.session_state.cow_assignments.remove_cows_above(total_cows)
                 # Save to Google Sheets
                 if auto_save_system_config() and auto_save_cow_assignments():
                     st.success(f"Updated to {total_cows} cows")
                 else:
                     st.error("Failed to save changes to Google Sheets")
-                st.rerun()
+                rerun_panel()
         
         with col2:
             st.markdown("#### Data Management")
             
-            if st.session_state.milk_data:
-                csv = pd.DataFrame(st.session_state.milk_data).to_csv(index=False)
-                st.download_button(
-                    label="📄 Export All Data",
-                    data=csv,
-                    file_name=f"dairy_data_{date.today()}.csv",
-                    mime="text/csv"
-                )
+            with st.expander("📤 Export Data"):
+                show_export_panel()
             
+            if st.button("🔍 Verify Report Totals"):
+                mismatches = st.session_state.milk_data.rollup_mismatches()
+                if mismatches:
+                    st.session_state.milk_data.rebuild_rollups()
+                    st.error(f"Report totals were out of sync for {len(mismatches)} groups and have been rebuilt")
+                else:
+                    st.success("Report totals match a full recompute of the records")
+            
+            if st.button("🗄️ Refresh Report Archive"):
+                storage = st.session_state.storage
+                current_month = milk_partition(date.today())
+                try:
+                    # Versions first, then the records, so what gets archived is at least as new as its version
+                    versions = storage.milk_month_versions([m for m in storage.milk_partitions() if m < current_month])
+                    archive = get_milk_archive(storage.cache_key)
+                    archive.revalidate(versions)
+                    sync_milk_data()
+                    ensure_milk_range()
+                    written = archive.sync(st.session_state.milk_data, current_month, versions)
+                    st.success(f"Archived {len(written)} months; {len(archive.months())} closed months are archived")
+                except Exception as e:
+                    st.error(f"Failed to refresh the report archive: {e}")
+            
+            if st.button("🧹 Compact Edit Log"):
+                try:
+                    folded = get_session_write_queue().compact()
+                    st.success(f"Folded {folded} edits and deletions into the production data")
+                except Exception as e:
+                    st.error(f"Failed to compact the edit log: {e}")
+
+            if not st.session_state.storage.is_local and has_legacy_milk_sheet(st.session_state.gsheets_conn):
+                st.warning("Production data is still in the single milk_data sheet")
+                if st.button("🗂️ Split milk_data into Monthly Sheets"):
+                    try:
+                        # Hold off background saves and compaction while rows move
+                        with get_session_write_queue().write_lock:
+                            copied = migrate_milk_data_to_partitions(st.session_state.gsheets_conn)
+                        st.success(f"Copied {sum(copied.values())} records into {len(copied)} monthly sheets")
+                    except Exception as e:
+                        st.error(f"Failed to split milk_data: {e}")
+
+            with st.expander("📥 Import Production History"):
+                show_import_panel()
+
             if st.button("🗑️ Clear All Production Data"):
                 if st.checkbox("Confirm deletion"):
-                    st.session_state.milk_data = []
+                    st.session_state.milk_data.clear()
                     if auto_save_milk_data():
                         st.success("All production data cleared")
                     else:
                         st.error("Failed to clear data from Google Sheets")
-                    st.rerun()
+                    rerun_panel()
+
+@st.fragment
+def show_diagnostics_panel():
+    """Timers, queue and cache state, and metrics export"""
+    metrics = get_metrics()
+    st.subheader("Diagnostics")
+
+    if not metrics.enabled:
+        st.info("Instrumentation is turned off ([diagnostics] enabled = false)")
+
+    queue = get_session_write_queue()
+    cache = get_reference_cache()
+    lookups = cache.hits + cache.misses
+    col1, col2, col3, col4 = st.columns(4)
+    with col1:
+        st.metric("Records Waiting to Save", queue.depth())
+    with col2:
+        st.metric("Unsaved in This Session", len(st.session_state.unsaved_milk_data))
+    with col3:
+        st.metric("Reference Cache Hit Rate", f"{cache.hits / lookups:.0%}" if lookups else "–")
+    with col4:
+        st.metric("Save Failures in a Row", queue.failures)
+
+    st.markdown("#### Rerun and Section Times")
+    st.caption(f"Since {datetime.fromtimestamp(metrics.started):%Y-%m-%d %H:%M:%S}; this tab's own time is recorded after it renders")
+    timers = metrics.timer_table()
+    if timers.empty:
+        st.info("No timings recorded yet")
+    else:
+        st.dataframe(timers, use_container_width=True, hide_index=True)
+
+    if not st.session_state.storage.is_local:
+        st.markdown("#### Google Sheets Calls")
+        sheet = st.session_state.gsheets_conn
+        sheets_calls = get_sheets_client(sheet.id, sheet).metrics()
+        if sheets_calls.empty:
+            st.info("No Google Sheets calls made yet")
+        else:
+            st.dataframe(sheets_calls, use_container_width=True)
+
+    samples = diagnostics_samples()
+    col1, col2, col3 = st.columns(3)
+    with col1:
+        st.download_button("📈 Export Prometheus Text", data=format_prometheus(samples),
+                           file_name=f"dairy_metrics_{date.today()}.prom", mime="text/plain")
+    with col2:
+        st.download_button("🧾 Export JSON Lines", data=format_json_lines(samples),
+                           file_name=f"dairy_metrics_{date.today()}.jsonl", mime="application/x-ndjson")
+    with col3:
+        if st.button("♻️ Reset Timers"):
+            metrics.reset()
+            rerun_panel()
+
+def show_export_panel():
+    """Filtered export of the production records, prepared only on request"""
+    all_history = st.checkbox("All history", value=True, key="export_all_history")
+    start = end = None
+    if not all_history:
+        col_start, col_end = st.columns(2)
+        with col_start:
+            start = st.date_input("From", value=date.today().replace(day=1), key="export_start")
+        with col_end:
+            end = st.date_input("To", value=date.today(), key="export_end")
+    workers = st.multiselect("Workers (all when empty)", st.session_state.workers, key="export_workers")
+    cows = st.multiselect("Cows (all when empty)", st.session_state.cows, key="export_cows")
+    label = st.radio("Format", list(EXPORT_FORMATS), horizontal=True, key="export_format")
+    extension, mime = EXPORT_FORMATS[label]
+
+    # A prepared file is offered while the filters and this session's records are unchanged
+    store = st.session_state.milk_data
+    request = (start, end, tuple(workers), tuple(cows), extension)
+    prepared = st.session_state.get('export_prepared')
+    if prepared and (prepared['request'] != request or prepared['version'] != (id(store), store.version)):
+        prepared = None
+
+    if prepared is None and st.button("📦 Prepare Export"):
+        # Records are read from storage month by month, not loaded into this session's store
+        with st.spinner("Preparing export..."), get_metrics().timer("section", section="export"):
+            try:
+                path, rows = prepare_milk_export(st.session_state.storage, extension, start, end, workers, cows)
+            except Exception as e:
+                st.error(f"Failed to prepare the export: {e}")
+                return
+        prepared = {'request': request, 'version': (id(store), store.version), 'path': path, 'rows': rows}
+        st.session_state.export_prepared = prepared
+
+    if prepared:
+        st.caption(f"{prepared['rows']:,} records")
+        path = prepared['path']
+        st.download_button(
+            label=f"📄 Download {label}",
+            # Read from disk only when the download is clicked
+            data=lambda: read_export_file(path),
+            file_name=f"dairy_data_{date.today()}.{extension}",
+            mime=mime,
+        )
+
+def show_import_panel():
+    """Upload a CSV or Excel ledger, map its columns to milk_data and stream it into storage"""
+    uploaded = st.file_uploader("CSV or Excel file", type=["csv", "xlsx"], key="import_file")
+    if uploaded is None:
+        return
+    try:
+        preview = preview_import_file(uploaded, uploaded.name)
+    except Exception as e:
+        st.error(f"Could not read {uploaded.name}: {e}")
+        return
+    if preview.empty:
+        st.warning("The file has no data rows")
+        return
+    st.dataframe(preview, use_container_width=True, hide_index=True)
+
+    st.markdown("##### Match the file's columns")
+    headers = list(preview.columns)
+    guessed = guess_import_mapping(headers)
+    options = [None] + headers
+    mapping = {}
+    for column in IMPORT_COLUMN_ALIASES:
+        mapping[column] = st.selectbox(
+            column, options,
+            index=options.index(guessed[column]) if guessed[column] else 0,
+            format_func=lambda header: "— not in file —" if header is None else header,
+            key=f"import_map_{column}",
+        )
+    col_session, col_worker = st.columns(2)
+    with col_session:
+        default_session = st.selectbox("Session when not in file", ["Morning", "Evening"], key="import_default_session")
+    with col_worker:
+        default_worker = st.text_input("Worker when not in file", value="import", key="import_default_worker")
+
+    required = [column for column in ('date', 'cow_number', 'milk_liters') if not mapping[column]]
+    if required:
+        st.warning(f"Choose the file columns for {', '.join(required)}")
+        return
+    if not st.button("🚀 Start Import"):
+        return
+
+    storage = st.session_state.storage
+    bar = st.progress(0.0, text="Starting import...")
+
+    def progress(fraction, summary):
+        bar.progress(min(fraction, 1.0), text=f"{summary['rows']:,} rows read, {summary['imported']:,} imported, "
+                                              f"{summary['duplicates']:,} duplicates skipped")
+
+    with get_metrics().timer("section", section="import"):
+        summary = import_milk_file(storage, uploaded, uploaded.name, mapping, default_session,
+                                   default_worker.strip() or "import", progress,
+                                   write_lock=get_session_write_queue().write_lock)
+    if 'error' in summary:
+        st.error(f"Import stopped after {summary['imported']:,} imported records: {summary['error']}")
+    else:
+        bar.progress(1.0, text="Import finished")
+        st.success(f"Imported {summary['imported']:,} of {summary['rows']:,} rows; "
+                   f"{summary['duplicates']:,} were already stored")
+    for reason, count in summary['rejected'].items():
+        st.warning(f"Skipped {count:,} rows: {reason}")
+
+    # Archived months and this session's store no longer match storage
+    get_milk_archive(storage.cache_key).forget(summary['months'])
+    if summary['imported']:
+        st.session_state.pop('milk_data', None)
+        st.session_state.pop('archive_synced_version', None)
+        if not ensure_milk_data():
+            # The rest of the dashboard needs the records, the next run loads them again
+            st.stop()
+
+def show_supervisor_dashboard():
+    st.markdown("""
+    <div class="supervisor-header">
+        <h1>👔 Supervisor Dashboard</h1>
+        <p>Manage workers, assign cows, and monitor production</p>
+    </div>
+    """, unsafe_allow_html=True)
+    
+    # Connection status
+    if not st.session_state.storage.is_local:
+        st.success(f"✅ Connected to {st.session_state.storage.name}")
+    elif st.session_state.gsheets_conn:
+        st.info(f"💾 Storing data in the local {st.session_state.storage.name} database")
+    else:
+        st.error("❌ Google Sheets connection failed - data will be stored in the local database only")
+    
+    # Logout button
+    if st.button("🚪 Logout", key="supervisor_logout"):
+        st.session_state.role = None
+        st.session_state.current_user = None
+        st.rerun()
+    
+    show_unsaved_reference_tables()
+
+    # Records other sessions saved, merged before the tabs draw and then on a timer
+    show_live_sync()
+    
+    # Tabs for different supervisor functions. Only the open tab runs, and each one is a
+    # fragment, so working in one tab does not recompute the others.
+    tabs = st.tabs(["👥 Manage Workers", "🐄 Assign Cows", "📊 Production Reports", "📋 Daily Records", "⚙️ System Settings", "🩺 Diagnostics"],
+                   key="supervisor_tab", on_change="rerun")
+    panels = [show_manage_workers_panel, show_cow_assignments_panel, show_production_reports_panel,
+              show_daily_records_panel, show_system_settings_panel, show_diagnostics_panel]
+    for tab, panel in zip(tabs, panels):
+        if tab.open:
+            with tab:
+                panel()
+
+# Grid entry for workers with many cows: one data editor per page instead of one widget per cow
+BULK_ENTRY_THRESHOLD = 20
+BULK_ENTRY_PAGE_SIZE = 50
+
+def validate_bulk_entries(grid, cows_to_log):
+    """Split an edited entry grid into rows to save and rows with invalid liters
+
+    Blank or zero liters mean the cow was not milked. Cows logged since the grid
+    was drawn (for example from another device) are dropped.
+    """
+    liters = pd.to_numeric(grid['milk_liters'], errors="coerce")
+    entered = liters.notna() & (liters != 0) & grid['cow_number'].isin(cows_to_log)
+    invalid = entered & ((liters < 0) | (liters > 100))
+    entries = pd.DataFrame({
+        'cow_number': grid['cow_number'].astype(int),
+        'milk_liters': liters.round(1),
+        'notes': grid['notes'].fillna("").astype(str).str.strip(),
+    })
+    return entries[entered & ~invalid], entries[invalid]
+
+def entry_submission():
+    """Idempotency key of the entries being filled in, kept until they are saved"""
+    if 'entry_submission' not in st.session_state:
+        st.session_state.entry_submission = uuid.uuid4().hex
+    return st.session_state.entry_submission
+
+def entry_record_id(submission, record):
+    """Record id that follows the submission and the record's slot, so saving the same entry twice gives the same id"""
+    return uuid.uuid5(uuid.NAMESPACE_OID, "|".join(map(str, (submission,) + milk_entry_key(record)))).hex
+
+def save_worker_entries(store, records, confirmed=False):
+    """Add a worker's new records to the session and queue them for saving.
+
+    Unless confirmed, the batch is first checked against each cow's usual
+    yield; when any entry looks wrong it is held in pending_entries for the
+    worker to fix or confirm instead of being saved.
+    """
+    if not confirmed:
+        with get_metrics().timer("section", section="yield_check"):
+            scores = session_yield_baselines(records[0]['date']).score(pd.DataFrame(records))
+        flagged = scores[scores['flag'] != ""]
+        if len(flagged):
+            st.session_state.pending_entries = {'records': records, 'flagged': flagged}
+            st.rerun()
+    store.extend(records)
+    st.session_state.unsaved_milk_data.extend(records)
+    if auto_save_milk_data():
+        st.session_state.pop('entry_submission', None)
+        st.success(f"✅ {len(records)} रिकॉर्ड सफलतापूर्वक सेव किए गए!")
+        st.balloons()
+        st.rerun()
+    else:
+        st.error("गूगल शीट्स में सेव नहीं हो सका, लेकिन स्थानीय रूप से सेव हो गया")
+
+def bulk_entry_grid_key(cows):
+    """Widget key for the grid of a page; it follows the cows on the page so stale edits never land on the wrong row"""
+    return "bulk_entry_grid_" + hashlib.sha1(",".join(map(str, cows)).encode()).hexdigest()[:12]
+
+def show_bulk_entry_grid(store, cows_to_log, day, session, worker_name, now):
+    """Paged grid for entering many cows at once; validated and saved per page"""
+    cows = sorted(cows_to_log)
+    pages = [cows[start:start + BULK_ENTRY_PAGE_SIZE] for start in range(0, len(cows), BULK_ENTRY_PAGE_SIZE)]
+    page = 0
+    if len(pages) > 1:
+        page = st.radio(
+            "पेज",
+            range(len(pages)),
+            format_func=lambda index: f"गाय #{pages[index][0]}–{pages[index][-1]}",
+            horizontal=True,
+            key="bulk_entry_page",
+        )
+        page = min(page, len(pages) - 1)
+    page_cows = pages[page]
+
+    grid = pd.DataFrame({
+        'cow_number': page_cows,
+        'milk_liters': np.full(len(page_cows), np.nan),
+        'notes': [""] * len(page_cows),
+    })
+    with st.form("bulk_entry_form"):
+        edited = st.data_editor(
+            grid,
+            key=bulk_entry_grid_key(page_cows),
+            num_rows="fixed",
+            hide_index=True,
+            use_container_width=True,
+            disabled=['cow_number'],
+            column_config={
+                'cow_number': st.column_config.NumberColumn("गाय #", format="%d"),
+                'milk_liters': st.column_config.NumberColumn("दूध (लीटर)", min_value=0.0, max_value=100.0, step=0.1, format="%.1f"),
+                'notes': st.column_config.TextColumn("नोट", max_chars=200),
+            },
+        )
+        submitted = st.form_submit_button("🚀 इस पेज की एंट्री सेव करें", use_container_width=True)
+
+    if submitted:
+        entries, invalid = validate_bulk_entries(edited, cows_to_log)
+        if len(invalid):
+            st.error("इन गायों की मात्रा 0 से 100 लीटर के बीच होनी चाहिए: "
+                     + ", ".join(f"#{cow}" for cow in invalid['cow_number']))
+        elif entries.empty:
+            st.warning("कृपया कम से कम एक गाय के लिए दूध मात्रा दर्ज करें।")
+        else:
+            entries = entries.assign(
+                date=day, time=session, worker=worker_name,
+                timestamp=now.strftime("%Y-%m-%d %H:%M:%S"),
+            )
+            submission = entry_submission()
+            entries['record_id'] = [entry_record_id(submission, record) for record in entries.to_dict('records')]
+            save_worker_entries(store, entries[MILK_DATA_HEADERS].to_dict('records'))
 
 # Worker Dashboard
 # Enhanced Worker Dashboard Function with Hindi Translation and Edit Features
@@ -739,7 +4535,7 @@ def show_worker_dashboard():
     """, unsafe_allow_html=True)
 
     # Assigned cows
-    assigned_cows = [cow for cow, worker in st.session_state.cow_assignments.items() if worker == worker_name]
+    assigned_cows = st.session_state.cow_assignments.cows_for(worker_name)
     if not assigned_cows:
         st.warning("⚠️ अभी तक आपको कोई गाय नहीं दी गई है। कृपया अपने सुपरवाइज़र से संपर्क करें।")
         return
@@ -750,112 +4546,178 @@ def show_worker_dashboard():
     session_display = "सुबह" if session == "Morning" else "शाम"
     today_str = str(date.today())
 
+    # Saves turned away because someone else got to the cow (or the record) first
+    store = st.session_state.milk_data
+    queue = get_session_write_queue()
+    conflicts = queue.take_conflicts(st.session_state.session_id)
+    if conflicts:
+        rejected = [conflict['record']['record_id'] for conflict in conflicts if conflict['kind'] == 'record']
+        if rejected:
+            store.delete(store.row_ids_for(rejected))
+        if any(conflict['kind'] == 'event' for conflict in conflicts):
+            # This session's copy of the changed records is stale
+            del st.session_state['milk_data']
+            if not ensure_milk_data():
+                return
+            store = st.session_state.milk_data
+        st.session_state.save_conflicts = st.session_state.get('save_conflicts', []) + conflicts
+
     # Get all records for this worker, today, this session
-    session_records = [
-        record for record in st.session_state.milk_data
-        if record['date'] == today_str and record['time'] == session and record['worker'] == worker_name
-    ]
-    already_logged = set(record['cow_number'] for record in session_records)
-    cows_to_log = [cow for cow in assigned_cows if cow not in already_logged]
+    session_records = store.session_records(today_str, session, worker_name)
+    already_logged = set(record.cow_number for record in session_records)
+    try:
+        # Cows logged from another device or by another worker
+        logged_elsewhere = {cow: holder for cow, holder in queue.ledger.session_holders(today_str, session).items()
+                            if cow in assigned_cows and cow not in already_logged}
+    except Exception:
+        # Saving still checks for conflicts
+        logged_elsewhere = {}
+    cows_to_log = [cow for cow in assigned_cows if cow not in already_logged and cow not in logged_elsewhere]
 
     st.markdown(f"### {session_display} | {today_str}")
 
     # Show session total
-    total_milk = sum(record['milk_liters'] for record in session_records)
+    total_milk = sum(record.milk_liters for record in session_records)
     st.success(f"**{session_display} सत्र का कुल दूध:** {total_milk:.1f} लीटर")
 
+    if st.session_state.get('save_conflicts'):
+        lines = []
+        for conflict in st.session_state.save_conflicts:
+            record, holder = conflict['record'], conflict['holder']
+            if conflict['kind'] == 'event':
+                lines.append(f"- गाय #{record['cow_number']}: रिकॉर्ड किसी और ने इस बीच बदल दिया था, आपका बदलाव सेव नहीं हुआ")
+            else:
+                lines.append(f"- गाय #{record['cow_number']}: {holder['worker']} पहले ही {holder['milk_liters']:.1f} लीटर दर्ज कर चुके हैं, "
+                             f"आपकी {float(record['milk_liters']):.1f} लीटर की एंट्री सेव नहीं हुई")
+        st.error("⚠️ ये एंट्री सेव नहीं हुईं:\n" + "\n".join(lines))
+        if st.button("ठीक है", key="dismiss_save_conflicts"):
+            del st.session_state['save_conflicts']
+            st.rerun()
+
+    if logged_elsewhere:
+        st.caption("दूसरे डिवाइस या कामगार द्वारा पहले से दर्ज: " + ", ".join(
+            f"गाय #{cow} ({holder['worker']}, {holder['milk_liters']:.1f} लीटर)" for cow, holder in sorted(logged_elsewhere.items())))
+
     # Show already entered records with edit/delete options
     if session_records:
         st.markdown("#### दर्ज की गई एंट्री (संपादित/हटाएँ)")
-        for record in sorted(session_records, key=lambda r: r['cow_number']):
+        for record in session_records:
             col1, col2, col3 = st.columns([3, 2, 2])
             with col1:
-                st.markdown(f"**गाय #{record['cow_number']}** — {record['milk_liters']} लीटर")
+                st.markdown(f"**गाय #{record.cow_number}** — {record.milk_liters} लीटर")
             with col2:
-                if st.button("✏️ संपादित करें", key=f"edit_{record['cow_number']}"):
-                    st.session_state['edit_cow'] = record['cow_number']
+                if st.button("✏️ संपादित करें", key=f"edit_{record.cow_number}"):
+                    st.session_state['edit_cow'] = record.cow_number
             with col3:
-                if st.button("🗑️ हटाएँ", key=f"delete_{record['cow_number']}"):
-                    st.session_state.milk_data = [
-                        r for r in st.session_state.milk_data
-                        if not (r['date'] == today_str and r['time'] == session and r['worker'] == worker_name and r['cow_number'] == record['cow_number'])
-                    ]
-                    st.success(f"गाय #{record['cow_number']} की एंट्री हटा दी गई।")
+                if st.button("🗑️ हटाएँ", key=f"delete_{record.cow_number}"):
+                    store.delete([record.row_id])
+                    save_milk_event('delete', record)
+                    st.success(f"गाय #{record.cow_number} की एंट्री हटा दी गई।")
                     st.rerun()
 
     # Edit form if needed
     if 'edit_cow' in st.session_state:
         edit_cow = st.session_state['edit_cow']
-        record = next((r for r in session_records if r['cow_number'] == edit_cow), None)
+        record = next((r for r in session_records if r.cow_number == edit_cow), None)
         if record:
             st.markdown(f"#### गाय #{edit_cow} की एंट्री संपादित करें")
             with st.form(f"edit_form_{edit_cow}"):
-                new_milk = st.number_input("दूध (लीटर)", min_value=0.0, max_value=100.0, value=record['milk_liters'], step=0.1, format="%.1f")
+                new_milk = st.number_input("दूध (लीटर)", min_value=0.0, max_value=100.0, value=record.milk_liters, step=0.1, format="%.1f")
                 submitted = st.form_submit_button("✅ अपडेट करें")
                 if submitted:
-                    for r in st.session_state.milk_data:
-                        if (r['date'] == today_str and r['time'] == session and r['worker'] == worker_name and r['cow_number'] == edit_cow):
-                            r['milk_liters'] = new_milk
-                            r['timestamp'] = now.strftime("%Y-%m-%d %H:%M:%S")
+                    timestamp = now.strftime("%Y-%m-%d %H:%M:%S")
+                    store.update([record.row_id], milk_liters=new_milk, timestamp=timestamp)
+                    save_milk_event('upsert', record, milk_liters=new_milk, timestamp=timestamp)
                     st.success("रिकॉर्ड अपडेट हो गया।")
                     del st.session_state['edit_cow']
-                    auto_save_milk_data()
                     st.rerun()
             if st.button("❌ रद्द करें", key="cancel_edit"):
                 del st.session_state['edit_cow']
                 st.rerun()
 
+    # Entries held back because some yields look unusual
+    pending = st.session_state.get('pending_entries')
+    if pending:
+        flag_names = {'low': "सामान्य से बहुत कम", 'high': "सामान्य से बहुत ज़्यादा", 'decimal slip': "दशमलव की गलती?"}
+        st.warning("⚠️ इन गायों का दूध सामान्य से बहुत अलग है। कृपया मात्रा जांचें:")
+        st.dataframe(pd.DataFrame({
+            "गाय #": pending['flagged']['cow_number'],
+            "दर्ज (लीटर)": pending['flagged']['milk_liters'],
+            "सामान्य (लीटर)": pending['flagged']['usual'].round(1),
+            "कारण": pending['flagged']['flag'].map(flag_names),
+        }), hide_index=True, use_container_width=True)
+        col1, col2 = st.columns(2)
+        with col1:
+            if st.button("✅ फिर भी सेव करें", key="confirm_pending_entries", use_container_width=True):
+                del st.session_state['pending_entries']
+                # Cows logged meanwhile (for example from another device) are dropped
+                records = [record for record in pending['records'] if record['cow_number'] in cows_to_log]
+                if records:
+                    save_worker_entries(store, records, confirmed=True)
+                st.rerun()
+        with col2:
+            if st.button("✏️ नीचे ठीक करें", key="discard_pending_entries", use_container_width=True):
+                del st.session_state['pending_entries']
+                st.rerun()
+
     # Entry form for cows not yet logged
     if cows_to_log:
         st.info("केवल उन गायों के लिए दूध दर्ज करें जिनका दूध निकाला गया है।")
-        with st.form("easy_entry_form"):
-            milk_inputs = {}
-            for cow in sorted(cows_to_log):
-                milk = st.number_input(
-                    f"गाय #{cow} (लीटर)", 
-                    min_value=0.0, 
-                    max_value=100.0, 
-                    step=0.1, 
-                    format="%.1f", 
-                    key=f"milk_{cow}",
-                    help="दूध की मात्रा दर्ज करें",
-                    label_visibility="visible"
-                )
-                milk_inputs[cow] = milk
-
-            submitted = st.form_submit_button("🚀 सभी एंट्री सेव करें", use_container_width=True)
-            if submitted:
-                count = 0
-                for cow, milk in milk_inputs.items():
-                    if milk > 0:
-                        new_record = {
+        bulk_mode = st.toggle("📋 ग्रिड मोड (कई गायों के लिए)", value=len(cows_to_log) > BULK_ENTRY_THRESHOLD, key="bulk_entry_mode")
+        if bulk_mode:
+            show_bulk_entry_grid(store, cows_to_log, today_str, session, worker_name, now)
+        else:
+            with st.form("easy_entry_form"):
+                milk_inputs = {}
+                for cow in sorted(cows_to_log):
+                    milk = st.number_input(
+                        f"गाय #{cow} (लीटर)", 
+                        min_value=0.0, 
+                        max_value=100.0, 
+                        step=0.1, 
+                        format="%.1f", 
+                        key=f"milk_{cow}",
+                        help="दूध की मात्रा दर्ज करें",
+                        label_visibility="visible"
+                    )
+                    milk_inputs[cow] = milk
+
+                submitted = st.form_submit_button("🚀 सभी एंट्री सेव करें", use_container_width=True)
+                if submitted:
+                    new_records = [
+                        {
                             'date': today_str,
                             'time': session,
                             'cow_number': cow,
                             'milk_liters': milk,
                             'worker': worker_name,
                             'notes': "",
-                            'timestamp': now.strftime("%Y-%m-%d %H:%M:%S")
+                            'timestamp': now.strftime("%Y-%m-%d %H:%M:%S"),
                         }
-                        st.session_state.milk_data.append(new_record)
-                        st.session_state.unsaved_milk_data.append(new_record)
-                        count += 1
-                if count > 0:
-                    if auto_save_milk_data():
-                        st.success(f"✅ {count} रिकॉर्ड सफलतापूर्वक सेव किए गए!")
-                        st.balloons()
-                        st.rerun()
+                        for cow, milk in milk_inputs.items() if milk > 0
+                    ]
+                    submission = entry_submission()
+                    for record in new_records:
+                        record['record_id'] = entry_record_id(submission, record)
+                    if new_records:
+                        save_worker_entries(store, new_records)
                     else:
-                        st.error("गूगल शीट्स में सेव नहीं हो सका, लेकिन स्थानीय रूप से सेव हो गया")
-                else:
-                    st.warning("कृपया कम से कम एक गाय के लिए दूध मात्रा दर्ज करें।")
+                        st.warning("कृपया कम से कम एक गाय के लिए दूध मात्रा दर्ज करें।")
+
+    # Background save status
+    save_status = get_session_write_queue().session_status(st.session_state.session_id)
+    if save_status['pending'] and not save_status['last_error']:
+        st.info(f"⏳ {save_status['pending']} रिकॉर्ड पृष्ठभूमि में सेव हो रहे हैं...")
 
     # Retry unsaved data
-    if st.session_state.unsaved_milk_data:
+    if st.session_state.unsaved_milk_data or save_status['last_error']:
         st.warning("⚠️ कुछ डेटा गूगल शीट्स में सेव नहीं हो सका। कृपया कनेक्शन जांचें और फिर से प्रयास करें।")
+        if save_status['last_error']:
+            st.caption(f"{save_status['last_error']} — {save_status['retry_in']:.0f}s में फिर से प्रयास होगा")
         if st.button("🔄 फिर से सेव करें"):
-            if auto_save_milk_data():
-                st.success("✅ डेटा सफलतापूर्वक सेव हो गया!")
+            get_session_write_queue().retry_now()
+            if not st.session_state.unsaved_milk_data or auto_save_milk_data():
+                st.success("✅ डेटा सेव के लिए कतार में है!")
                 st.rerun()
             else:
                 st.error("❌ अभी भी सेव नहीं हो सका। डेटा सुरक्षित है।")
@@ -868,18 +4730,28 @@ def show_worker_dashboard():
 
 # Main Application Flow
 def main():
-    # Show role selection if no role is selected
-    if st.session_state.role is None:
-        show_role_selection()
-    elif st.session_state.role == "supervisor":
-        if not check_supervisor_password():
-            return
-        show_supervisor_dashboard()
-    elif st.session_state.role == "worker":
-        if st.session_state.current_user is None:
-            show_worker_selection()
-        else:
-            show_worker_dashboard()
+    metrics = get_metrics()
+    if not select_farm():
+        return
+    with metrics.timer("rerun", page=st.session_state.get('role') or "role_selection", farm=st.session_state.farm_id):
+        with metrics.timer("section", section="initialize_session_state"):
+            initialize_session_state()
+
+        # Show role selection if no role is selected
+        if st.session_state.role is None:
+            show_role_selection()
+        elif st.session_state.role == "supervisor":
+            if not check_supervisor_password():
+                return
+            if not ensure_milk_data():
+                return
+            show_supervisor_dashboard()
+        elif st.session_state.role == "worker":
+            if st.session_state.current_user is None:
+                show_worker_selection()
+            elif ensure_milk_data():
+                with metrics.timer("section", section="worker_form"):
+                    show_worker_dashboard()
 
 # Run the application
 if __name__ == "__main__":
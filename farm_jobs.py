@@ -0,0 +1,374 @@
+"""Headless jobs for the Dairy Farm Management System.
+
+Run with: python farm_jobs.py rollup --date 2026-10-16
+          python farm_jobs.py compact --farm north
+          python farm_jobs.py report --formats csv pdf
+          python farm_jobs.py nightly
+          python farm_jobs.py schedule --at 02:30
+
+Jobs use the app's storage backends, loaders, rollups and report archive
+with the same .streamlit/secrets.toml, so run them from the directory the
+app is started in. Each job runs for every configured farm unless --farm
+picks some, and for yesterday unless --date is given.
+
+rollup   archives closed months for the Production Reports tab and writes
+         the day's and the month-to-date summary as JSON
+compact  folds the edit/delete log into the milk records
+report   writes the day's records as CSV and a one-page summary as PDF
+nightly  all three
+schedule runs nightly every day at a fixed time, catching up on a run
+         missed while the scheduler was down
+
+Files go to [jobs] report_dir (default reports/<farm>/<date>/); report
+folders older than [jobs] keep_days (default 90) are removed.
+"""
+import argparse
+import json
+import logging
+import os
+import shutil
+import sys
+import time
+from datetime import date, datetime, timedelta
+
+import streamlit.config
+
+# Outside `streamlit run` Streamlit warns once on import and on every call that there is no script run
+streamlit.config.set_option("global.showWarningOnDirectExecution", False)
+logging.getLogger("streamlit.runtime.scriptrunner_utils.script_run_context").disabled = True
+
+import cow_milk_tracker as app
+
+log = logging.getLogger("farm_jobs")
+
+
+def open_storage(farm):
+    """The farm's storage backend, as a session of the app would pick it.
+
+    Unlike the app, a farm with a spreadsheet never falls back to its local
+    database: a job must not read or fold a stale copy, so a spreadsheet
+    that cannot be opened raises.
+    """
+    if farm.spreadsheet_id is None:
+        return app.create_storage_backend(None, farm)
+    pool = app.get_gspread_pool()
+    if pool is None:
+        raise RuntimeError(f"No Google Sheets credentials to open the spreadsheet of {farm.farm_id}")
+    return app.create_storage_backend(pool.open(farm.spreadsheet_id), farm)
+
+
+def report_dir(farm, day):
+    path = os.path.join(app.get_app_setting("jobs", "report_dir", "reports"), farm.farm_id, str(day))
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def summary_json(rollups):
+    """Rollups summary as plain JSON values"""
+    summary = rollups.summary()
+    by_cow = summary['by_cow'].sort_values('sum')
+    return {
+        'total_liters': round(summary['total'], 1),
+        'records': summary['records'],
+        'active_cows': summary['active_cows'],
+        'mean_liters': round(summary['mean'], 2),
+        'by_session': {row.time: round(row.milk_liters, 1) for row in summary['by_session'].itertuples()},
+        'by_worker': {row.worker: round(row.milk_liters, 1) for row in summary['by_worker'].itertuples()},
+        'lowest_cows': {int(cow): round(liters, 1) for cow, liters in by_cow['sum'].head(5).items()},
+        'highest_cows': {int(cow): round(liters, 1) for cow, liters in by_cow['sum'].tail(5).items()},
+    }
+
+
+def run_rollup(farm, storage, day):
+    """Archive closed months and write the day's and month-to-date summaries; returns the summary file"""
+    archive = app.get_milk_archive(storage.cache_key)
+    current_month = app.milk_partition(date.today())
+    # Recently closed months may still get late entries and edits, so they are archived again
+    recent = app.milk_partitions_between(date.today() - timedelta(days=31), date.today())
+    stored = storage.milk_partitions()
+    # Read before the records, so what gets archived is at least as new as its version
+    versions = storage.milk_month_versions([month for month in stored if month < current_month])
+    stale = archive.revalidate(versions)
+    if stale:
+        log.info("%s: %s changed in storage since they were archived", farm.farm_id, ", ".join(stale))
+    months = [month for month in stored
+              if month in recent or month == app.milk_partition(day) or not archive.has(month)]
+    store, rejected = app.load_milk_store(storage, months)
+    if rejected:
+        log.warning("%s: skipped %d invalid milk rows %s", farm.farm_id, sum(rejected.values()), rejected)
+    archived = archive.sync(store, current_month, versions)
+
+    month_start = day.replace(day=1)
+    summary = {
+        'farm': farm.farm_id,
+        'date': str(day),
+        'generated_at': datetime.now().isoformat(timespec="seconds"),
+        'archived_months': archived,
+        'day': summary_json(app.production_rollups(store, archive, day, day)),
+        'month_to_date': summary_json(app.production_rollups(store, archive, month_start, day)),
+    }
+    path = os.path.join(report_dir(farm, day), f"summary_{day}.json")
+    with open(path + ".tmp", "w", encoding="utf-8") as f:
+        json.dump(summary, f, indent=2)
+    os.replace(path + ".tmp", path)
+    log.info("%s: archived %s, %.1fL on %s", farm.farm_id, archived or "nothing new", summary['day']['total_liters'], day)
+    return path
+
+
+def run_compact(farm, storage, day):
+    """Fold the edit/delete log into the milk records.
+
+    The app's write-behind queue takes the same lock for every flush, so
+    records it saves meanwhile wait for the compaction instead of racing it.
+    """
+    with app.storage_write_lock(storage.cache_key):
+        folded = storage.compact_milk_data()
+    log.info("%s: folded %d edits and deletions", farm.farm_id, folded)
+    return folded
+
+
+def pdf_text(text):
+    """A PDF string literal for text in the standard Latin-1 fonts"""
+    text = text.encode("latin-1", "replace").decode("latin-1")
+    return "(" + text.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)") + ")"
+
+
+def write_text_pdf(path, lines, lines_per_page=64):
+    """Write lines of monospaced text as an A4 PDF, without a PDF library"""
+    pages = [lines[start:start + lines_per_page] for start in range(0, max(len(lines), 1), lines_per_page)]
+    # Objects 1-3 are the catalog, the page tree and the font; each page adds its page and content stream
+    objects = [b"<< /Type /Catalog /Pages 2 0 R >>", b"", b"<< /Type /Font /Subtype /Type1 /BaseFont /Courier >>"]
+    kids = []
+    for page in pages:
+        stream = ("BT /F1 9 Tf 12 TL 40 810 Td " + " ".join(pdf_text(line) + " '" for line in page) + " ET").encode("latin-1")
+        objects.append(b"<< /Length %d >>\nstream\n%s\nendstream" % (len(stream), stream))
+        objects.append(("<< /Type /Page /Parent 2 0 R /MediaBox [0 0 595 842] /Contents %d 0 R "
+                        "/Resources << /Font << /F1 3 0 R >> >> >>" % len(objects)).encode())
+        kids.append(len(objects))
+    objects[1] = ("<< /Type /Pages /Kids [%s] /Count %d >>" % (" ".join(f"{kid} 0 R" for kid in kids), len(kids))).encode()
+
+    output = bytearray(b"%PDF-1.4\n")
+    offsets = []
+    for number, body in enumerate(objects, 1):
+        offsets.append(len(output))
+        output += b"%d 0 obj\n%s\nendobj\n" % (number, body)
+    xref = len(output)
+    output += b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1)
+    output += b"".join(b"%010d 00000 n \n" % offset for offset in offsets)
+    output += b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(objects) + 1, xref)
+    with open(path + ".tmp", "wb") as f:
+        f.write(output)
+    os.replace(path + ".tmp", path)
+
+
+def daily_report_lines(farm, day, records, baselines):
+    """Text of the daily report: totals, workers, yield alerts and every record"""
+    scores = baselines.score(records)
+    # Decimal slips would swamp the herd comparison
+    known = scores[scores['usual'].notna() & (scores['flag'] != "decimal slip")]
+    lines = [
+        f"{farm.name} - daily production report - {day}",
+        "",
+        f"Total milk   {records['milk_liters'].sum():8.1f} L",
+        f"Cows milked  {records['cow_number'].nunique():8d}",
+        f"Records      {len(records):8d}",
+    ]
+    if not known.empty:
+        expected = known['usual'].sum()
+        lines.append(f"vs usual     {(known['milk_liters'].sum() - expected) / expected * 100:+7.1f} %")
+    lines += ["", "Session     Liters"]
+    for session, liters in records.groupby('time', observed=True)['milk_liters'].sum().items():
+        lines.append(f"{session:<10} {liters:7.1f}")
+    lines += ["", "Worker                 Liters  Cows"]
+    for worker, group in records.groupby('worker', observed=True):
+        lines.append(f"{worker[:22]:<22} {group['milk_liters'].sum():6.1f}  {group['cow_number'].nunique():4d}")
+
+    flagged = scores[scores['flag'] != ""].sort_values('z')
+    lines += ["", "Yield alerts (cow far from her usual yield)"]
+    if flagged.empty:
+        lines.append("none")
+    else:
+        lines.append("Cow   Session   Liters  Usual  Flag")
+        for row in flagged.itertuples():
+            lines.append(f"{row.cow_number:<5} {row.time:<9} {row.milk_liters:6.1f} {row.usual:6.1f}  {row.flag}")
+
+    lines += ["", "Cow   Session   Liters  Worker                 Notes"]
+    for row in records.sort_values(['time', 'cow_number']).itertuples():
+        lines.append(f"{row.cow_number:<5} {row.time:<9} {row.milk_liters:6.1f}  {row.worker[:22]:<22} {row.notes[:30]}")
+    return lines
+
+
+def run_report(farm, storage, day, formats=("csv", "pdf")):
+    """Write the day's records as CSV and a summary as PDF; returns the files written"""
+    baseline_start = day - timedelta(days=app.BASELINE_DAYS)
+    store, _ = app.load_milk_store(storage, app.milk_partitions_between(baseline_start, day))
+    records = store.select(day, day)
+    directory = report_dir(farm, day)
+    written = []
+    if "csv" in formats:
+        path = os.path.join(directory, f"milk_{day}.csv")
+        app.write_milk_export(store.export_chunks(records, app.EXPORT_CHUNK_ROWS), path, "csv")
+        written.append(path)
+    if "pdf" in formats:
+        path = os.path.join(directory, f"report_{day}.pdf")
+        baselines = app.build_yield_baselines(store.select(baseline_start, day - timedelta(days=1)))
+        write_text_pdf(path, daily_report_lines(farm, day, records, baselines))
+        written.append(path)
+    log.info("%s: %d records on %s, wrote %s", farm.farm_id, len(records), day, ", ".join(written))
+    return written
+
+
+def prune_reports(farm):
+    """Remove report folders older than [jobs] keep_days"""
+    keep_days = int(app.get_app_setting("jobs", "keep_days", 90))
+    root = os.path.join(app.get_app_setting("jobs", "report_dir", "reports"), farm.farm_id)
+    cutoff = date.today() - timedelta(days=keep_days)
+    for name in sorted(os.listdir(root)) if os.path.isdir(root) else []:
+        try:
+            folder_day = date.fromisoformat(name)
+        except ValueError:
+            continue
+        if folder_day < cutoff:
+            shutil.rmtree(os.path.join(root, name), ignore_errors=True)
+
+
+JOBS = {
+    'rollup': run_rollup,
+    'compact': run_compact,
+    'report': run_report,
+}
+
+
+def run_jobs(names, farm_ids=None, day=None, formats=("csv", "pdf")):
+    """Run jobs for each farm in turn; returns True when every job succeeded.
+
+    A failing job, or a farm whose storage cannot be opened, is logged and
+    does not stop the other jobs or farms.
+    """
+    farms = app.get_farms()
+    unknown = set(farm_ids or ()) - set(farms)
+    if unknown:
+        log.error("Unknown farm %s, configured: %s", ", ".join(sorted(unknown)), ", ".join(farms))
+        return False
+    day = day or date.today() - timedelta(days=1)
+    ok = True
+    for farm_id, farm in farms.items():
+        if farm_ids and farm_id not in farm_ids:
+            continue
+        try:
+            storage = open_storage(farm)
+        except Exception:
+            ok = False
+            log.exception("%s: could not open storage, skipped %s", farm_id, ", ".join(names))
+            continue
+        for name in names:
+            start = time.perf_counter()
+            try:
+                with app.get_metrics().timer("job", job=name):
+                    if name == "report":
+                        run_report(farm, storage, day, formats)
+                    else:
+                        JOBS[name](farm, storage, day)
+            except Exception:
+                ok = False
+                log.exception("%s: %s failed", farm_id, name)
+            else:
+                log.info("%s: %s took %.1fs", farm_id, name, time.perf_counter() - start)
+        prune_reports(farm)
+    return ok
+
+
+class DailyScheduler:
+    """Runs a task once a day at a fixed local time.
+
+    The day of the last run is kept in a small state file, so a run missed
+    while the scheduler was stopped happens as soon as it starts again, and
+    a restart on the same day does not run the task twice.
+    """
+
+    def __init__(self, at, task, state_path):
+        self.at = datetime.strptime(at, "%H:%M").time()
+        self.task = task
+        self.state_path = state_path
+
+    def last_run(self):
+        try:
+            with open(self.state_path, encoding="utf-8") as f:
+                return date.fromisoformat(json.load(f)['last_run'])
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def _save(self, day):
+        with open(self.state_path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump({'last_run': str(day)}, f)
+        os.replace(self.state_path + ".tmp", self.state_path)
+
+    def _latest_day(self, now):
+        """Day of the most recent scheduled time at or before now"""
+        return now.date() if now.time() >= self.at else now.date() - timedelta(days=1)
+
+    def due(self, now):
+        """Whether today's run is due (or an earlier one was missed)"""
+        last = self.last_run()
+        if last is None:
+            return now.time() >= self.at
+        return last < self._latest_day(now)
+
+    def next_run(self, now):
+        scheduled = datetime.combine(now.date(), self.at)
+        if self.due(now):
+            return now
+        if scheduled <= now:
+            scheduled += timedelta(days=1)
+        return scheduled
+
+    def run_pending(self, now=None):
+        """Run the task if it is due; returns True when it ran"""
+        now = now or datetime.now()
+        if not self.due(now):
+            return False
+        self.task()
+        # A missed run caught up before today's time still leaves today's run due
+        self._save(self._latest_day(now))
+        return True
+
+    def run_forever(self, max_sleep=300):
+        # Sleep in short steps so clock changes (and suspended machines) are noticed
+        while True:
+            self.run_pending()
+            wait = (self.next_run(datetime.now()) - datetime.now()).total_seconds()
+            time.sleep(min(max(wait, 1), max_sleep))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    subparsers = parser.add_subparsers(dest="job", required=True)
+    for name, help_text in [("rollup", "archive closed months and write the day's summary"),
+                            ("compact", "fold the edit/delete log into the milk records"),
+                            ("report", "write the day's CSV and PDF report"),
+                            ("nightly", "rollup, compact and report")]:
+        job = subparsers.add_parser(name, help=help_text)
+        job.add_argument("--farm", nargs="+", help="farm ids (default: every farm)")
+        job.add_argument("--date", type=date.fromisoformat, help="day to summarize and report (default: yesterday)")
+        job.add_argument("--formats", nargs="+", choices=["csv", "pdf"], default=["csv", "pdf"])
+    schedule = subparsers.add_parser("schedule", help="run nightly every day at a fixed time")
+    schedule.add_argument("--at", default=app.get_app_setting("jobs", "nightly_at", "02:30"), help="local time, HH:MM")
+    schedule.add_argument("--farm", nargs="+", help="farm ids (default: every farm)")
+    schedule.add_argument("--formats", nargs="+", choices=["csv", "pdf"], default=["csv", "pdf"])
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+
+    nightly = ["rollup", "compact", "report"]
+    if args.job == "schedule":
+        state_dir = app.get_app_setting("jobs", "report_dir", "reports")
+        os.makedirs(state_dir, exist_ok=True)
+        scheduler = DailyScheduler(args.at, lambda: run_jobs(nightly, args.farm, formats=args.formats),
+                                   os.path.join(state_dir, "schedule_state.json"))
+        log.info("Running nightly jobs every day at %s, next at %s", args.at, scheduler.next_run(datetime.now()))
+        scheduler.run_forever()
+    names = nightly if args.job == "nightly" else [args.job]
+    sys.exit(0 if run_jobs(names, args.farm, args.date, args.formats) else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,43 @@
+"""Shared fixtures: the app imported in bare mode and an in-memory fake of the Sheets API."""
+import logging
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import streamlit as st
+import streamlit.config
+
+# Outside `streamlit run` Streamlit warns once on import and on every call that there is no script run
+streamlit.config.set_option("global.showWarningOnDirectExecution", False)
+logging.getLogger("streamlit.runtime.scriptrunner_utils.script_run_context").disabled = True
+
+import cow_milk_tracker as app
+from benchmark import FakeSpreadsheet
+
+
+@pytest.fixture(autouse=True)
+def fresh_resources():
+    """Process-wide caches (Sheets clients, header and snapshot caches) start empty in every test"""
+    st.cache_resource.clear()
+    yield
+    st.cache_resource.clear()
+
+
+@pytest.fixture
+def spreadsheet():
+    return FakeSpreadsheet("test")
+
+
+@pytest.fixture
+def sqlite(tmp_path):
+    return app.SQLiteBackend(str(tmp_path / "farm.db"))
+
+
+def milk_record(day, cow, liters, session="Morning", worker="John Doe", **fields):
+    record = {"date": day, "time": session, "cow_number": cow, "milk_liters": liters, "worker": worker,
+              "notes": "", "timestamp": f"{day} 06:00:00", "record_id": f"{day}-{session}-{cow}"}
+    record.update(fields)
+    return record
@@ -0,0 +1,49 @@
+import pytest
+
+import cow_milk_tracker as app
+from conftest import milk_record
+
+
+@pytest.fixture
+def sqlite(sqlite):
+    sqlite.append_milk_data([milk_record("2026-08-10", cow, 9.0) for cow in (1, 2)]
+                            + [milk_record("2026-09-10", cow, 8.0) for cow in (1, 2)])
+    return sqlite
+
+
+def archived_store(storage, archive):
+    months = ["2026_08", "2026_09"]
+    versions = storage.milk_month_versions(months)
+    store, _ = app.load_milk_store(storage, months)
+    assert archive.sync(store, "2026_10", versions) == months
+    return versions
+
+
+def test_month_changed_in_storage_is_dropped_from_the_archive(sqlite, tmp_path):
+    archive = app.MilkArchive(str(tmp_path / "archive"))
+    archived_store(sqlite, archive)
+
+    sqlite.append_milk_events([dict(milk_record("2026-09-10", 1, 8.0), event="upsert", event_id="e1",
+                                    milk_liters=11.0, timestamp="2026-10-01 08:00:00")])
+
+    assert archive.revalidate(sqlite.milk_month_versions(["2026_08", "2026_09"])) == ["2026_09"]
+    assert archive.months() == ["2026_08"]
+
+
+def test_versions_survive_compaction_of_unchanged_months(sqlite, tmp_path):
+    before = sqlite.milk_month_versions(["2026_08"])
+    sqlite.append_milk_events([dict(milk_record("2026-09-10", 1, 8.0), event="delete", event_id="e1",
+                                    timestamp="2026-10-01 08:00:00")])
+
+    sqlite.compact_milk_data()
+
+    assert sqlite.milk_month_versions(["2026_08"]) == before
+
+
+def test_manifest_written_by_another_process_is_read_again(sqlite, tmp_path):
+    directory = str(tmp_path / "archive")
+    reader = app.MilkArchive(directory)
+    versions = archived_store(sqlite, app.MilkArchive(directory))
+
+    assert reader.revalidate(versions) == []
+    assert reader.months() == ["2026_08", "2026_09"]
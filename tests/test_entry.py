@@ -0,0 +1,23 @@
+import pandas as pd
+
+import cow_milk_tracker as app
+
+
+def test_bulk_grid_keeps_entered_cows_and_reports_invalid_liters():
+    grid = pd.DataFrame({
+        'cow_number': [1, 2, 3, 4, 5, 6],
+        'milk_liters': [9.04, None, 0, -2, 140, 8.0],
+        'notes': [" calm ", None, "", "", "", "sold"],
+    })
+
+    entries, invalid = app.validate_bulk_entries(grid, cows_to_log=[1, 2, 3, 4, 5])
+
+    # Blank and zero mean not milked; cow 6 was logged from another device meanwhile
+    assert entries.to_dict('records') == [{'cow_number': 1, 'milk_liters': 9.0, 'notes': "calm"}]
+    assert invalid['cow_number'].tolist() == [4, 5]
+
+
+def test_grid_key_follows_the_cows_on_the_page():
+    assert app.bulk_entry_grid_key([1, 2, 3]) == app.bulk_entry_grid_key([1, 2, 3])
+    assert app.bulk_entry_grid_key([1, 2, 3]) != app.bulk_entry_grid_key([51, 52, 53])
+
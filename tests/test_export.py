@@ -0,0 +1,62 @@
+import os
+from datetime import date
+
+import pandas as pd
+import pytest
+
+import cow_milk_tracker as app
+from conftest import milk_record
+
+
+@pytest.fixture
+def sqlite(sqlite, tmp_path, monkeypatch):
+    monkeypatch.setattr(app.st, "secrets", {"storage": {"export_dir": str(tmp_path / "exports")}})
+    sqlite.append_milk_data([milk_record("2026-08-10", cow, 9.0) for cow in (1, 2)]
+                            + [milk_record("2026-09-10", cow, 8.0, worker="Jane") for cow in (1, 2)])
+    return sqlite
+
+
+def test_export_reads_only_the_months_of_its_range(sqlite, monkeypatch):
+    fetched = []
+    fetch = sqlite.fetch_milk_data
+    monkeypatch.setattr(sqlite, "fetch_milk_data", lambda partitions=None: fetched.append(partitions) or fetch(partitions))
+
+    path, rows = app.prepare_milk_export(sqlite, "csv", date(2026, 9, 1), date(2026, 9, 30))
+
+    assert rows == 2
+    assert fetched == [["2026_09"]]
+    exported = pd.read_csv(path)
+    assert exported['date'].tolist() == ["2026-09-10", "2026-09-10"]
+    assert exported['worker'].tolist() == ["Jane", "Jane"]
+
+
+def test_repeated_export_is_served_without_loading_records(sqlite, monkeypatch):
+    first = app.prepare_milk_export(sqlite, "parquet", workers=["John Doe"])
+
+    def no_fetch(partitions=None):
+        raise AssertionError("records were loaded for an unchanged export")
+
+    monkeypatch.setattr(sqlite, "fetch_milk_data", no_fetch)
+    assert app.prepare_milk_export(sqlite, "parquet", workers=["John Doe"]) == first
+    assert first[1] == 2
+
+
+def test_stored_change_writes_a_new_export(sqlite):
+    path, _ = app.prepare_milk_export(sqlite, "csv")
+    sqlite.append_milk_events([dict(milk_record("2026-08-10", 1, 9.0), event="delete", event_id="e1",
+                                    timestamp="2026-10-01 08:00:00")])
+
+    new_path, rows = app.prepare_milk_export(sqlite, "csv")
+
+    assert new_path != path
+    assert rows == 3
+    assert len(pd.read_csv(new_path)) == 3
+
+
+def test_oversized_excel_export_leaves_no_file(sqlite, tmp_path, monkeypatch):
+    monkeypatch.setattr(app, "EXCEL_MAX_ROWS", 3)
+
+    with pytest.raises(ValueError, match="Excel"):
+        app.prepare_milk_export(sqlite, "xlsx")
+
+    assert [name for _, _, names in os.walk(tmp_path / "exports") for name in names] == []
@@ -0,0 +1,99 @@
+import os
+
+import pytest
+from streamlit.testing.v1 import AppTest
+
+import cow_milk_tracker as app
+
+APP_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "cow_milk_tracker.py")
+FARMS = {
+    "north": {"name": "North", "supervisor_password": "1111"},
+    "south": {"name": "South", "supervisor_password": "2222"},
+    "west": {"name": "West"},
+}
+
+
+def test_supervisor_passwords_come_from_each_farms_section(monkeypatch):
+    monkeypatch.setattr(app.st, "secrets", {"farms": FARMS})
+
+    farms = app.get_farms()
+
+    assert farms["north"].supervisor_password_matches("1111")
+    assert not farms["north"].supervisor_password_matches("2222")
+    assert not farms["west"].supervisor_password_matches("")
+    assert not farms["west"].supervisor_password_matches(None)
+
+
+def test_single_farm_deployment_reads_the_supervisor_section(monkeypatch):
+    monkeypatch.setattr(app.st, "secrets", {"supervisor": {"password": "9999"}})
+
+    farm = app.get_farms()["default"]
+
+    assert farm.supervisor_password_matches("9999")
+    assert not farm.supervisor_password_matches("7441")
+
+
+def test_single_farm_without_a_supervisor_password_has_no_supervisor_access(monkeypatch):
+    monkeypatch.setattr(app.st, "secrets", {})
+
+    farm = app.get_farms()["default"]
+
+    assert farm.supervisor_password is None
+    assert not farm.supervisor_password_matches("7441")
+
+
+@pytest.fixture
+def supervisor_login(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+
+    def login(farm_id, password):
+        at = AppTest.from_file(APP_PATH, default_timeout=60)
+        at.secrets["farms"] = FARMS
+        at.session_state["farm_id"] = farm_id
+        at.session_state["role"] = "supervisor"
+        at.run()
+        at.text_input(key="supervisor_password_input").input(password)
+        submit = [button for button in at.button if button.label == "Submit Password"]
+        if submit:
+            submit[0].click()
+        at.run()
+        return at
+
+    return login
+
+
+def test_supervisor_access_is_checked_against_the_selected_farm(supervisor_login):
+    assert supervisor_login("north", "1111").session_state["supervisor_password_correct"] == "north"
+
+    denied = supervisor_login("north", "2222")
+    assert "supervisor_password_correct" not in denied.session_state
+    assert any("Incorrect" in error.value for error in denied.error)
+
+    unset = supervisor_login("west", "")
+    assert any("No supervisor password" in error.value for error in unset.error)
+
+
+def test_farms_share_process_resources_and_keep_their_data_apart(tmp_path, monkeypatch):
+    farms = {farm_id: dict(section, sqlite_path=str(tmp_path / f"{farm_id}.db")) for farm_id, section in FARMS.items()}
+    monkeypatch.setattr(app.st, "secrets", {"farms": farms})
+    north, south = (app.create_storage_backend(None, app.get_farms()[farm_id]) for farm_id in ("north", "south"))
+    north.save_workers(["Ann"])
+    north.append_milk_data([{"date": "2026-10-17", "time": "Morning", "cow_number": 1, "milk_liters": 9.0,
+                             "worker": "Ann", "notes": "", "timestamp": "", "record_id": "a"}])
+
+    cache = app.get_reference_cache()
+    assert cache.get(north, "workers", north.load_workers)[0] == ["Ann"]
+    assert cache.get(south, "workers", south.load_workers)[0] == app.DEFAULT_WORKERS
+    assert len(north.fetch_milk_data()[0]) == 1 and south.fetch_milk_data()[0].empty
+    # One reference cache however many farms the process serves, but load slots per farm
+    assert app.get_reference_cache() is cache
+    assert app.get_farms()["north"].load_slots is not app.get_farms()["south"].load_slots
+
+
+def test_only_the_open_supervisor_tab_runs(supervisor_login):
+    at = supervisor_login("north", "1111")
+    assert [header.value for header in at.subheader] == ["Worker Management"]
+
+    at.session_state["supervisor_tab"] = "🩺 Diagnostics"
+    at.run()
+    assert [header.value for header in at.subheader] == ["Diagnostics"]
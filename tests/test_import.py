@@ -0,0 +1,68 @@
+import io
+
+import openpyxl
+import pytest
+
+import cow_milk_tracker as app
+from conftest import milk_record
+
+LEDGER = """Date,Shift,Cow No,Litres,Milker,Remarks
+2026-09-30,AM,1,9.5,Ann,
+2026-09-30,PM,1,8.0,,late
+2026-10-01,m,2,7.5,Ann,
+2026-10-01,Morning,2,7.5,Ann,typed twice
+2026-10-01,night,3,6.0,Ann,
+2026-10-02,Evening,4,lots,Ann,
+2026-10-02,Evening,5,6.5,Ann,
+"""
+
+
+@pytest.fixture
+def sqlite(sqlite):
+    sqlite.append_milk_data([milk_record("2026-10-02", 5, 6.5, session="Evening")])
+    return sqlite
+
+
+def import_ledger(storage, data, file_name="ledger.csv"):
+    headers = next(app.read_import_chunks(io.BytesIO(data), file_name, 1))[0].columns
+    mapping = app.guess_import_mapping(headers)
+    return app.import_milk_file(storage, io.BytesIO(data), file_name, mapping, chunk_rows=3, batch_rows=2)
+
+
+def test_columns_are_matched_by_their_usual_names():
+    mapping = app.guess_import_mapping(["Date", "Shift", "Cow No", "Litres", "Milker", "Remarks"])
+
+    assert mapping == {'date': "Date", 'time': "Shift", 'cow_number': "Cow No", 'milk_liters': "Litres",
+                       'worker': "Milker", 'notes': "Remarks"}
+
+
+def test_import_skips_invalid_rows_and_records_already_stored(sqlite):
+    summary = import_ledger(sqlite, LEDGER.encode())
+
+    assert 'error' not in summary
+    assert (summary['rows'], summary['imported'], summary['duplicates']) == (7, 3, 2)
+    assert sum(summary['rejected'].values()) == 2
+    stored = sqlite.fetch_milk_data()[0].sort_values(['date', 'time', 'cow_number'])
+    assert stored[['cow_number', 'time', 'worker']].values.tolist() == [
+        [1, "Evening", "import"], [1, "Morning", "Ann"], [2, "Morning", "Ann"], [5, "Evening", "John Doe"]]
+
+
+def test_importing_a_file_again_stores_nothing_new(sqlite):
+    import_ledger(sqlite, LEDGER.encode())
+
+    summary = import_ledger(sqlite, LEDGER.encode())
+
+    assert (summary['imported'], summary['duplicates']) == (0, 5)
+    assert len(sqlite.fetch_milk_data()[0]) == 4
+
+
+def test_excel_ledgers_are_streamed_like_csv(sqlite):
+    workbook = openpyxl.Workbook()
+    for line in LEDGER.splitlines():
+        workbook.active.append(line.split(","))
+    data = io.BytesIO()
+    workbook.save(data)
+
+    summary = import_ledger(sqlite, data.getvalue(), "ledger.xlsx")
+
+    assert (summary['rows'], summary['imported'], summary['duplicates']) == (7, 3, 2)
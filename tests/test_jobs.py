@@ -0,0 +1,104 @@
+import time
+from datetime import date, datetime
+from types import SimpleNamespace
+
+import pytest
+
+import cow_milk_tracker as app
+import farm_jobs
+from conftest import milk_record
+
+
+@pytest.fixture
+def scheduler(tmp_path):
+    runs = []
+    return farm_jobs.DailyScheduler("02:30", lambda: runs.append(1), str(tmp_path / "state.json")), runs
+
+
+def test_first_run_waits_for_the_scheduled_time(scheduler):
+    scheduler, _ = scheduler
+
+    assert not scheduler.due(datetime(2026, 10, 17, 2, 29))
+    assert scheduler.due(datetime(2026, 10, 17, 2, 30))
+
+
+def test_run_is_due_once_a_day(scheduler):
+    scheduler, runs = scheduler
+
+    assert scheduler.run_pending(datetime(2026, 10, 17, 2, 31))
+    assert not scheduler.due(datetime(2026, 10, 17, 23, 59))
+    assert not scheduler.due(datetime(2026, 10, 18, 2, 29))
+    assert scheduler.due(datetime(2026, 10, 18, 2, 30))
+    assert runs == [1]
+
+
+def test_missed_run_is_caught_up_at_start_without_skipping_todays(scheduler):
+    scheduler, runs = scheduler
+    scheduler._save(date(2026, 10, 15))
+
+    # Stopped through the run of the 16th, started again early on the 17th
+    assert scheduler.due(datetime(2026, 10, 17, 1, 0))
+    assert scheduler.run_pending(datetime(2026, 10, 17, 1, 0))
+    assert not scheduler.due(datetime(2026, 10, 17, 2, 0))
+    assert scheduler.due(datetime(2026, 10, 17, 2, 30))
+    assert runs == [1]
+
+
+def test_farm_with_a_spreadsheet_does_not_fall_back_to_its_database(tmp_path, monkeypatch):
+    monkeypatch.setattr(app, "get_gspread_pool", lambda: None)
+    farm = app.Farm("north", "North", "sheet-id", str(tmp_path / "north.db"), 60, 60)
+
+    with pytest.raises(RuntimeError, match="north"):
+        farm_jobs.open_storage(farm)
+
+
+def test_farm_whose_storage_cannot_open_does_not_stop_the_others(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(app.st, "secrets", {"farms": {
+        "north": {"spreadsheet": "sheet-id", "sqlite_path": str(tmp_path / "north.db")},
+        "south": {"sqlite_path": str(tmp_path / "south.db")},
+    }})
+    monkeypatch.setattr(app, "get_gspread_pool", lambda: None)
+    south = app.create_storage_backend(None, app.get_farms()["south"])
+    south.append_milk_data([milk_record("2026-10-16", 1, 9.0)])
+    south.append_milk_events([dict(milk_record("2026-10-16", 1, 9.0), event="delete", event_id="e1")])
+
+    assert not farm_jobs.run_jobs(["compact"], day=date(2026, 10, 16))
+    assert south.fetch_milk_data()[0].empty
+    assert south.compact_milk_data() == 0
+
+
+def test_nightly_compaction_waits_for_the_apps_writes_and_keeps_them(spreadsheet, tmp_path, monkeypatch):
+    monkeypatch.setattr(app.st, "secrets", {"storage": {"journal_dir": str(tmp_path / "journal")},
+                                            "farms": {"north": {"spreadsheet": spreadsheet.id}}})
+    monkeypatch.setattr(app, "get_gspread_pool", lambda: SimpleNamespace(open=lambda spreadsheet_id: spreadsheet))
+    monkeypatch.chdir(tmp_path)
+    # The app's own backend and write-behind queue, as in the server process
+    storage = app.GoogleSheetsBackend(spreadsheet)
+    record = milk_record("2026-10-16", 1, 9.0)
+    storage.append_milk_data([record])
+    storage.append_milk_events([dict(record, event="upsert", event_id="e1", milk_liters=11.0,
+                                     timestamp="2026-10-16 07:00:00")])
+    queue = app.WriteBehindQueue(storage, app.storage_journal_path(storage.cache_key, "jsonl"), coalesce_seconds=0,
+                                 lock_path=app.storage_journal_path(storage.cache_key, "lock"))
+    fold_milk_rows = app.fold_milk_rows
+    waiting = []
+
+    def save_while_folding(*args):
+        assert queue.submit("s1", [milk_record("2026-10-16", 2, 8.0)])
+        time.sleep(0.3)
+        # The queue's flush waits for the job's lock
+        waiting.append(queue.depth())
+        return fold_milk_rows(*args)
+
+    monkeypatch.setattr(app, "fold_milk_rows", save_while_folding)
+    assert farm_jobs.run_jobs(["compact"], day=date(2026, 10, 16))
+    monkeypatch.setattr(app, "fold_milk_rows", fold_milk_rows)
+
+    deadline = time.monotonic() + 10
+    while queue.depth():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.01)
+    assert waiting == [1]
+    frame, _ = storage.fetch_milk_data()
+    assert sorted(zip(frame['cow_number'], frame['milk_liters'])) == [(1, 11.0), (2, 8.0)]
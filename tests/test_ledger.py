@@ -0,0 +1,57 @@
+import cow_milk_tracker as app
+from conftest import milk_record
+
+
+def entry(record, kind="record", base=None):
+    return {"id": record["record_id"] + kind, "kind": kind, "record": record, "base": base}
+
+
+def test_second_record_for_a_slot_is_a_conflict_and_a_retry_a_duplicate(sqlite):
+    ledger = app.MilkEntryLedger(sqlite)
+    first = entry(milk_record("2026-10-01", 1, 9.0))
+    other = entry(milk_record("2026-10-01", 1, 7.0, worker="Jane", record_id="other"))
+
+    accepted, duplicates, conflicts = ledger.admit([first, first, other])
+
+    assert accepted == [first]
+    assert duplicates == [first]
+    assert [(item, holder['record_id']) for item, holder in conflicts] == [(other, first['record']['record_id'])]
+
+
+def test_edit_based_on_an_old_version_is_a_conflict(sqlite):
+    record = milk_record("2026-10-01", 1, 9.0)
+    sqlite.append_milk_data([record])
+    ledger = app.MilkEntryLedger(sqlite)
+    base = app.milk_entry_version(record["timestamp"])
+    edit = dict(record, event="upsert", milk_liters=10.0, timestamp="2026-10-01 09:00:00")
+    stale = dict(record, event="upsert", milk_liters=11.0, timestamp="2026-10-01 09:05:00")
+
+    accepted, _, conflicts = ledger.admit([entry(edit, "event", base), entry(stale, "event", base)])
+
+    assert [item['record']['milk_liters'] for item in accepted] == [10.0]
+    assert [holder['milk_liters'] for _, holder in conflicts] == [10.0]
+
+
+def test_verify_reads_storage_again_within_the_ttl(sqlite):
+    ledger = app.MilkEntryLedger(sqlite, ttl_seconds=3600)
+    mine = entry(milk_record("2026-10-01", 1, 9.0))
+    assert ledger.admit([mine])[0] == [mine]
+
+    # Another process saves the same cow and session after the slot was read
+    sqlite.append_milk_data([milk_record("2026-10-01", 1, 7.0, worker="Jane", record_id="elsewhere")])
+
+    fresh, written, conflicts = ledger.verify([mine])
+    assert (fresh, written) == ([], [])
+    assert [holder['record_id'] for _, holder in conflicts] == ["elsewhere"]
+
+
+def test_written_records_are_duplicates_of_later_retries(sqlite):
+    ledger = app.MilkEntryLedger(sqlite)
+    record = entry(milk_record("2026-10-01", 1, 9.0))
+    ledger.admit([record])
+    sqlite.append_milk_data([record["record"]])
+    ledger.written([record])
+
+    assert ledger.verify([record])[1] == [record]
+    assert ledger.admit([record])[1] == [record]
+    assert ledger.claims == {}
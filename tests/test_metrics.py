@@ -0,0 +1,45 @@
+import pytest
+
+import cow_milk_tracker as app
+
+
+def test_timers_and_counters_are_kept_per_label_set():
+    metrics = app.Metrics(window=4)
+    for seconds in (0.1, 0.2, 0.3, 0.4, 0.5):
+        metrics.observe("section", seconds, section="daily")
+    metrics.observe("section", 1.0, section="export")
+    metrics.increment("saves", 2, kind="record")
+    metrics.increment("saves", kind="record")
+
+    table = metrics.timer_table().set_index('labels')
+    assert table.loc["section=daily", 'count'] == 5
+    assert table.loc["section=daily", 'avg_ms'] == 300.0
+    assert table.loc["section=daily", 'max_ms'] == 500.0
+    # Percentiles only cover the recent window
+    assert table.loc["section=daily", 'p50_ms'] == 350.0
+    assert ("saves_total", {'kind': "record"}, 3) in metrics.samples()
+
+
+def test_timer_records_a_block_ended_by_an_exception():
+    metrics = app.Metrics()
+
+    with pytest.raises(RuntimeError):
+        with metrics.timer("job", job="rollup"):
+            raise RuntimeError("stopped")
+
+    assert metrics.timer_table()['count'].tolist() == [1]
+
+
+def test_disabled_metrics_record_nothing():
+    metrics = app.Metrics(enabled=False)
+
+    with metrics.timer("section", section="daily"):
+        metrics.increment("saves")
+
+    assert metrics.samples() == []
+
+
+def test_prometheus_text_escapes_label_values():
+    text = app.format_prometheus([("dairy_saves_total", {'worker': 'Ann "A"'}, 3), ("dairy_queue_depth", {}, 0)])
+
+    assert text == 'dairy_saves_total{worker="Ann \\"A\\""} 3\ndairy_queue_depth 0\n'
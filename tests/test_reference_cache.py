@@ -0,0 +1,44 @@
+import threading
+
+import cow_milk_tracker as app
+
+
+class Storage:
+    def __init__(self, cache_key):
+        self.cache_key = cache_key
+
+
+def test_put_writes_through_without_a_reload():
+    cache = app.ReferenceCache(ttl_seconds=300)
+    storage = Storage("farm")
+    loads = []
+    cache.get(storage, "workers", lambda: loads.append(1) or ["Ann"])
+
+    saved, version = cache.put(storage, "workers", ["Ann", "Bob"])
+
+    assert saved == ["Ann", "Bob"]
+    assert cache.version(storage, "workers") == version
+    assert cache.get(storage, "workers", lambda: loads.append(1) or []) == (["Ann", "Bob"], version)
+    assert len(loads) == 1
+
+
+def test_loads_of_other_tables_do_not_wait_for_each_other():
+    cache = app.ReferenceCache(ttl_seconds=300)
+    storage = Storage("farm")
+    started, release = threading.Event(), threading.Event()
+
+    def slow_loader():
+        started.set()
+        release.wait(5)
+        return ["Ann"]
+
+    slow = threading.Thread(target=cache.get, args=(storage, "workers", slow_loader))
+    slow.start()
+    started.wait(5)
+    try:
+        # Would block on a single shared load lock until the workers load finished
+        assert cache.get(storage, "system_config", lambda: 50)[0] == 50
+        assert cache.get(Storage("other farm"), "workers", lambda: ["Eve"])[0] == ["Eve"]
+    finally:
+        release.set()
+        slow.join()
@@ -0,0 +1,182 @@
+import pytest
+
+import cow_milk_tracker as app
+from conftest import milk_record
+
+
+def test_append_milk_data_is_one_request_per_month(spreadsheet):
+    records = [milk_record("2026-09-30", cow, 9.5) for cow in range(1, 4)]
+    records += [milk_record("2026-10-01", cow, 10.0) for cow in range(1, 6)]
+
+    assert app.append_milk_data_to_sheets(spreadsheet, records)
+
+    assert spreadsheet.calls["append_rows"] == 2
+    october = spreadsheet.sheets["milk_data_2026_10"].rows
+    assert october[0] == app.MILK_DATA_HEADERS
+    assert len(october) == 6
+
+
+def test_append_milk_data_reuses_cached_headers(spreadsheet):
+    app.append_milk_data_to_sheets(spreadsheet, [milk_record("2026-10-01", 1, 10.0)])
+    reads = spreadsheet.calls["row_values"]
+
+    app.append_milk_data_to_sheets(spreadsheet, [milk_record("2026-10-01", cow, 10.0) for cow in range(2, 40)])
+
+    assert spreadsheet.calls["row_values"] == reads
+    assert spreadsheet.calls["append_rows"] == 2
+    assert len(spreadsheet.sheets["milk_data_2026_10"].rows) == 40
+
+
+def workers_sheet(spreadsheet, names):
+    worksheet = spreadsheet.add_worksheet("workers")
+    worksheet.rows = [["name"]] + [[name] for name in names]
+    return app.get_worksheet(spreadsheet, "workers")
+
+
+def test_removing_a_worker_rewrites_only_its_row(spreadsheet):
+    worksheet = workers_sheet(spreadsheet, ["Ann", "Bob", "Cid", "Dee"])
+    app.load_workers_from_sheets(spreadsheet)
+
+    assert app.save_workers_to_sheets(spreadsheet, ["Ann", "Cid", "Dee"])
+
+    assert spreadsheet.calls["batch_update"] == 1
+    assert worksheet._worksheet.rows == [["name"], ["Ann"], [""], ["Cid"], ["Dee"]]
+    assert app.load_workers_from_sheets(spreadsheet) == ["Ann", "Cid", "Dee"]
+
+
+def test_new_worker_fills_a_blank_row(spreadsheet):
+    worksheet = workers_sheet(spreadsheet, ["Ann", "Bob", "Cid"])
+    app.load_workers_from_sheets(spreadsheet)
+    app.save_workers_to_sheets(spreadsheet, ["Ann", "Cid"])
+
+    app.save_workers_to_sheets(spreadsheet, ["Ann", "Cid", "Eve"])
+
+    assert worksheet._worksheet.rows == [["name"], ["Ann"], ["Eve"], ["Cid"]]
+
+
+def test_edits_made_elsewhere_are_kept(spreadsheet):
+    worksheet = spreadsheet.add_worksheet("cow_assignments")
+    worksheet.rows = [["cow_number", "worker_name"], [1, "Ann"], [2, "Bob"], [3, "Cid"]]
+    assignments = app.load_cow_assignments_from_sheets(spreadsheet)
+    # Another process reassigns cow 2 and assigns cow 4
+    worksheet.rows[2] = [2, "Dee"]
+    worksheet.rows.append([4, "Dee"])
+
+    assignments[3] = "Ann"
+    assert app.save_cow_assignments_to_sheets(spreadsheet, assignments)
+
+    assert app.load_cow_assignments_from_sheets(spreadsheet) == {1: "Ann", 2: "Dee", 3: "Ann", 4: "Dee"}
+
+
+def test_single_record_table_is_replaced(spreadsheet):
+    app.load_system_config_from_sheets(spreadsheet)
+
+    assert app.save_system_config_to_sheets(spreadsheet, 80)
+
+    assert app.load_system_config_from_sheets(spreadsheet) == 80
+
+
+def milk_row(record):
+    return [record[header] for header in app.MILK_DATA_HEADERS]
+
+
+def milk_event(event, record, timestamp, **changes):
+    return dict(record, event=event, event_id=f"{event}-{record['record_id']}-{timestamp}", timestamp=timestamp, **changes)
+
+
+def test_compaction_writes_only_the_rows_events_touch(spreadsheet):
+    kept, edited, deleted = (milk_record("2026-10-17", cow, 9.0) for cow in (1, 2, 3))
+    partition = spreadsheet.add_worksheet("milk_data_2026_10")
+    partition.rows = [app.MILK_DATA_HEADERS, milk_row(kept), ["17/13/2026", "Morning", 9, 9.0, "John Doe", "", "", "x"],
+                      milk_row(edited), milk_row(deleted)]
+    app.append_milk_events_to_sheets(spreadsheet, [
+        milk_event("upsert", edited, "2026-10-17 08:00:00", milk_liters=12.5),
+        milk_event("delete", deleted, "2026-10-17 08:00:00"),
+    ])
+    spreadsheet.calls.clear()
+
+    assert app.compact_milk_data_in_sheets(spreadsheet) == 2
+
+    rows = partition.rows
+    assert rows[1] == milk_row(kept)
+    assert rows[2][0] == "17/13/2026"
+    assert rows[3][3] == 12.5 and rows[3][7] == edited['record_id']
+    assert len(rows) == 4
+    assert spreadsheet.calls["batch_update"] == 1 and spreadsheet.calls["append_rows"] == 0
+    assert spreadsheet.sheets["milk_events"].rows == [app.MILK_EVENT_HEADERS]
+
+
+def test_cow_logged_again_in_the_same_second_as_a_delete_is_kept():
+    deleted = milk_record("2026-10-17", 1, 9.0, timestamp="2026-10-17 06:00:00")
+    relogged = milk_record("2026-10-17", 1, 9.4, timestamp="2026-10-17 06:00:00", record_id="again")
+    base = app.clean_milk_frame(app.pd.DataFrame([deleted, relogged]))[0]
+    events = app.clean_milk_frame(app.pd.DataFrame([milk_event("delete", deleted, "2026-10-17 06:00:00")]))[0]
+
+    merged = app.materialize_milk_events(base, events)
+
+    assert merged['record_id'].tolist() == ["again"]
+
+
+class ApiResponse:
+    def __init__(self, status):
+        self.status_code = status
+        self.text = ""
+
+    def json(self):
+        return {"error": {"code": self.status_code, "message": "injected", "status": "INJECTED"}}
+
+
+class ThrottledWorksheet:
+    """Worksheet that fails calls with the queued HTTP statuses; a 5xx fails after the call was applied"""
+
+    def __init__(self, worksheet, **failures):
+        self.worksheet = worksheet
+        self.failures = {operation: list(statuses) for operation, statuses in failures.items()}
+
+    def __getattr__(self, name):
+        method = getattr(self.worksheet, name)
+
+        def call(*args, **kwargs):
+            status = self.failures.get(name, []) and self.failures[name].pop(0)
+            if status == 429:
+                raise app.gspread.exceptions.APIError(ApiResponse(status))
+            result = method(*args, **kwargs)
+            if status:
+                raise app.gspread.exceptions.APIError(ApiResponse(status))
+            return result
+        return call
+
+
+def throttled_client(spreadsheet, **failures):
+    client = app.SheetsClient(spreadsheet, base_delay=0, max_delay=0)
+    fake = spreadsheet.add_worksheet("milk_data_2026_10")
+    return client, app.MeteredWorksheet(client, ThrottledWorksheet(fake, **failures)), fake
+
+
+def test_throttled_append_is_retried(spreadsheet):
+    client, worksheet, fake = throttled_client(spreadsheet, append_rows=[429, 429])
+
+    worksheet.append_rows([["a"]])
+
+    assert fake.rows == [["a"]]
+    assert client.stats["append_rows"]["retries"] == 2
+
+
+def test_append_is_not_retried_after_a_server_error(spreadsheet):
+    client, worksheet, fake = throttled_client(spreadsheet, append_rows=[503])
+
+    with pytest.raises(app.gspread.exceptions.APIError):
+        worksheet.append_rows([["a"]])
+
+    assert fake.rows == [["a"]]
+    assert client.stats["append_rows"]["retries"] == 0
+
+
+def test_idempotent_writes_and_reads_are_retried_after_a_server_error(spreadsheet):
+    client, worksheet, fake = throttled_client(spreadsheet, batch_update=[503], get_values=[500, 429])
+
+    worksheet.batch_update([{"range": "A1:A1", "values": [["a"]]}])
+
+    assert worksheet.get_values() == [["a"]]
+    assert client.stats["batch_update"]["retries"] == 1
+    assert client.stats["get_values"]["retries"] == 2
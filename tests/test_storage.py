@@ -0,0 +1,72 @@
+import threading
+import time
+
+import pytest
+
+import cow_milk_tracker as app
+from conftest import milk_record
+
+
+def test_backends_must_implement_the_whole_interface():
+    class Partial(app.StorageBackend):
+        def load_workers(self):
+            return []
+
+    with pytest.raises(TypeError):
+        Partial()
+
+
+def test_sqlite_round_trip(sqlite):
+    assert sqlite.save_workers(["Ann", "Bob"])
+    assert sqlite.save_cow_assignments({1: "Ann", 2: "Bob"})
+    sqlite.append_milk_data([milk_record("2026-10-01", 1, 9.5), milk_record("2026-10-01", 2, 8.0)])
+
+    assert sqlite.load_workers() == ["Ann", "Bob"]
+    assert sqlite.load_cow_assignments() == {1: "Ann", 2: "Bob"}
+    frame, rejected = sqlite.fetch_milk_data(["2026_10"])
+    assert rejected == {}
+    assert sorted(frame['cow_number'].tolist()) == [1, 2]
+    assert sqlite.milk_partitions() == ["2026_10"]
+
+
+def test_parse_milk_frame_accepts_hand_typed_dates():
+    values = [app.MILK_DATA_HEADERS,
+              ["2026-10-17", "Morning", 1, 9.0, "Ann", "", "2026-10-17 06:00:00", "a"],
+              ["10/17/2026", "Morning", 2, 9.5, "Ann", "", "10/17/2026 06:05", "b"],
+              ["17.10.2026", "Evening", 3, 8.0, "Ann", "", "", "c"],
+              ["not a date", "Evening", 4, 8.0, "Ann", "", "", "d"]]
+
+    frame, rejected = app.parse_milk_frame(values)
+
+    assert frame['date'].tolist() == ["2026-10-17"] * 3
+    assert frame["timestamp"].tolist() == ["2026-10-17 06:00:00", "10/17/2026 06:05", ""]
+    assert rejected == {"invalid date": 1}
+
+
+def test_sqlite_compaction_keeps_what_another_connection_saves_meanwhile(sqlite, monkeypatch):
+    app_connection = app.SQLiteBackend(sqlite.path)
+    record = milk_record("2026-10-01", 1, 9.0)
+    sqlite.append_milk_data([record])
+    sqlite.append_milk_events([dict(record, event="upsert", event_id="e1", milk_liters=11.0,
+                                    timestamp="2026-10-01 07:00:00")])
+    materialize = app.materialize_milk_events
+    writers = []
+
+    def save_while_folding(base, events):
+        # The app saves a new record and another edit after compaction has read both tables
+        writer = threading.Thread(target=lambda: (
+            app_connection.append_milk_data([milk_record("2026-10-01", 2, 8.0)]),
+            app_connection.append_milk_events([dict(record, event="upsert", event_id="e2", milk_liters=12.0,
+                                                    timestamp="2026-10-01 08:00:00")])))
+        writer.start()
+        writers.append(writer)
+        time.sleep(0.3)
+        return materialize(base, events)
+
+    monkeypatch.setattr(app, "materialize_milk_events", save_while_folding)
+    assert sqlite.compact_milk_data() == 1
+    writers[0].join()
+    monkeypatch.setattr(app, "materialize_milk_events", materialize)
+
+    frame, _ = sqlite.fetch_milk_data()
+    assert sorted(zip(frame['cow_number'], frame['milk_liters'])) == [(1, 12.0), (2, 8.0)]
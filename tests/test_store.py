@@ -0,0 +1,49 @@
+import pandas as pd
+
+import cow_milk_tracker as app
+from conftest import milk_record
+
+
+def test_store_keeps_records_with_hand_typed_dates():
+    frame = pd.DataFrame([milk_record("2026-10-17", 1, 9.0),
+                          milk_record("10/17/2026", 2, 9.5, timestamp="10/17/2026 06:05")])
+
+    store = app.MilkRecordStore(frame)
+
+    assert store.frame()['date'].dt.strftime("%Y-%m-%d").tolist() == ["2026-10-17"] * 2
+    assert store.frame()['timestamp'].notna().all()
+    assert len(store.date_frame("2026-10-17")) == 2
+
+
+def test_merged_delete_spares_a_cow_logged_again_in_the_same_second():
+    deleted = milk_record("2026-10-17", 1, 9.0)
+    store = app.MilkRecordStore(pd.DataFrame([deleted]))
+    relogged = milk_record("2026-10-17", 1, 9.4, record_id="again")
+    delete = dict(deleted, event="delete", event_id="e1")
+
+    store.merge_changes(app.clean_milk_frame(pd.DataFrame([relogged]))[0],
+                        app.clean_milk_frame(pd.DataFrame([delete]))[0])
+
+    assert store.frame()['record_id'].tolist() == ["again"]
+
+
+def test_merging_the_same_changes_twice_changes_nothing_the_second_time():
+    store = app.MilkRecordStore(pd.DataFrame([milk_record("2026-10-17", cow, 9.0) for cow in (1, 2, 3)]))
+    records = app.clean_milk_frame(pd.DataFrame([milk_record("2026-10-17", 4, 8.0),
+                                                 milk_record("2026-10-17", 5, 8.5),
+                                                 milk_record("2026-10-17", 5, 8.5)]))[0]
+    events = app.clean_milk_frame(pd.DataFrame([
+        dict(milk_record("2026-10-17", 1, 9.0), event="upsert", event_id="e1",
+             milk_liters=10.0, timestamp="2026-10-17 08:00:00"),
+        dict(milk_record("2026-10-17", 2, 9.0), event="delete", event_id="e2"),
+        dict(milk_record("2026-10-17", 3, 9.0, record_id=""), event="upsert", event_id="e3",
+             milk_liters=7.0, timestamp="2026-10-17 08:00:00"),
+        dict(milk_record("2026-10-17", 6, 6.0), event="upsert", event_id="e4"),
+    ]))[0]
+
+    assert store.merge_changes(records, events) == 6
+    merged = store.frame().copy()
+
+    assert store.merge_changes(records, events) == 0
+    pd.testing.assert_frame_equal(store.frame(), merged)
+    assert sorted(zip(merged['cow_number'], merged['milk_liters'])) == [(1, 10.0), (3, 7.0), (4, 8.0), (5, 8.5), (6, 6.0)]
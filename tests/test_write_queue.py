@@ -0,0 +1,74 @@
+import json
+import time
+
+import pytest
+
+import benchmark
+import cow_milk_tracker as app
+from conftest import milk_record
+
+
+def wait_for(condition, timeout=10.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.01)
+
+
+@pytest.fixture
+def queue(spreadsheet, tmp_path):
+    queue = app.WriteBehindQueue(app.GoogleSheetsBackend(spreadsheet), str(tmp_path / "journal.jsonl"),
+                                 coalesce_seconds=0, base_delay=0.05, max_delay=0.05)
+    return queue
+
+
+def test_append_that_landed_before_a_timeout_is_not_written_again(queue, spreadsheet, monkeypatch):
+    append_rows = benchmark.FakeWorksheet.append_rows
+    failures = []
+
+    def lands_then_times_out(worksheet, values, **kwargs):
+        append_rows(worksheet, values, **kwargs)
+        if not failures:
+            failures.append(True)
+            raise TimeoutError("read timed out")
+
+    monkeypatch.setattr(benchmark.FakeWorksheet, "append_rows", lands_then_times_out)
+
+    assert queue.submit("s1", [milk_record("2026-10-17", 1, 9.5)])
+    wait_for(lambda: queue.failures)
+    status = queue.session_status("s1")
+    assert "Could not save milk records" in status['last_error']
+    assert "read timed out" in status['last_error']
+
+    queue.retry_now()
+    wait_for(lambda: queue.session_status("s1")['saved'] == 1)
+    assert len(spreadsheet.sheets["milk_data_2026_10"].rows) == 2
+    assert queue.session_status("s1")['last_error'] is None
+
+
+def test_journal_is_replayed_after_a_crash_without_writing_anything_twice(spreadsheet, tmp_path):
+    storage = app.GoogleSheetsBackend(spreadsheet)
+    saved, landed, new = (milk_record("2026-10-17", cow, 9.0) for cow in (1, 2, 3))
+    landed_edit = dict(saved, event="upsert", event_id="e1", milk_liters=9.5, timestamp="2026-10-17 07:00:00")
+    new_edit = dict(saved, event="upsert", event_id="e2", milk_liters=9.8, timestamp="2026-10-17 08:00:00")
+    storage.append_milk_data([saved, landed])
+    storage.append_milk_events([landed_edit])
+    journal = tmp_path / "journal.jsonl"
+    lines = [{'op': "add", 'id': f"r{cow}", 'session': "s1", 'kind': "record", 'record': record}
+             for cow, record in ((1, saved), (2, landed), (3, new))]
+    lines += [{'op': "add", 'id': event['event_id'], 'session': "s1", 'kind': "event", 'record': event}
+              for event in (landed_edit, new_edit)]
+    lines.append({'op': "done", 'ids': ["r1"]})
+    # Crashed after r2 and e1 were written but before they were journaled as done, mid-way through a line
+    journal.write_text("".join(json.dumps(line) + "\n" for line in lines) + '{"op": "add", "id"', encoding="utf-8")
+
+    queue = app.WriteBehindQueue(storage, str(journal), coalesce_seconds=0)
+    assert queue.depth() == 4
+    wait_for(lambda: queue.depth() == 0)
+
+    records, _ = storage.fetch_milk_data()
+    assert sorted(row[-1] for row in spreadsheet.sheets["milk_data_2026_10"].rows[1:]) == sorted(
+        record['record_id'] for record in (saved, landed, new))
+    assert [row[1] for row in spreadsheet.sheets["milk_events"].rows[1:]] == ["e1", "e2"]
+    assert records.sort_values('cow_number')['milk_liters'].tolist() == [9.8, 9.0, 9.0]
+    assert journal.read_text(encoding="utf-8") == ""
@@ -0,0 +1,45 @@
+import pandas as pd
+
+import cow_milk_tracker as app
+
+
+def history(yields, cow=1, session="Morning"):
+    days = pd.date_range("2026-09-01", periods=len(yields))
+    return pd.DataFrame({"date": days, "cow_number": cow, "time": session, "milk_liters": yields})
+
+
+def batch(*entries):
+    return pd.DataFrame(entries, columns=["cow_number", "time", "milk_liters"])
+
+
+def test_score_flags_yields_far_from_the_cows_usual():
+    baselines = app.YieldBaselines(history([10.0, 10.5, 9.5, 10.0, 10.2, 9.8, 10.1]))
+
+    scores = baselines.score(batch((1, "Morning", 10.1), (1, "Morning", 4.0), (1, "Morning", 16.0)))
+
+    assert scores['usual'].tolist() == [10.0, 10.0, 10.0]
+    assert scores['flag'].tolist() == ["", "low", "high"]
+    assert scores['z'].iloc[1] < -3.5
+
+
+def test_score_tells_a_decimal_slip_from_a_high_yield():
+    baselines = app.YieldBaselines(history([12.0] * 6))
+
+    assert baselines.score(batch((1, "Morning", 120.0)))['flag'].tolist() == ["decimal slip"]
+
+
+def test_score_does_not_judge_cows_without_enough_history():
+    frame = pd.concat([history([10.0] * 4, cow=1), history([10.0] * 6, cow=2, session="Evening")])
+    baselines = app.YieldBaselines(frame, min_sessions=5)
+
+    scores = baselines.score(batch((1, "Morning", 2.0), (2, "Morning", 2.0), (2, "Evening", 2.0)))
+
+    assert scores['flag'].tolist() == ["", "", "low"]
+    assert scores['usual'].isna().tolist() == [False, True, False]
+    assert scores['z'].isna().tolist() == [True, True, False]
+
+
+def test_baselines_use_only_the_most_recent_sessions():
+    baselines = app.YieldBaselines(history([20.0] * 10 + [10.0] * 5), sessions=5)
+
+    assert baselines.score(batch((1, "Morning", 10.0)))['flag'].tolist() == [""]